@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+"""单线程事件循环服务器引擎
+
+线程引擎为每个客户端启动一个接收线程和一个发送线程, 几百个用户时就是几百个线程,
+大量时间花在GIL争用和上下文切换上。这里所有连接都跑在一个 selectors (Linux 上为
+epoll) 事件循环里: socket 设为非阻塞, 每个连接有自己的写缓冲队列, 只有在内核发送
+缓冲区满时才注册可写事件。
+
+转发、统计和移除客户端的语义与 Server 保持一致: 每个接收方最多缓存 queue_size 个帧,
+满了丢弃最旧的一帧并计入丢包。写缓冲队列挂着可写事件的时间就是阻塞在发送上的
+时间, 与线程引擎一样计入背压评估 (见 backpressure.py)。
+"""
+
+import asyncio
+import socket
+import time
+from collections import deque
+
+from backpressure import EVAL_INTERVAL
+from protocol import HEADER, PT_AUDIO, PT_CN, FrameDecoder
+from server import Server
+from workers import ANNOUNCE_INTERVAL
+
+
+class AsyncConnection:
+    """事件循环中的一个客户端连接"""
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.decoder = FrameDecoder()
+        # 写缓冲队列, 队首可能是已经发送了一部分的帧
+        self.outbox = deque()
+        # 最多缓存的帧数, 中继连接会调大
+        self.queue_size = server.queue_size
+        self.head_offset = 0
+        self.writing = False
+        self.closed = False
+
+    def on_readable(self):
+        """socket可读时调用"""
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"接收数据错误: {e}")
+            self.server.remove_client(self, self.addr)
+            return
+
+        if not data:
+            self.server.remove_client(self, self.addr)
+            return
+
+        try:
+            frames = self.decoder.feed(data)
+        except Exception as e:
+            print(f"处理数据错误: {e}")
+            self.server.remove_client(self, self.addr)
+            return
+
+        sender_id = self.server.client_ids.get(self, 0)
+        for frame in frames:
+            self.server.route_frame(self, sender_id, frame)
+
+    def enqueue(self, packet):
+        """加入写缓冲队列, 返回是否因队列满丢弃了旧帧"""
+        dropped = 0
+        server = self.server
+        server.queue_depth_frames.observe(len(self.outbox))
+        # drop-oldest 生效时队列缩短, 可能一次丢掉好几帧
+        limit = server.backlog_limit(self)
+        while len(self.outbox) >= (limit or self.queue_size) and len(self.outbox) > bool(self.head_offset):
+            self.drop_oldest()
+            dropped += 1
+        if dropped:
+            server.drops["queue_full" if limit is None else "slow_consumer"].inc(dropped)
+        self.outbox.append(packet)
+        server.note_pressure(self, len(self.outbox), dropped)
+        if not self.writing:
+            self.flush()
+        return dropped > 0
+
+    def drop_oldest(self):
+        """丢掉最旧的一个音频帧, 控制消息 (WELCOME、CODEC 等) 尽量保留"""
+        # 已经发出一部分的队首帧不能丢, 否则数据流会错位
+        first = 1 if self.head_offset else 0
+        for i in range(first, len(self.outbox)):
+            if HEADER.unpack_from(self.outbox[i])[4] in (PT_AUDIO, PT_CN):
+                del self.outbox[i]
+                return
+        del self.outbox[first]
+
+    def flush(self):
+        """尽可能多地把写缓冲队列写入socket"""
+        server = self.server
+        while self.outbox:
+            head = self.outbox[0]
+            start = time.perf_counter()
+            try:
+                sent = self.sock.send(memoryview(head)[self.head_offset:])
+                server.send_seconds.observe(time.perf_counter() - start)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                print(f"发送数据错误: {e}")
+                self.server.remove_client(self, self.addr)
+                return
+
+            self.head_offset += sent
+            server.bytes_out.inc(sent)
+            if self.head_offset < len(head):
+                # 内核发送缓冲区已满, 等可写事件
+                if not self.writing:
+                    self.server.loop.add_writer(self.sock, self.flush)
+                    self.writing = True
+                    self.blocked(True)
+                return
+            self.outbox.popleft()
+            self.head_offset = 0
+            server.frames_out.inc()
+
+        if self.writing:
+            self.server.loop.remove_writer(self.sock)
+            self.writing = False
+            self.blocked(False)
+
+    def blocked(self, started):
+        """开始或结束等待可写事件, 计入发送压力"""
+        pressure = self.server.client_pressure.get(self)
+        if pressure is not None:
+            if started:
+                pressure.send_started(time.monotonic())
+            else:
+                pressure.send_finished(time.monotonic())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        loop = self.server.loop
+        loop.remove_reader(self.sock)
+        if self.writing:
+            loop.remove_writer(self.sock)
+            self.writing = False
+        self.outbox.clear()
+        self.sock.close()
+
+
+class AsyncServer(Server):
+    """所有连接共用一个事件循环的服务器"""
+
+    def __init__(self, ip="0.0.0.0", port=2000, mix=False, udp=False, reuse_port=False, vad=False,
+                 active_speakers=0):
+        super().__init__(ip, port, mix=mix, udp=udp, reuse_port=reuse_port, vad=vad,
+                         active_speakers=active_speakers)
+        self.loop = None
+        self.next_tick = 0
+
+    def serve_forever(self):
+        # Windows 默认的 Proactor 循环不支持 add_reader, 显式使用 selectors 循环
+        self.loop = asyncio.SelectorEventLoop()
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            self.loop.close()
+
+    async def run(self):
+        self.s.listen(100)
+        self.s.setblocking(False)
+        print('服务器运行在IP: '+self.ip)
+        print('服务器运行在端口: '+str(self.port))
+        print('服务器引擎: asyncio')
+        self.loop.add_reader(self.s, self.accept_ready)
+        if self.udp:
+            self.udp.setblocking(False)
+            self.loop.add_reader(self.udp, self.udp_ready)
+        if self.bus:
+            # 总线消息在事件循环线程里处理, 与本地转发共用同一个线程
+            self.bus.attach(self.loop.add_reader, self.loop.remove_reader)
+            self.schedule_bus_tick()
+        if self.relay:
+            self.relay.start()
+        if self.mix:
+            # 混音节拍也在事件循环里跑, 不需要额外线程
+            self.next_tick = self.loop.time()
+            self.schedule_mix()
+        self.loop.call_later(EVAL_INTERVAL, self.schedule_backpressure)
+        # 一直运行直到进程退出
+        await self.loop.create_future()
+
+    def accept_ready(self):
+        """监听socket可读时接受所有等待中的连接"""
+        while True:
+            try:
+                c, addr = self.s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"接受连接时出错: {e}")
+                return
+
+            try:
+                self.configure_client_socket(c)
+                c.setblocking(False)
+            except OSError as e:
+                print(f"接受连接时出错: {e}")
+                c.close()
+                continue
+
+            print(f"新连接来自: {addr[0]}:{addr[1]}")
+            self.start_connection(c, addr)
+
+    def start_connection(self, c, addr):
+        c.setblocking(False)
+        conn = AsyncConnection(self, c, addr)
+        self.add_client(conn, conn.outbox)
+        self.loop.add_reader(c, conn.on_readable)
+        return conn
+
+    def start_peer(self, sock, addr):
+        # 由中继的连接线程调用, 转到事件循环线程里登记
+        self.loop.call_soon_threadsafe(super().start_peer, sock, addr)
+
+    def resize_queue(self, c, size):
+        c.queue_size = size
+
+    def queue_depth(self, c):
+        return len(c.outbox)
+
+    def udp_ready(self):
+        """UDP socket可读时处理所有已到达的数据报"""
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"UDP接收错误: {e}")
+                return
+            self.handle_datagram(data, addr)
+
+    def schedule_mix(self):
+        """事件循环中的混音节拍, 按绝对时间排期"""
+        self.next_tick += self.frame_interval
+        try:
+            self.mix_tick()
+        except Exception as e:
+            print(f"混音出错: {e}")
+        now = self.loop.time()
+        if now - self.next_tick > 5 * self.frame_interval:
+            self.next_tick = now
+        self.loop.call_at(self.next_tick, self.schedule_mix)
+
+    def schedule_backpressure(self):
+        try:
+            self.check_backpressure()
+        except Exception as e:
+            print(f"背压评估出错: {e}")
+        self.loop.call_later(EVAL_INTERVAL, self.schedule_backpressure)
+
+    def client_socket(self, c):
+        return c.sock
+
+    def schedule_bus_tick(self):
+        self.bus.tick()
+        self.loop.call_later(ANNOUNCE_INTERVAL, self.schedule_bus_tick)
+
+    def queue_packet(self, c, packet):
+        if c.closed:
+            return False
+        return c.enqueue(packet)
+
+    def forward_packet(self, c, room, packet_for):
+        """将一个完整的帧写入同一房间其他成员的写缓冲队列"""
+        # 转发只发生在事件循环线程, 锁只用于和统计线程同步计数
+        dropped = 0
+        for client in list(room.members):
+            if client is c:
+                continue
+            packet = packet_for(self.client_codecs.get(client, "pcm"))
+            if packet is None:
+                continue
+            pressure = self.client_pressure.get(client)
+            if pressure is not None and pressure.speakers is not None and \
+                    not self.limit_streams(pressure, [packet]):
+                continue
+            if self.send_to_client(client, packet):
+                dropped += 1
+
+        with self.lock:
+            room.stats["frames"] += 1
+            room.stats["dropped"] += dropped
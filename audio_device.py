@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+"""音频设备抽象
+
+AudioClient 不直接读写声卡, 只提供两个回调, 由设备按自己的时钟调用:
+
+    on_capture(pcm, capture_time)   每录到一块数据调用一次
+    on_playout(frame_count)         设备需要一块播放数据时调用, 返回PCM字节
+
+每个设备还提供:
+
+    latency()   设备的 (输入延迟, 输出延迟), 秒, 用于估计端到端延迟
+    clock       返回当前时间 (秒) 的函数, 采集时间戳按它给出, 客户端的到达和播放时间也用它
+    speed       相对实时的速率, 1 为实时
+
+PyAudioDevice 使用 PyAudio 的回调模式 (stream_callback), 两个回调都在 PortAudio
+的音频线程里运行, 客户端不再需要靠阻塞读写和 sleep 轮询的录音/播放线程。
+
+其余设备不接真实硬件, 可以在没有声卡的机器上运行整个客户端, 对采集 -> 编码 ->
+发送 -> 接收 -> 抖动缓冲 -> 播放的完整链路做基准测试和回归测试:
+
+- ClockDevice: 按时钟节拍驱动回调, 录音数据来自 source, 播放数据交给 sink;
+- NullDevice: 录音为静音, 播放数据丢弃;
+- SyntheticDevice: 录音为正弦音或白噪声;
+- WavDevice: 从 WAV 文件录音, 把播放的声音写入 WAV 文件;
+- LoopbackDevice: 播放的声音延迟几个周期后被录进来, 模拟扬声器对着麦克风。
+
+它们都可以 start() 后在后台线程里运行, speed 大于 1 时比实时更快, 这时采集时间戳和
+客户端时钟使用按同样倍数走的虚拟时钟 (同一进程里的设备共用); 也可以不启动线程而由
+测试代码逐个调用 tick(), 配合手动推进的时钟得到完全确定的结果。
+
+device_factory() 按 "名称[:参数,...]" 形式的描述创建设备, 供客户端的 --audio-device 使用。
+"""
+
+import threading
+import time
+import wave
+from collections import deque
+
+import numpy as np
+
+DEVICE_NAMES = ("pyaudio", "null", "tone", "noise", "wav", "loopback")
+
+# 虚拟时钟的起点, 同一进程里同样速率的虚拟时钟读数一致
+CLOCK_EPOCH = time.time()
+CLOCK_EPOCH_PERF = time.perf_counter()
+
+
+def scaled_clock(speed):
+    """返回按 speed 倍实时速率走的时钟函数"""
+    if speed == 1:
+        return time.time
+    return lambda: CLOCK_EPOCH + (time.perf_counter() - CLOCK_EPOCH_PERF) * speed
+
+
+class PyAudioDevice:
+    """PyAudio 回调模式的声卡输入/输出"""
+
+    def __init__(self, rate, channels, chunk_size):
+        self.rate = rate
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self.clock = time.time
+        self.speed = 1.0
+        self.pa = None
+        self.input_stream = None
+        self.output_stream = None
+
+    def open(self, on_capture, on_playout):
+        """打开输入/输出流, 不开始运行"""
+        import pyaudio
+        self.on_capture = on_capture
+        self.on_playout = on_playout
+        self.continue_flag = pyaudio.paContinue
+        self.pa = pyaudio.PyAudio()
+        self.output_stream = self.pa.open(format=pyaudio.paInt16,
+                                          channels=self.channels,
+                                          rate=self.rate,
+                                          output=True,
+                                          frames_per_buffer=self.chunk_size,
+                                          stream_callback=self.output_callback,
+                                          start=False)
+        self.input_stream = self.pa.open(format=pyaudio.paInt16,
+                                         channels=self.channels,
+                                         rate=self.rate,
+                                         input=True,
+                                         frames_per_buffer=self.chunk_size,
+                                         stream_callback=self.input_callback,
+                                         start=False)
+
+    def input_callback(self, in_data, frame_count, time_info, status):
+        self.on_capture(in_data, time.time())
+        return None, self.continue_flag
+
+    def output_callback(self, in_data, frame_count, time_info, status):
+        return self.on_playout(frame_count), self.continue_flag
+
+    def latency(self):
+        return self.input_stream.get_input_latency(), self.output_stream.get_output_latency()
+
+    def start(self):
+        self.output_stream.start_stream()
+        self.input_stream.start_stream()
+
+    def close(self):
+        for stream in (self.input_stream, self.output_stream):
+            if stream is not None:
+                try:
+                    stream.stop_stream()
+                    stream.close()
+                except Exception:
+                    pass
+        self.input_stream = None
+        self.output_stream = None
+        if self.pa is not None:
+            try:
+                self.pa.terminate()
+            except Exception:
+                pass
+            self.pa = None
+
+
+class ClockDevice:
+    """按时钟节拍驱动回调的虚拟设备, 用于无声卡、无界面的测试
+
+    source(frame_count) 返回录音数据, 默认静音; sink(pcm) 接收播放数据, 默认丢弃。
+    clock 为返回当前时间(秒)的函数, 作为采集时间戳和节拍的时间基准, 默认按 speed 取。
+    """
+
+    def __init__(self, rate, channels, chunk_size, source=None, sink=None, clock=None, speed=1.0):
+        if speed <= 0:
+            raise ValueError("speed 必须大于0")
+        self.rate = rate
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self.period = chunk_size / rate
+        self.source = source
+        self.sink = sink
+        self.speed = speed
+        self.clock = clock if clock is not None else scaled_clock(speed)
+        self.silence = bytes(chunk_size * channels * 2)
+        self.ticks = 0
+        self.running = False
+        self.thread = None
+
+    def open(self, on_capture, on_playout):
+        self.on_capture = on_capture
+        self.on_playout = on_playout
+
+    def latency(self):
+        # 没有硬件缓冲, 数据交出去就算播放了
+        return 0.0, 0.0
+
+    def capture(self, frame_count):
+        """一个周期的录音数据"""
+        return self.source(frame_count) if self.source else self.silence
+
+    def playout(self, pcm):
+        """一个周期的播放数据"""
+        if self.sink:
+            self.sink(pcm)
+
+    def tick(self):
+        """运行一个周期: 先录一块再播一块"""
+        self.on_capture(self.capture(self.chunk_size), self.clock())
+        self.playout(self.on_playout(self.chunk_size))
+        self.ticks += 1
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        period = self.period / self.speed
+        next_tick = time.perf_counter()
+        while self.running:
+            self.tick()
+            next_tick += period
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -4 * period:
+                # 落后太多时不补跑, 从现在重新计时
+                next_tick = time.perf_counter()
+
+    def close(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=1)
+        self.thread = None
+
+
+class NullDevice(ClockDevice):
+    """录音为静音、播放数据丢弃的设备"""
+
+    def __init__(self, rate, channels, chunk_size, speed=1.0):
+        super().__init__(rate, channels, chunk_size, speed=speed)
+
+
+class SyntheticDevice(ClockDevice):
+    """录音为合成信号的设备: signal 为 "tone" (正弦音) 或 "noise" (白噪声), level 为峰值幅度"""
+
+    def __init__(self, rate, channels, chunk_size, signal="tone", frequency=440.0, level=8000,
+                 seed=0, sink=None, speed=1.0):
+        super().__init__(rate, channels, chunk_size, sink=sink, speed=speed)
+        if signal not in ("tone", "noise"):
+            raise ValueError(f"未知的合成信号: {signal}")
+        self.signal = signal
+        self.frequency = frequency
+        self.level = level
+        self.phase = 0.0
+        self.rng = np.random.default_rng(seed)
+
+    def capture(self, frame_count):
+        if self.signal == "tone":
+            step = 2 * np.pi * self.frequency / self.rate
+            samples = self.level * np.sin(self.phase + step * np.arange(frame_count))
+            # 相位连续, 块之间没有咔嗒声
+            self.phase = (self.phase + step * frame_count) % (2 * np.pi)
+        else:
+            samples = self.rng.normal(0, self.level / 3, frame_count)
+        samples = np.clip(samples, -32768, 32767).astype(np.int16)
+        return np.repeat(samples, self.channels).tobytes()
+
+
+class WavDevice(ClockDevice):
+    """从 WAV 文件录音、把播放的声音写入 WAV 文件的设备
+
+    input_path 的采样率和声道数必须与客户端一致, 采样为16位; 读完后录音为静音并
+    设置 finished, loop 为真时从头循环。input_path 或 output_path 为 None 时对应方向
+    为静音/丢弃。
+    """
+
+    def __init__(self, rate, channels, chunk_size, input_path=None, output_path=None, loop=False,
+                 speed=1.0):
+        super().__init__(rate, channels, chunk_size, speed=speed)
+        self.input_path = input_path
+        self.output_path = output_path
+        self.loop = loop
+        self.reader = None
+        self.writer = None
+        self.finished = input_path is None
+
+    def open(self, on_capture, on_playout):
+        super().open(on_capture, on_playout)
+        if self.input_path:
+            self.reader = wave.open(self.input_path, "rb")
+            params = (self.reader.getframerate(), self.reader.getnchannels(), self.reader.getsampwidth())
+            if params != (self.rate, self.channels, 2):
+                self.reader.close()
+                self.reader = None
+                raise ValueError(f"{self.input_path}: 采样率/声道数/位宽为 {params}, "
+                                 f"需要 {(self.rate, self.channels, 2)}")
+        if self.output_path:
+            self.writer = wave.open(self.output_path, "wb")
+            self.writer.setnchannels(self.channels)
+            self.writer.setsampwidth(2)
+            self.writer.setframerate(self.rate)
+
+    def capture(self, frame_count):
+        if self.reader is None or self.finished:
+            return self.silence
+        data = self.reader.readframes(frame_count)
+        size = frame_count * self.channels * 2
+        if len(data) < size:
+            if self.loop and self.reader.getnframes():
+                self.reader.rewind()
+                data += self.reader.readframes(frame_count - len(data) // (self.channels * 2))
+            else:
+                self.finished = True
+        return data.ljust(size, b"\x00")
+
+    def playout(self, pcm):
+        if self.writer is not None:
+            self.writer.writeframes(pcm)
+
+    def close(self):
+        super().close()
+        for f in (self.reader, self.writer):
+            if f is not None:
+                f.close()
+        self.reader = None
+        self.writer = None
+
+
+class LoopbackDevice(ClockDevice):
+    """播放的声音延迟 delay 个周期、乘以 gain 后被录进来的设备, 模拟扬声器对着麦克风"""
+
+    def __init__(self, rate, channels, chunk_size, delay=1, gain=1.0, speed=1.0):
+        super().__init__(rate, channels, chunk_size, speed=speed)
+        self.gain = gain
+        self.pending = deque([self.silence] * max(1, delay), maxlen=max(1, delay))
+
+    def latency(self):
+        # 声音从 "扬声器" 回到 "麦克风" 的时间算作设备延迟
+        return 0.0, len(self.pending) * self.period
+
+    def capture(self, frame_count):
+        pcm = self.pending[0]
+        if self.gain == 1:
+            return pcm
+        samples = np.frombuffer(pcm, dtype=np.int16) * self.gain
+        return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+    def playout(self, pcm):
+        self.pending.append(bytes(pcm))
+
+
+def device_factory(spec, speed=1.0):
+    """按描述返回 factory(rate, channels, chunk_size) -> 设备
+
+    描述的形式 (参数用逗号分隔, 文件路径里可以有冒号):
+        pyaudio                 声卡 (默认)
+        null                    静音输入, 丢弃输出
+        tone[:频率[,幅度]]      正弦音输入
+        noise[:幅度]            白噪声输入
+        wav:输入.wav[,输出.wav]  从文件录音, 可选把播放的声音写入文件; 输入留空表示静音
+        loopback[:周期数]       播放的声音延迟几个周期后录回来
+    """
+    name, _, rest = spec.partition(":")
+    params = rest.split(",") if rest else []
+    if name == "pyaudio":
+        if speed != 1:
+            raise ValueError("声卡只能按实时速率运行")
+        return PyAudioDevice
+    if name == "null":
+        return lambda rate, channels, chunk: NullDevice(rate, channels, chunk, speed=speed)
+    if name == "tone":
+        frequency = float(params[0]) if params else 440.0
+        level = float(params[1]) if len(params) > 1 else 8000
+        return lambda rate, channels, chunk: SyntheticDevice(rate, channels, chunk, "tone", frequency,
+                                                              level, speed=speed)
+    if name == "noise":
+        level = float(params[0]) if params else 3000
+        return lambda rate, channels, chunk: SyntheticDevice(rate, channels, chunk, "noise",
+                                                              level=level, speed=speed)
+    if name == "wav":
+        input_path = params[0] if params and params[0] else None
+        output_path = params[1] if len(params) > 1 and params[1] else None
+        return lambda rate, channels, chunk: WavDevice(rate, channels, chunk, input_path, output_path,
+                                                       speed=speed)
+    if name == "loopback":
+        delay = int(params[0]) if params else 1
+        return lambda rate, channels, chunk: LoopbackDevice(rate, channels, chunk, delay, speed=speed)
+    raise ValueError(f"未知的音频设备: {spec} (可选: {', '.join(DEVICE_NAMES)})")
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+"""音频格式协商和格式转换
+
+原来所有客户端都固定为 48kHz 双声道, 语音用不到这么高的采样率和立体声, 带宽是
+12kHz 单声道的 8 倍。现在客户端在 HELLO 里声明采集格式 ("format") 和希望收到的
+播放格式 ("playout"), 都是 {"rate": 采样率, "channels": 声道数}, 不提供时为
+48kHz 双声道; 服务器在 WELCOME 里回复实际采用的格式, 不支持的格式按默认处理。
+
+所有格式的一帧时长相同 (48kHz 下 1024 个采样, 约21ms), 这样不同格式的客户端在
+同一个房间里时帧仍然一一对应, 转发和混音的节拍不变。因此采样率只能取一帧采样数
+为整数的 48000、24000、12000 Hz。
+
+服务器上一路流由编码和格式共同确定, 用 "编码@采样率/声道数" 的流名称表示
+(默认格式时就是编码名, 与原来相同)。发送者和接收方的流名称不同时, 服务器解码、
+转换格式、再按接收方的编码编码。
+
+格式转换先做声道下混 (求平均) 再重采样, 或者先重采样再上混 (复制), 重采样用有理
+数倍的多相 FIR 滤波器: 原型低通滤波器 (Kaiser 窗 sinc) 按输出采样的相位拆成多组
+系数, 因为每帧的输入和输出采样数都是整数, 每帧里各输出采样用到的输入下标和系数
+完全相同, 预先算成两个矩阵, 每帧只需一次取下标和一次按行加权求和, 不逐个采样循环。
+系数矩阵按采样率对缓存; 每路流的重采样器保留上一帧末尾的采样, 帧之间是连续的。
+"""
+
+import functools
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from codec import CODEC_NAMES, create_codec
+
+AudioFormat = namedtuple("AudioFormat", ["rate", "channels"])
+
+DEFAULT_FORMAT = AudioFormat(48000, 2)
+# 一帧的时长由 48kHz 下的 1024 个采样决定
+FRAME_BASE_RATE = 48000
+FRAME_BASE_SAMPLES = 1024
+FRAME_DURATION = FRAME_BASE_SAMPLES / FRAME_BASE_RATE
+SUPPORTED_RATES = (48000, 24000, 12000)
+SUPPORTED_CHANNELS = (1, 2)
+
+
+def frame_samples(rate):
+    """该采样率下一帧的采样数 (每个声道)"""
+    return rate * FRAME_BASE_SAMPLES // FRAME_BASE_RATE
+
+
+def check_format(rate, channels):
+    """检查格式是否支持, 返回 AudioFormat, 不支持时抛出 ValueError"""
+    if rate not in SUPPORTED_RATES:
+        raise ValueError(f"不支持的采样率 {rate}, 可选: {', '.join(map(str, SUPPORTED_RATES))}")
+    if channels not in SUPPORTED_CHANNELS:
+        raise ValueError(f"不支持的声道数 {channels}, 可选: 1, 2")
+    return AudioFormat(rate, channels)
+
+
+def parse_format(value, default=DEFAULT_FORMAT):
+    """解析握手消息里的格式 {"rate": ..., "channels": ...}, 缺失或不支持时返回 default"""
+    if not isinstance(value, dict):
+        return default
+    try:
+        return check_format(value.get("rate"), value.get("channels"))
+    except ValueError:
+        return default
+
+
+def format_message(fmt):
+    """AudioFormat 转成握手消息里的字典"""
+    return {"rate": fmt.rate, "channels": fmt.channels}
+
+
+def stream_name(codec, fmt):
+    """编码和格式对应的流名称"""
+    if fmt == DEFAULT_FORMAT:
+        return codec
+    return f"{codec}@{fmt.rate}/{fmt.channels}"
+
+
+@functools.lru_cache(maxsize=None)
+def parse_stream_name(name):
+    """stream_name 的逆操作, 返回 (编码名, AudioFormat); 名称无效时抛出 ValueError"""
+    codec, _, fmt = name.partition("@")
+    if codec not in CODEC_NAMES:
+        raise ValueError(f"未知的编码: {codec}")
+    if not fmt:
+        return codec, DEFAULT_FORMAT
+    try:
+        rate, channels = (int(x) for x in fmt.split("/"))
+    except ValueError:
+        raise ValueError(f"流名称格式错误: {name}")
+    return codec, check_format(rate, channels)
+
+
+def stream_format(name):
+    return parse_stream_name(name)[1]
+
+
+@functools.lru_cache(maxsize=None)
+def stream_frame_bytes(name):
+    """这路流一帧音频的负载字节数 (不含帧头)"""
+    codec, fmt = parse_stream_name(name)
+    return len(create_codec(codec, fmt.channels).encode(bytes(frame_samples(fmt.rate) * fmt.channels * 2)))
+
+
+def valid_stream(name):
+    try:
+        parse_stream_name(name)
+    except ValueError:
+        return False
+    return True
+
+
+class StreamCodecs(dict):
+    """流名称 -> 编解码器, 第一次用到时按流的声道数创建 (编解码器无状态, 可以共用)"""
+
+    def __missing__(self, name):
+        codec, fmt = parse_stream_name(name)
+        value = self[name] = create_codec(codec, fmt.channels)
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def polyphase_table(in_rate, out_rate, zero_crossings=8, beta=8.0):
+    """一帧的多相重采样矩阵, 返回 (下标矩阵, 系数矩阵, 需要保留的历史采样数)
+
+    输出第 n 个采样 = sum_k 系数[n, k] * 扩展输入[下标[n, k]],
+    扩展输入为上一帧末尾的历史采样加上这一帧的采样。
+    """
+    g = math.gcd(in_rate, out_rate)
+    up, down = out_rate // g, in_rate // g
+    n_in, n_out = frame_samples(in_rate), frame_samples(out_rate)
+    factor = max(up, down)
+    # 原型滤波器工作在 in_rate * up 的采样率上, 截止在较低的奈奎斯特频率的 90%
+    half = zero_crossings * factor
+    length = 2 * half + 1
+    cutoff = 0.9 / factor
+    t = np.arange(length) - half
+    prototype = cutoff * np.sinc(cutoff * t) * np.kaiser(length, beta)
+
+    taps = -(-length // up)
+    u = np.arange(n_out) * down
+    newest = u // up
+    phase = u - newest * up
+    k = np.arange(taps)
+    coefficient_index = phase[:, None] + k[None, :] * up
+    valid = coefficient_index < length
+    weights = np.where(valid, prototype[np.minimum(coefficient_index, length - 1)], 0.0)
+    # 每个相位的系数和归一化为1, 直流增益准确
+    weights /= weights.sum(axis=1, keepdims=True)
+    history = taps
+    index = newest[:, None] - k[None, :] + history
+    assert index.min() >= 0 and index.max() < history + n_in
+    return index, weights.astype(np.float32), history
+
+
+class Resampler:
+    """一路帧流的重采样, 保留上一帧末尾的采样"""
+
+    def __init__(self, in_rate, out_rate, channels):
+        self.index, self.weights, history = polyphase_table(in_rate, out_rate)
+        self.history = np.zeros((history, channels), dtype=np.float32)
+
+    def process(self, samples):
+        """samples 为一帧 float32 采样, 形状 (采样数, 声道数)"""
+        extended = np.concatenate((self.history, samples))
+        self.history = extended[-len(self.history):]
+        # 逐声道取下标再按行求和, 比一次处理 (采样, 抽头, 声道) 三维数组快
+        return np.stack([np.einsum("nk,nk->n", self.weights, np.take(extended[:, c], self.index))
+                         for c in range(extended.shape[1])], axis=1)
+
+
+class StreamConverter:
+    """把一路流的 int16 PCM 帧从 source 格式转换成 target 格式"""
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.samples = frame_samples(source.rate)
+        channels = min(source.channels, target.channels)
+        self.resampler = None
+        if source.rate != target.rate:
+            self.resampler = Resampler(source.rate, target.rate, channels)
+
+    def convert(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+        needed = self.samples * self.source.channels
+        if len(samples) != needed:
+            # 长度不对的帧补零或截断, 保证每帧采样数固定
+            fixed = np.zeros(needed, dtype=np.int16)
+            n = min(len(samples), needed)
+            fixed[:n] = samples[:n]
+            samples = fixed
+        x = samples.reshape(-1, self.source.channels).astype(np.float32)
+        if self.source.channels > self.target.channels:
+            x = x.mean(axis=1, keepdims=True)
+        if self.resampler is not None:
+            x = self.resampler.process(x)
+        if self.target.channels > x.shape[1]:
+            x = np.repeat(x, self.target.channels, axis=1)
+        return np.clip(np.rint(x), -32768, 32767).astype(np.int16).tobytes()
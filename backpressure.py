@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+"""慢速接收方的检测和处理 (背压)
+
+一个客户端的网络不好时, 服务器发给它的数据积在内核发送缓冲区里, 发送线程阻塞在
+sendmsg 上 (事件循环引擎则是写缓冲队列一直挂着可写事件), 它的发送队列被新帧不断
+覆盖。原来这些只体现为 queue_full 丢包计数, 既不知道是哪个客户端, 也不做任何处理。
+
+现在每个客户端有一个 ClientPressure, 记录:
+
+- 阻塞在发送上的时间 (正在进行的发送也算到当前时刻);
+- 内核发送缓冲区里还没发出的字节数 (Linux 的 SIOCOUTQ, 其他平台没有这一项);
+- 发送时积压的最大帧数和因队列满丢弃的帧数。
+
+服务器每 EVAL_INTERVAL 秒评估一次, 满足任一条件就认为这个周期拥塞: 阻塞时间超过
+周期的 BLOCKED_RATIO, 未发出的字节超过发送缓冲区的一半, 有帧被丢弃, 积压超过队列
+长度的一半。处理策略 (--slow-policy, 可以组合) 为:
+
+    drop-oldest  拥塞期间发送队列只保留最新的 SLOW_QUEUE 帧, 旧帧直接丢弃,
+                 延迟不会越积越大; 恢复后换回正常长度
+    downgrade    连续拥塞时逐级降级: 先换成客户端支持的更低码率的编码 (服务器用
+                 CODEC 控制帧通知客户端), 然后在转发模式下限制只收最活跃的几路流;
+                 连续一段时间正常后逐级恢复
+    disconnect   连续拥塞超过 --slow-budget 秒后断开这个客户端
+
+每一次处理都计入 voicechat_backpressure_actions_total{action}。客户端也可以在报告里
+请求少收几路 (见 congestion.py), 与降级的流数限制同时存在时取较小的。
+"""
+
+import socket
+import struct
+import threading
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Windows 上没有 ioctl, 只用阻塞时间和丢帧判断
+    fcntl = None
+
+from codec import CODEC_BITS, CODEC_NAMES
+from protocol import HEADER, PT_AUDIO
+from speakers import ActiveSpeakers
+
+SLOW_POLICIES = ("drop-oldest", "downgrade", "disconnect")
+BACKPRESSURE_ACTIONS = ("drop_oldest", "recover", "downgrade", "upgrade", "disconnect")
+# 评估周期, 秒
+EVAL_INTERVAL = 0.5
+# 一个周期里阻塞在发送上的时间超过这个比例时为拥塞
+BLOCKED_RATIO = 0.2
+# 内核发送缓冲区里未发出的字节超过缓冲区大小的这个比例时为拥塞
+UNSENT_RATIO = 0.5
+# drop-oldest: 拥塞期间最多积压的帧数 (约85ms)
+SLOW_QUEUE = 4
+# 连续拥塞这么多个周期降一级, 连续正常这么多个周期升一级
+DOWNGRADE_PERIODS = 2
+UPGRADE_PERIODS = 20
+# downgrade: 编码降到最低后, 每个接收方最多收的流数依次为
+STREAM_STEPS = (4, 2, 1)
+
+
+def unsent_bytes(sock):
+    """内核发送缓冲区里还没有发出 (或没有被对方确认) 的字节数, 不支持时返回 None"""
+    if fcntl is None or not hasattr(termios, "TIOCOUTQ"):
+        return None
+    try:
+        # 对 TCP socket, TIOCOUTQ 即 SIOCOUTQ
+        value = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0")
+    except (OSError, ValueError):
+        return None
+    return struct.unpack("i", value)[0]
+
+
+def send_buffer_size(sock):
+    try:
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    except (OSError, ValueError):
+        return None
+
+
+def downgrade_ladder(codec, offered=(), codec_switch=False, limit_streams=True, active_speakers=0):
+    """一个客户端的降级阶梯: [(编码, 最多流数), ...], 第 0 级是协商的结果, 流数 0 表示不限
+
+    编码只在客户端支持切换时 (codec_switch) 换成它在 HELLO 里列出的、码率更低的编码,
+    每种码率取客户端最优先的一个, 相邻两级的帧长一定不同, 客户端据此丢弃切换前后
+    编码不对的帧。混音模式下每个接收方本来只收一路, limit_streams 为 False; 服务器
+    已经按 --active-speakers 限制时, 只取比它更少的流数。
+    """
+    ladder = [(codec, 0)]
+    if codec_switch:
+        bits = CODEC_BITS[codec]
+        for name in offered or []:
+            if name in CODEC_NAMES and CODEC_BITS[name] < bits:
+                bits = CODEC_BITS[name]
+                ladder.append((name, 0))
+    if limit_streams:
+        codec = ladder[-1][0]
+        ladder.extend((codec, k) for k in STREAM_STEPS if not active_speakers or k < active_speakers)
+    return ladder
+
+
+class ClientPressure:
+    """一个接收方的发送压力, 由发送方更新, 评估线程 (或事件循环) 定期取走"""
+
+    def __init__(self, ladder, now):
+        self.ladder = ladder
+        self.level = 0
+        # 本周期的测量, 评估时清零
+        self.period_start = now
+        self.blocked = 0.0
+        self.sending_since = None
+        self.dropped = 0
+        self.backlog = 0
+        # 最近一次评估的结果, 用于指标
+        self.blocked_ratio = 0.0
+        self.unsent = 0
+        self.congested = False
+        self.congested_since = None
+        self.congested_periods = 0
+        self.healthy_periods = 0
+        # 拥塞时缩短的队列长度, None 表示正常长度
+        self.queue_limit = None
+        # 客户端在报告里请求的最多流数 (见 congestion.py), 0 表示不限
+        self.requested_streams = 0
+        # 限制流数时按音量选择的发送者; 最近一次因此少发帧的时刻 (time.monotonic())
+        self.speakers = None
+        self.limited_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def codec(self):
+        return self.ladder[self.level][0]
+
+    @property
+    def stream_limit(self):
+        """当前最多发几路流, 取降级阶梯和客户端请求中较小的限制, 0 表示不限"""
+        limits = [k for k in (self.ladder[self.level][1], self.requested_streams) if k]
+        return min(limits) if limits else 0
+
+    def send_started(self, now):
+        with self.lock:
+            self.sending_since = now
+
+    def send_finished(self, now):
+        with self.lock:
+            if self.sending_since is not None:
+                self.blocked += now - max(self.sending_since, self.period_start)
+                self.sending_since = None
+
+    def note(self, backlog=0, dropped=0):
+        with self.lock:
+            self.dropped += dropped
+            if backlog > self.backlog:
+                self.backlog = backlog
+
+    def take(self, now):
+        """取走本周期的 (阻塞时间比例, 丢帧数, 最大积压) 并开始新周期"""
+        with self.lock:
+            blocked = self.blocked
+            if self.sending_since is not None:
+                blocked += now - max(self.sending_since, self.period_start)
+            period = max(now - self.period_start, 1e-6)
+            result = (min(1.0, blocked / period), self.dropped, self.backlog)
+            self.period_start = now
+            self.blocked = 0.0
+            self.dropped = 0
+            self.backlog = 0
+        return result
+
+    def admit(self, packet, now):
+        """限制流数时判断一个转发帧是否发给这个接收方"""
+        speakers = self.speakers
+        if speakers is None:
+            return True
+        _, sender_id, _, _, payload_type, level = HEADER.unpack_from(packet)
+        if payload_type != PT_AUDIO:
+            # 舒适噪声描述帧只有几个字节, 照常发送
+            return True
+        return speakers.admit(sender_id, level, now)
+
+    def set_level(self, level):
+        """切换到降级阶梯的第 level 级, 返回编码是否变了"""
+        old = self.codec
+        self.level = level
+        self.update_speakers()
+        return self.codec != old
+
+    def request_streams(self, streams):
+        """客户端请求最多收 streams 路 (0 为不限), 返回限制是否变了"""
+        if streams == self.requested_streams:
+            return False
+        self.requested_streams = streams
+        self.update_speakers()
+        return True
+
+    def update_speakers(self):
+        streams = self.stream_limit
+        if not streams:
+            self.speakers = None
+        elif self.speakers is None or self.speakers.limit != streams:
+            self.speakers = ActiveSpeakers(streams)
+
+
+class BackpressurePolicy:
+    """按测量结果决定对慢速接收方的处理"""
+
+    def __init__(self, policies=("drop-oldest",), budget=10.0, queue_size=20):
+        self.policies = set(policies)
+        self.budget = budget
+        self.queue_size = queue_size
+
+    @property
+    def downgrade(self):
+        return "downgrade" in self.policies
+
+    def evaluate(self, pressure, now, unsent=None, buffer_size=None):
+        """评估一个周期, 更新 pressure 的状态, 返回要执行的动作列表 (BACKPRESSURE_ACTIONS)"""
+        ratio, dropped, backlog = pressure.take(now)
+        pressure.blocked_ratio = ratio
+        pressure.unsent = unsent or 0
+        congested = (ratio > BLOCKED_RATIO or dropped > 0 or backlog > self.queue_size // 2
+                     or (unsent is not None and buffer_size and unsent > buffer_size * UNSENT_RATIO))
+        actions = []
+        if congested:
+            pressure.healthy_periods = 0
+            pressure.congested_periods += 1
+            if not pressure.congested:
+                pressure.congested = True
+                pressure.congested_since = now
+                if "drop-oldest" in self.policies:
+                    pressure.queue_limit = SLOW_QUEUE
+                    actions.append("drop_oldest")
+            if "disconnect" in self.policies and now - pressure.congested_since >= self.budget:
+                actions.append("disconnect")
+            elif (self.downgrade and pressure.congested_periods >= DOWNGRADE_PERIODS
+                  and pressure.level < len(pressure.ladder) - 1):
+                pressure.congested_periods = 0
+                actions.append("downgrade")
+        else:
+            pressure.congested_periods = 0
+            pressure.healthy_periods += 1
+            if pressure.congested:
+                pressure.congested = False
+                pressure.congested_since = None
+                if pressure.queue_limit is not None:
+                    pressure.queue_limit = None
+                    actions.append("recover")
+            if pressure.level > 0 and pressure.healthy_periods >= UPGRADE_PERIODS:
+                pressure.healthy_periods = 0
+                actions.append("upgrade")
+        return actions
@@ -0,0 +1,1134 @@
+#!/usr/bin/python3
+"""性能基准测试
+
+用法:
+    python benchmark.py engine --clients 10,50,100,200 --talkers 2 --duration 5
+    python benchmark.py codec --frames 500
+    python benchmark.py vad --frames 3000
+    python benchmark.py send --duration 3
+    python benchmark.py rooms --clients 120 --room-sizes 120,30,8,4
+    python benchmark.py workers --workers 1,2,4 --clients 240 --room-size 6
+    python benchmark.py relay --listeners 5,20,50
+    python benchmark.py dtx --frames 1500 --listeners 4
+    python benchmark.py speakers --clients 16 --loud 2 --limits 0,2,3
+    python benchmark.py pipeline --codecs pcm,adpcm --seconds 20 --speed 4
+    python benchmark.py resample --formats 48000/2,24000/1,12000/1 --frames 500
+    python benchmark.py record --speakers 8 --seconds 30
+    python benchmark.py congestion --capacity 2000:15,300:20,100:15,1000:30 --loss 0.0
+
+网络相关的子命令都在本机回环地址上运行, 结果以表格打印; congestion 是不联网的
+离线模拟, 同样的参数每次结果相同。
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from codec import CODEC_BITS, CODEC_NAMES, create_codec
+from audioformat import AudioFormat, StreamConverter, check_format, frame_samples
+from dtx import DtxEncoder
+from plc import comfort_noise
+from vad import VoiceActivityDetector
+from metrics import Registry
+from protocol import Frame, FrameDecoder, encode_control, encode_frame, HEADER_SIZE, PT_AUDIO, PT_CN, PT_HELLO
+from recorder import SessionRecorder
+from congestion import REPORT_INTERVAL, RateController, Report, StreamMonitor, send_ladder, stream_bitrate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 48kHz 双声道 16位, 每帧1024个采样
+FRAME_BYTES = 1024 * 2 * 2
+FRAME_INTERVAL = 1024 / 48000
+
+
+def percentile(values, p):
+    """简单的百分位数, values 为空时返回0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def process_cpu_seconds(pid):
+    """读取进程累计CPU时间 (用户态+内核态), 仅支持 Linux"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = int(fields[11]) + int(fields[12])
+        return ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_tree_cpu_seconds(pid):
+    """进程及其所有子进程的累计CPU时间, 仅支持 Linux"""
+    total = process_cpu_seconds(pid)
+    if total is None:
+        return None
+    try:
+        children = []
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(x) for x in f.read().split())
+    except (OSError, ValueError):
+        return total
+    for child in children:
+        total += process_tree_cpu_seconds(child) or 0.0
+    return total
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(engine, port, extra_args=()):
+    """在子进程中启动服务器并等待端口可连接"""
+    cmd = [sys.executable, os.path.join(HERE, "server.py"),
+           "--host", "127.0.0.1", "--port", str(port), "--engine", engine]
+    cmd.extend(extra_args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"服务器没有在端口 {port} 上启动")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def run_load(port, clients, talkers, duration, payload_size=FRAME_BYTES, rooms=None):
+    """连接 clients 个模拟客户端, 其中 talkers 个按实时速率发送帧
+
+    rooms 为每个客户端要加入的房间名列表, 给出时先发送 HELLO。
+    返回已发送帧数、收到的音频帧数和端到端转发延迟列表(秒)。
+    """
+    sel = selectors.DefaultSelector()
+    socks = []
+    try:
+        for _ in range(clients):
+            s = socket.create_connection(("127.0.0.1", port), timeout=5)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.settimeout(1.0)
+            socks.append(s)
+            sel.register(s, selectors.EVENT_READ, FrameDecoder())
+            if rooms is not None:
+                hello = {"transport": "tcp", "codecs": ["pcm"], "room": rooms[len(socks) - 1]}
+                s.sendall(encode_control(PT_HELLO, hello))
+        # 等服务器登记完所有连接
+        time.sleep(0.5)
+
+        payload = bytes(payload_size)
+        sent = 0
+        received = 0
+        latencies = []
+        seq = 0
+        start = time.perf_counter()
+        next_send = start
+        end = start + duration
+
+        while True:
+            now = time.perf_counter()
+            if now >= end + 0.5:
+                break
+            if now >= next_send and now < end:
+                for s in socks[:talkers]:
+                    s.sendall(encode_frame(payload, seq=seq, timestamp=time.time()))
+                    sent += 1
+                seq += 1
+                next_send += FRAME_INTERVAL
+            timeout = max(0.0, min(next_send, end + 0.5) - time.perf_counter())
+            for key, _ in sel.select(timeout):
+                data = key.fileobj.recv(262144)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                arrival = time.time()
+                for frame in key.data.feed(data):
+                    if frame.payload_type != PT_AUDIO:
+                        continue
+                    received += 1
+                    latencies.append(arrival - frame.timestamp)
+        return sent, received, latencies
+    finally:
+        sel.close()
+        for s in socks:
+            s.close()
+
+
+def bench_engine(args):
+    """对比线程引擎和asyncio引擎的CPU占用与可承载客户端数"""
+    counts = [int(x) for x in args.clients.split(",")]
+    print(f"{'引擎':<10}{'客户端':>8}{'CPU%':>8}{'CPU%/连接':>12}{'送达率':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for engine in args.engines.split(","):
+        max_ok = 0
+        for n in counts:
+            port = free_port()
+            proc = start_server(engine, port)
+            try:
+                cpu_before = process_cpu_seconds(proc.pid)
+                wall_before = time.perf_counter()
+                try:
+                    sent, received, latencies = run_load(port, n, min(args.talkers, n), args.duration)
+                except OSError as e:
+                    print(f"{engine:<10}{n:>8}  连接失败: {e}")
+                    break
+                wall = time.perf_counter() - wall_before
+                cpu_after = process_cpu_seconds(proc.pid)
+            finally:
+                stop_server(proc)
+
+            expected = sent * (n - 1)
+            ratio = received / expected if expected else 0.0
+            if cpu_before is not None and cpu_after is not None:
+                cpu = (cpu_after - cpu_before) / wall * 100
+                cpu_text = f"{cpu:>8.1f}{cpu / n:>12.3f}"
+            else:
+                cpu_text = f"{'n/a':>8}{'n/a':>12}"
+            p50 = percentile(latencies, 50) * 1000
+            p95 = percentile(latencies, 95) * 1000
+            print(f"{engine:<10}{n:>8}{cpu_text}{ratio * 100:>9.1f}%{p50:>10.1f}{p95:>10.1f}")
+            if ratio >= 0.99 and p95 < args.max_latency:
+                max_ok = n
+        print(f"{engine}: 满足送达率>=99%且p95<{args.max_latency:.0f}ms 的最大客户端数: {max_ok}")
+
+
+def measure_throughput(port, duration, payload_size=FRAME_BYTES, batch=32):
+    """一个客户端尽快发送帧, 返回另一个客户端每秒收到的帧数"""
+    sender = socket.create_connection(("127.0.0.1", port), timeout=5)
+    receiver = socket.create_connection(("127.0.0.1", port), timeout=5)
+    stop = threading.Event()
+    try:
+        receiver.settimeout(0.5)
+        time.sleep(0.5)
+        payload = bytes(payload_size)
+        burst = b"".join(encode_frame(payload, seq=i) for i in range(batch))
+
+        def blast():
+            while not stop.is_set():
+                try:
+                    sender.sendall(burst)
+                except OSError:
+                    return
+
+        threading.Thread(target=blast, daemon=True).start()
+        decoder = FrameDecoder()
+        received = 0
+        # 先跑一小段让队列进入稳态再开始计数
+        warmup_end = time.perf_counter() + 0.3
+        start = None
+        while True:
+            now = time.perf_counter()
+            if start is None and now >= warmup_end:
+                start, received = now, 0
+            if start is not None and now - start >= duration:
+                break
+            try:
+                data = receiver.recv(262144)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            received += len(decoder.feed(data))
+        return received / (time.perf_counter() - start) if start else 0.0
+    finally:
+        stop.set()
+        sender.close()
+        receiver.close()
+
+
+def bench_send(args):
+    """单个接收方的最大转发速率, 以及实时速率下转发增加的延迟"""
+    print(f"{'引擎':<10}{'最大 帧/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for engine in args.engines.split(","):
+        port = free_port()
+        proc = start_server(engine, port)
+        try:
+            rate = measure_throughput(port, args.duration, args.payload)
+        finally:
+            stop_server(proc)
+        # 新开一个服务器测延迟, 避免上一轮积压的帧影响结果
+        port = free_port()
+        proc = start_server(engine, port)
+        try:
+            _, _, latencies = run_load(port, 2, 1, args.duration, args.payload)
+        finally:
+            stop_server(proc)
+        p50, p95, p99 = (percentile(latencies, p) * 1000 for p in (50, 95, 99))
+        print(f"{engine:<10}{rate:>12.0f}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}")
+
+
+def bench_rooms(args):
+    """同样的客户端数和说话人数, 分成不同大小的房间时服务器的开销"""
+    n = args.clients
+    talkers = min(args.talkers, n)
+    print(f"{'引擎':<10}{'房间大小':>8}{'房间数':>8}{'CPU%':>8}{'送达 帧/s':>12}{'送达率':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for engine in args.engines.split(","):
+        for size in (int(x) for x in args.room_sizes.split(",")):
+            count = max(1, n // size)
+            # 轮流分配, 前几个说话人尽量落在不同的房间
+            rooms = [f"room{i % count}" for i in range(n)]
+            members = {name: rooms.count(name) for name in set(rooms)}
+            port = free_port()
+            proc = start_server(engine, port)
+            try:
+                cpu_before = process_cpu_seconds(proc.pid)
+                wall_before = time.perf_counter()
+                sent, received, latencies = run_load(port, n, talkers, args.duration, rooms=rooms)
+                wall = time.perf_counter() - wall_before
+                cpu_after = process_cpu_seconds(proc.pid)
+            finally:
+                stop_server(proc)
+
+            per_talker = sent / talkers if talkers else 0
+            expected = sum(per_talker * (members[rooms[i]] - 1) for i in range(talkers))
+            ratio = received / expected if expected else 0.0
+            if cpu_before is not None and cpu_after is not None:
+                cpu_text = f"{(cpu_after - cpu_before) / wall * 100:>8.1f}"
+            else:
+                cpu_text = f"{'n/a':>8}"
+            p50 = percentile(latencies, 50) * 1000
+            p95 = percentile(latencies, 95) * 1000
+            print(f"{engine:<10}{size:>8}{count:>8}{cpu_text}{received / args.duration:>12.0f}"
+                  f"{ratio * 100:>9.1f}%{p50:>10.1f}{p95:>10.1f}")
+
+
+def run_load_args(job):
+    return run_load(*job)
+
+
+def bench_workers(args):
+    """同样的负载下不同工作进程数的总转发能力
+
+    客户端分散在多个负载进程里, 避免单个负载进程先成为瓶颈; 房间成员由内核随机
+    分到不同的工作进程上, 跨进程的帧经过总线转发。
+    """
+    n = args.clients
+    size = args.room_size
+    count = max(1, n // size)
+    # 每个房间第一个成员说话
+    rooms = [f"room{i % count}" for i in range(n)]
+    talkers = min(args.talkers or count, count)
+    loaders = max(1, args.loaders)
+    print(f"CPU核心数: {os.cpu_count()}, 客户端: {n}, 房间: {count}, 说话人: {talkers}, 负载进程: {loaders}")
+    print(f"{'工作进程':>8}{'CPU%':>8}{'送达 帧/s':>12}{'送达率':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    # 把客户端平均分给各负载进程, 每个负载进程的前几个客户端是说话人
+    jobs = []
+    for k in range(loaders):
+        clients = list(range(k, n, loaders))
+        jobs.append((clients, sum(1 for i in clients if i < talkers)))
+    members = {name: rooms.count(name) for name in set(rooms)}
+    for workers in (int(x) for x in args.workers.split(",")):
+        port = free_port()
+        extra = [] if workers <= 1 else ["--workers", str(workers)]
+        proc = start_server(args.engine, port, extra)
+        try:
+            # 等所有工作进程都启动并交换过房间列表
+            time.sleep(1.5)
+            cpu_before = process_tree_cpu_seconds(proc.pid)
+            wall_before = time.perf_counter()
+            with multiprocessing.Pool(loaders) as pool:
+                results = pool.map(run_load_args, [
+                    (port, len(clients), t, args.duration, FRAME_BYTES, [rooms[i] for i in clients])
+                    for clients, t in jobs])
+            wall = time.perf_counter() - wall_before
+            cpu_after = process_tree_cpu_seconds(proc.pid)
+        finally:
+            stop_server(proc)
+
+        sent = sum(r[0] for r in results)
+        received = sum(r[1] for r in results)
+        latencies = [x for r in results for x in r[2]]
+        talker_rooms = [rooms[i] for clients, t in jobs for i in clients[:t]]
+        per_talker = sent / len(talker_rooms) if talker_rooms else 0
+        expected = sum(per_talker * (members[name] - 1) for name in talker_rooms)
+        ratio = received / expected if expected else 0.0
+        if cpu_before is not None and cpu_after is not None:
+            cpu_text = f"{(cpu_after - cpu_before) / wall * 100:>8.1f}"
+        else:
+            cpu_text = f"{'n/a':>8}"
+        p50 = percentile(latencies, 50) * 1000
+        p95 = percentile(latencies, 95) * 1000
+        print(f"{workers:>8}{cpu_text}{received / args.duration:>12.0f}"
+              f"{ratio * 100:>9.1f}%{p50:>10.1f}{p95:>10.1f}")
+
+
+class CountingProxy:
+    """本机TCP转发, 统计从目标流向连接方的字节数, 用于测量两个节点之间的中继流量"""
+
+    def __init__(self, target_port):
+        self.target_port = target_port
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(4)
+        self.port = self.listener.getsockname()[1]
+        self.downstream = 0
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+                target = socket.create_connection(("127.0.0.1", self.target_port))
+            except OSError:
+                return
+            threading.Thread(target=self.pipe, args=(client, target, False), daemon=True).start()
+            threading.Thread(target=self.pipe, args=(target, client, True), daemon=True).start()
+
+    def pipe(self, src, dst, count):
+        while True:
+            try:
+                data = src.recv(262144)
+                if not data:
+                    break
+                dst.sendall(data)
+            except OSError:
+                break
+            if count:
+                self.downstream += len(data)
+        src.close()
+        dst.close()
+
+    def close(self):
+        self.listener.close()
+
+
+def bench_relay(args):
+    """说话人在节点A, 收听者在节点B, 节点之间的流量与收听者人数的关系"""
+    print(f"{'收听者':>8}{'中继 字节/帧':>14}{'直连 字节/帧':>14}{'送达率':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for n in (int(x) for x in args.listeners.split(",")):
+        port_a = free_port()
+        node_a = start_server(args.engine, port_a, ["--node-id", "1"])
+        proxy = CountingProxy(port_a)
+        port_b = free_port()
+        node_b = start_server(args.engine, port_b, ["--node-id", "2", "--peer", f"127.0.0.1:{proxy.port}"])
+        try:
+            # 等中继连接建立
+            time.sleep(2.5)
+            with multiprocessing.Pool(2) as pool:
+                talk = pool.apply_async(run_load, (port_a, args.talkers, args.talkers, args.duration,
+                                                   FRAME_BYTES, ["r"] * args.talkers))
+                listen = pool.apply_async(run_load, (port_b, n, 0, args.duration, FRAME_BYTES, ["r"] * n))
+                sent = talk.get()[0]
+                _, received, latencies = listen.get()
+        finally:
+            stop_server(node_b)
+            stop_server(node_a)
+            proxy.close()
+
+        expected = sent * n
+        ratio = received / expected if expected else 0.0
+        per_frame = proxy.downstream / sent if sent else 0.0
+        # 收听者直接连到节点A时, 每帧要发给每个收听者一份
+        direct = (FRAME_BYTES + HEADER_SIZE) * n
+        p50 = percentile(latencies, 50) * 1000
+        p95 = percentile(latencies, 95) * 1000
+        print(f"{n:>8}{per_frame:>14.0f}{direct:>14}{ratio * 100:>9.1f}%{p50:>10.1f}{p95:>10.1f}")
+
+
+def synthetic_speech(frames, rate=48000, channels=2, chunk=1024, seed=0):
+    """生成近似语音的测试信号: 带颤音的谐波加噪声, 按音节开关, 返回PCM帧列表"""
+    rng = np.random.default_rng(seed)
+    total = frames * chunk
+    t = np.arange(total) / rate
+    pitch = 140 + 30 * np.sin(2 * np.pi * 3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = (np.sin(2 * np.pi * 4 * t) > -0.3).astype(float)
+    signal = 6000 * voice * envelope + rng.normal(0, 150, total)
+    samples = np.clip(signal, -32768, 32767).astype(np.int16)
+    interleaved = np.repeat(samples, channels)
+    frame_bytes = chunk * channels * 2
+    data = interleaved.tobytes()
+    return [data[i * frame_bytes:(i + 1) * frame_bytes] for i in range(frames)]
+
+
+def synthetic_conversation(frames, snr_db, tilt=0.0, rate=48000, channels=2, chunk=1024, seed=0):
+    """带背景噪声的说话/停顿交替信号, 返回 (PCM帧列表, 每帧是否在说话)
+
+    说话段和停顿各 0.4-2 秒; 说话段内的音节间隙也算说话。噪声电平按说话段的
+    信噪比 snr_db 设定, tilt 为噪声的频谱倾斜 (见 plc.comfort_noise)。
+    """
+    rng = np.random.default_rng(seed)
+    total = frames * chunk
+    voice = np.frombuffer(b"".join(synthetic_speech(frames, rate, 1, chunk, seed)),
+                          dtype=np.int16).astype(np.float64)
+    mask = np.zeros(total, dtype=bool)
+    pos = int(rng.uniform(0.4, 2.0) * rate)
+    while pos < total:
+        length = int(rng.uniform(0.4, 2.0) * rate)
+        mask[pos:pos + length] = True
+        pos += length + int(rng.uniform(0.4, 2.0) * rate)
+    voice *= mask
+    voice_rms = np.sqrt(np.mean(voice[mask] ** 2)) if mask.any() else 1000.0
+    noise = comfort_noise(total, 1, voice_rms / 10 ** (snr_db / 20), tilt, rng)[:, 0]
+    samples = np.clip(voice + noise, -32768, 32767).astype(np.int16)
+    data = np.repeat(samples, channels).tobytes()
+    frame_bytes = chunk * channels * 2
+    pcm = [data[i * frame_bytes:(i + 1) * frame_bytes] for i in range(frames)]
+    labels = mask.reshape(frames, chunk).any(axis=1)
+    return pcm, labels
+
+
+def legacy_vad(threshold=300):
+    """原来客户端里的固定阈值静音检测 (平均绝对值), 作为对比基准"""
+    def process(pcm):
+        return np.abs(np.frombuffer(pcm, dtype=np.int16)).mean() >= threshold
+    return process
+
+
+def bench_vad(args):
+    """语音活动检测的速度、漏检率 (说话帧判为静音) 和误检率 (停顿帧判为说话)"""
+    hangover = VoiceActivityDetector().hangover
+    print(f"{'检测器':<10}{'噪声':<8}{'SNR dB':>8}{'帧/s':>10}{'漏检率':>10}{'误检率':>10}{'挂起外误检':>12}")
+    for noise_name, tilt in (("white", 0.0), ("brown", 0.9)):
+        for snr in (float(x) for x in args.snr.split(",")):
+            pcm, labels = synthetic_conversation(args.frames, snr, tilt, seed=args.seed)
+            speech = labels.sum()
+            pause = len(labels) - speech
+            # 说话结束后 hangover 帧以内的停顿帧判为说话是有意的
+            tail = np.zeros_like(labels)
+            for k in range(1, hangover + 1):
+                tail[k:] |= labels[:-k]
+            far = ~labels & ~tail
+            for name in ("vad", "legacy"):
+                process = VoiceActivityDetector().process if name == "vad" else legacy_vad()
+                start = time.perf_counter()
+                decisions = np.array([process(f) for f in pcm])
+                elapsed = time.perf_counter() - start
+                rejected = np.count_nonzero(labels & ~decisions) / speech if speech else 0.0
+                accepted = np.count_nonzero(~labels & decisions) / pause if pause else 0.0
+                far_accepted = np.count_nonzero(far & decisions) / far.sum() if far.any() else 0.0
+                print(f"{name:<10}{noise_name:<8}{snr:>8.0f}{len(pcm) / elapsed:>10.0f}"
+                      f"{rejected * 100:>9.1f}%{accepted * 100:>9.1f}%{far_accepted * 100:>11.1f}%")
+
+
+def run_dtx_load(port, codec_name, pcm, silent, listeners, use_dtx, speed):
+    """一个说话人按 speed 倍实时速率发送 pcm, 返回静音帧和说话帧的上行、下发字节数
+
+    use_dtx 为 False 时所有帧都作为音频发送; 否则静音帧 (silent 为真) 像客户端
+    一样只在需要时发描述帧。
+    """
+    codec = create_codec(codec_name)
+    dtx = DtxEncoder()
+    hello = {"transport": "tcp", "codecs": [codec_name], "room": "dtx"}
+    sel = selectors.DefaultSelector()
+    socks = []
+    try:
+        for i in range(listeners + 1):
+            s = socket.create_connection(("127.0.0.1", port), timeout=5)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.sendall(encode_control(PT_HELLO, hello))
+            socks.append(s)
+            if i:
+                s.setblocking(False)
+                sel.register(s, selectors.EVENT_READ, FrameDecoder())
+        time.sleep(0.5)
+
+        # 按类别 (静音/说话) 统计的上行和下发字节数, 序列号 -> 类别
+        uplink = {True: 0, False: 0}
+        downlink = {True: 0, False: 0}
+        kinds = {}
+        seq = 0
+        index = 0
+        interval = FRAME_INTERVAL / speed
+        next_send = time.perf_counter()
+        deadline = None
+        while deadline is None or time.perf_counter() < deadline:
+            now = time.perf_counter()
+            if index < len(pcm) and now >= next_send:
+                quiet = bool(silent[index])
+                if not use_dtx or not quiet:
+                    dtx.reset()
+                    packet = encode_frame(codec.encode(pcm[index]), seq=seq)
+                else:
+                    descriptor = dtx.silent_frame(pcm[index])
+                    packet = None if descriptor is None else encode_frame(descriptor, seq=seq,
+                                                                          payload_type=PT_CN)
+                if packet is not None:
+                    socks[0].sendall(packet)
+                    uplink[quiet] += len(packet)
+                    kinds[seq] = quiet
+                    seq += 1
+                index += 1
+                next_send += interval
+                if index == len(pcm):
+                    deadline = now + 0.5
+            timeout = max(0.0, next_send - time.perf_counter()) if deadline is None else 0.05
+            for key, _ in sel.select(timeout):
+                try:
+                    data = key.fileobj.recv(262144)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                for frame in key.data.feed(data):
+                    if frame.payload_type in (PT_AUDIO, PT_CN) and frame.seq in kinds:
+                        downlink[kinds[frame.seq]] += HEADER_SIZE + len(frame.payload)
+        return uplink, downlink
+    finally:
+        sel.close()
+        for s in socks:
+            s.close()
+
+
+def bench_dtx(args):
+    """不连续发送对静音期间上行和服务器下发流量的影响"""
+    pcm, _ = synthetic_conversation(args.frames, args.snr, 0.9, seed=args.seed)
+    # 按客户端的语音活动检测结果划分静音帧, 两种模式下是同一批帧
+    vad = VoiceActivityDetector()
+    silent = np.array([not vad.process(f) for f in pcm])
+    quiet_frames = int(silent.sum())
+    seconds = quiet_frames * FRAME_INTERVAL
+    print(f"{quiet_frames}/{len(pcm)} 帧为静音, 收听者 {args.listeners} 人, 静音期间的流量:")
+    print(f"{'编码':<8}{'模式':<12}{'上行 B/s':>12}{'下发 B/s':>12}{'上行减少':>10}{'下发减少':>10}{'说话期下发 B/s':>16}")
+    for codec_name in args.codecs.split(","):
+        baseline = None
+        for mode in ("continuous", "dtx"):
+            port = free_port()
+            server = start_server(args.engine, port)
+            try:
+                uplink, downlink = run_dtx_load(port, codec_name, pcm, silent, args.listeners,
+                                                mode == "dtx", args.speed)
+            finally:
+                stop_server(server)
+            up = uplink[True] / seconds
+            down = downlink[True] / seconds
+            talk = downlink[False] / ((len(pcm) - quiet_frames) * FRAME_INTERVAL)
+            if baseline is None:
+                baseline = (up, down)
+            up_cut = 1 - up / baseline[0] if baseline[0] else 0.0
+            down_cut = 1 - down / baseline[1] if baseline[1] else 0.0
+            print(f"{codec_name:<8}{mode:<12}{up:>12.0f}{down:>12.0f}"
+                  f"{up_cut * 100:>9.1f}%{down_cut * 100:>9.1f}%{talk:>16.0f}")
+
+
+def run_speaker_load(port, clients, loud, duration, turn):
+    """所有客户端按实时速率发送, 其中 loud 个音量高, 每 turn 秒轮换一次
+
+    返回 (每个收听者每秒收到的字节数, 高音量帧的送达率, 每个节拍一个收听者收到
+    的路数列表)。切换说话人的那个节拍里新旧说话人的帧可能都被转发。
+    """
+    sel = selectors.DefaultSelector()
+    socks = []
+    rng = np.random.default_rng(0)
+    try:
+        for _ in range(clients):
+            s = socket.create_connection(("127.0.0.1", port), timeout=5)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.sendall(encode_control(PT_HELLO, {"transport": "tcp", "codecs": ["pcm"], "room": "big"}))
+            s.setblocking(False)
+            socks.append(s)
+            sel.register(s, selectors.EVENT_READ, FrameDecoder())
+        time.sleep(0.5)
+
+        payload = bytes(FRAME_BYTES)
+        loud_sent = 0
+        loud_received = 0
+        received_bytes = 0
+        # (收听者, 序列号) -> 收到的发送者集合, 所有客户端每个节拍用同一个序列号
+        streams = {}
+        seq = 0
+        start = time.perf_counter()
+        next_send = start
+        end = start + duration
+        while True:
+            now = time.perf_counter()
+            if now >= end + 0.5:
+                break
+            round_index = int((now - start) / turn)
+            speaking = {(round_index * loud + i) % clients for i in range(loud)}
+            if now >= next_send and now < end:
+                for i, s in enumerate(socks):
+                    # 说话的人约 65 dB, 其他人是 35 dB 上下的背景噪声
+                    level = 65 if i in speaking else 35 + rng.uniform(-3, 3)
+                    # 时间戳字段用来带上这一帧是不是说话帧
+                    packet = encode_frame(payload, seq=seq, timestamp=1.0 if i in speaking else 0.0,
+                                          level=int(level))
+                    try:
+                        s.sendall(packet)
+                    except BlockingIOError:
+                        continue
+                    if i in speaking:
+                        loud_sent += 1
+                seq += 1
+                next_send += FRAME_INTERVAL
+            timeout = max(0.0, min(next_send, end + 0.5) - time.perf_counter())
+            for key, _ in sel.select(timeout):
+                try:
+                    data = key.fileobj.recv(262144)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                received_bytes += len(data)
+                for frame in key.data.feed(data):
+                    if frame.payload_type != PT_AUDIO:
+                        continue
+                    if frame.timestamp == 1.0:
+                        loud_received += 1
+                    streams.setdefault((key.fileobj.fileno(), frame.seq), set()).add(frame.sender_id)
+        expected = loud_sent * (clients - 1)
+        counts = [len(v) for v in streams.values()]
+        return received_bytes / clients / duration, loud_received / expected if expected else 0.0, counts
+    finally:
+        sel.close()
+        for s in socks:
+            s.close()
+
+
+def bench_speakers(args):
+    """只转发最活跃的 K 路时, 每个收听者的下行流量、说话帧送达率和服务器CPU"""
+    print(f"客户端: {args.clients} (都在发送), 说话人: {args.loud}, 每 {args.turn:.0f} 秒轮换")
+    print(f"{'K':>4}{'CPU%':>8}{'每人下行 KB/s':>16}{'说话帧送达率':>14}{'平均路数':>10}{'p99 路数':>10}")
+    for limit in (int(x) for x in args.limits.split(",")):
+        port = free_port()
+        proc = start_server(args.engine, port, ["--active-speakers", str(limit)])
+        try:
+            cpu_before = process_cpu_seconds(proc.pid)
+            wall_before = time.perf_counter()
+            per_listener, delivered, counts = run_speaker_load(port, args.clients, args.loud,
+                                                               args.duration, args.turn)
+            wall = time.perf_counter() - wall_before
+            cpu_after = process_cpu_seconds(proc.pid)
+        finally:
+            stop_server(proc)
+        if cpu_before is not None and cpu_after is not None:
+            cpu_text = f"{(cpu_after - cpu_before) / wall * 100:>8.1f}"
+        else:
+            cpu_text = f"{'n/a':>8}"
+        mean = sum(counts) / len(counts) if counts else 0.0
+        print(f"{limit or '全部':>4}{cpu_text}{per_listener / 1024:>16.0f}{delivered * 100:>13.1f}%"
+              f"{mean:>10.2f}{percentile(counts, 99):>10.0f}")
+
+
+def timed(function, totals):
+    """包装回调, 把调用次数和累计耗时记进 totals"""
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            totals[0] += 1
+            totals[1] += time.perf_counter() - start
+    return wrapper
+
+
+def run_pipeline(port, codec_name, transport, seconds, speed):
+    """一个说话人和一个收听者的完整客户端链路, 使用虚拟音频设备, 返回统计"""
+    from audio_device import ClockDevice
+    from client import AudioClient
+
+    source = synthetic_speech(200)
+    position = [0]
+
+    def capture(frame_count):
+        pcm = source[position[0] % len(source)]
+        position[0] += 1
+        return pcm
+
+    played = [0]
+
+    def sink(pcm):
+        if any(pcm):
+            played[0] += 1
+
+    clients = []
+    capture_cost = [0, 0.0]
+    playout_cost = [0, 0.0]
+    try:
+        for device in (lambda r, ch, cs: ClockDevice(r, ch, cs, source=capture, speed=speed),
+                       lambda r, ch, cs: ClockDevice(r, ch, cs, sink=sink, speed=speed)):
+            client = AudioClient()
+            client.codec_preference = [codec_name]
+            client.device_factory = device
+            # 实例属性覆盖方法, connect_to_server 把包装后的回调交给设备
+            client.on_capture = timed(client.on_capture, capture_cost)
+            client.on_playout = timed(client.on_playout, playout_cost)
+            if not client.connect_to_server("127.0.0.1", port, transport == "udp", "pipeline"):
+                raise ConnectionError("客户端连接失败")
+            clients.append(client)
+        talker, listener = clients
+        for client in clients:
+            client.run()
+        talker.start_sending()
+        start = time.perf_counter()
+        time.sleep(seconds / speed)
+        talker.stop_sending()
+        time.sleep(0.5 / speed + 0.2)
+        wall = time.perf_counter() - start
+        delays = list(listener.delays.values())
+        return {
+            "speed": talker.device.ticks * talker.device.period / wall,
+            "sent": talker.counters["frames_sent"].value(),
+            "received": listener.counters["packets_received"].value(),
+            "played": played[0],
+            "concealed": listener.counters["frames_concealed"].value(),
+            "capture_us": capture_cost[1] / max(1, capture_cost[0]) * 1e6,
+            "playout_us": playout_cost[1] / max(1, playout_cost[0]) * 1e6,
+            "network_ms": (delays[0].network or 0.0) * 1000 if delays else 0.0,
+            "jitter_ms": (delays[0].jitter or 0.0) * 1000 if delays else 0.0,
+        }
+    finally:
+        for client in clients:
+            client.cleanup()
+
+
+def bench_pipeline(args):
+    """不用声卡运行完整的客户端链路: 采集 -> 编码 -> 发送 -> 服务器 -> 接收 -> 抖动缓冲 -> 播放"""
+    try:
+        import client  # noqa: F401
+    except ImportError as e:
+        print(f"需要客户端的依赖: {e}")
+        return
+    print(f"{args.seconds:.0f} 秒合成语音, 按实时的 {args.speed:g} 倍运行 (延迟为虚拟时钟下的值)")
+    print(f"{'编码':<8}{'传输':<6}{'实际倍数':>10}{'发送':>8}{'收到':>8}{'播放':>8}{'补偿':>6}"
+          f"{'采集 µs/帧':>12}{'播放 µs/帧':>12}{'网络 ms':>10}{'缓冲 ms':>10}")
+    for codec_name in args.codecs.split(","):
+        for transport in args.transports.split(","):
+            port = free_port()
+            proc = start_server(args.engine, port, ["--udp"] if transport == "udp" else [])
+            try:
+                r = run_pipeline(port, codec_name, transport, args.seconds, args.speed)
+            finally:
+                stop_server(proc)
+            print(f"{codec_name:<8}{transport:<6}{r['speed']:>10.2f}{r['sent']:>8}{r['received']:>8}"
+                  f"{r['played']:>8}{r['concealed']:>6}{r['capture_us']:>12.0f}{r['playout_us']:>12.0f}"
+                  f"{r['network_ms']:>10.1f}{r['jitter_ms']:>10.1f}")
+
+
+def bench_codec(args):
+    """单线程编码/解码吞吐量, 即每个核心每秒能处理的帧数"""
+    pcm_frames = synthetic_speech(args.frames)
+    realtime = 1 / FRAME_INTERVAL
+    print(f"{'编码':<8}{'压缩比':>8}{'SNR dB':>8}{'编码 帧/s':>12}{'解码 帧/s':>12}{'实时倍数':>10}")
+    for name in args.codecs.split(","):
+        codec = create_codec(name)
+        start = time.perf_counter()
+        encoded = [codec.encode(f) for f in pcm_frames]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [codec.decode(e) for e in encoded]
+        decode_time = time.perf_counter() - start
+
+        ref = np.frombuffer(b"".join(pcm_frames), dtype=np.int16).astype(np.float64)
+        out = np.frombuffer(b"".join(decoded), dtype=np.int16).astype(np.float64)
+        noise = np.sum((ref - out) ** 2)
+        snr = 10 * np.log10(np.sum(ref ** 2) / noise) if noise else float("inf")
+        ratio = sum(len(f) for f in pcm_frames) / sum(len(e) for e in encoded)
+        enc_fps = len(pcm_frames) / encode_time
+        dec_fps = len(pcm_frames) / decode_time
+        # 一个说话人需要编码一次, 每个收听者解码一次, 这里按较慢的一侧计算
+        print(f"{name:<8}{ratio:>8.2f}{snr:>8.1f}{enc_fps:>12.0f}{dec_fps:>12.0f}"
+              f"{min(enc_fps, dec_fps) / realtime:>9.0f}x")
+    print("实时倍数约等于一个核心能同时处理的实时流数: 服务器转码、混音和录音时每路发送者解码一次,"
+          " 每个节拍每路不同的输出 (每种接收编码、每份混音) 编码一次")
+
+
+def bench_resample(args):
+    """服务器格式转换的速度和质量, 以及各格式下每路流的带宽
+
+    输入为 1kHz 正弦波, 质量按输出与理想正弦波的信噪比计算。
+    """
+    formats = []
+    for spec in args.formats.split(","):
+        rate, channels = (int(x) for x in spec.split("/"))
+        formats.append(check_format(rate, channels))
+    
+    print(f"{'格式':<12}" + "".join(f"{name + ' kbit/s':>14}" for name in CODEC_NAMES))
+    for fmt in formats:
+        pcm = bytes(frame_samples(fmt.rate) * fmt.channels * 2)
+        print(f"{fmt.rate}/{fmt.channels:<6}" + "".join(
+            f"{len(create_codec(name, fmt.channels).encode(pcm)) * 8 / FRAME_INTERVAL / 1000:>14.0f}"
+            for name in CODEC_NAMES))
+    print()
+    
+    realtime = 1 / FRAME_INTERVAL
+    print(f"{'源格式':<12}{'目标格式':<12}{'µs/帧':>10}{'实时倍数':>10}{'SNR dB':>8}")
+    for source in formats:
+        n = frame_samples(source.rate)
+        t = np.arange(n * args.frames) / source.rate
+        tone = np.round(8000 * np.sin(2 * np.pi * 1000 * t)).astype(np.int16)
+        tone = np.repeat(tone[:, None], source.channels, axis=1)
+        frames = [tone[i * n:(i + 1) * n].tobytes() for i in range(args.frames)]
+        for target in formats:
+            if target == source:
+                continue
+            converter = StreamConverter(source, target)
+            start = time.perf_counter()
+            out = [converter.convert(f) for f in frames]
+            elapsed = (time.perf_counter() - start) / args.frames
+            y = np.frombuffer(b"".join(out), dtype=np.int16).reshape(-1, target.channels)[:, 0]
+            # 跳过滤波器的启动段, 按最小二乘拟合 1kHz 正弦波
+            y = y[target.rate // 10:].astype(np.float64)
+            t = np.arange(len(y)) / target.rate
+            basis = np.stack([np.sin(2 * np.pi * 1000 * t), np.cos(2 * np.pi * 1000 * t)], axis=1)
+            residual = y - basis @ np.linalg.lstsq(basis, y, rcond=None)[0]
+            snr = 10 * np.log10(np.sum(y ** 2) / np.sum(residual ** 2))
+            print(f"{source.rate}/{source.channels:<6}{target.rate}/{target.channels:<6}"
+                  f"{elapsed * 1e6:>10.0f}{1 / elapsed / realtime:>9.0f}x{snr:>8.1f}")
+
+
+def bench_record(args):
+    """服务器端录音: 数据路径上 record() 的耗时和写线程的吞吐量
+
+    不经过网络, 直接按实时的时间间隔给每一帧标上到达时间交给录音器, 写线程同时在后台写入。
+    """
+    codec = create_codec(args.codec)
+    payloads = [codec.encode(f) for f in synthetic_speech(int(args.seconds / FRAME_INTERVAL))]
+    print(f"{'方式':<10}{'格式':<6}{'内存映射':<8}{'record µs/帧':>14}{'写线程 s':>10}{'MB/s':>10}{'实时倍数':>10}")
+    for mode in args.modes.split(","):
+        for file_format in args.formats.split(","):
+            for use_mmap in (False, True):
+                directory = tempfile.mkdtemp(prefix="voicechat-record-")
+                registry = Registry()
+                recorder = SessionRecorder(directory, registry, mode=mode, file_format=file_format,
+                                           preallocate=args.preallocate, use_mmap=use_mmap,
+                                           max_backlog=len(payloads) * args.speakers)
+                base = time.monotonic()
+                elapsed = 0.0
+                for seq, payload in enumerate(payloads):
+                    arrival = base + seq * FRAME_INTERVAL
+                    for speaker in range(args.speakers):
+                        frame = Frame(speaker + 1, seq, 0.0, PT_AUDIO, payload, 0)
+                        start = time.perf_counter()
+                        recorder.record("bench", speaker + 1, args.codec, frame, arrival)
+                        elapsed += time.perf_counter() - start
+                recorder.close()
+                busy = registry.snapshot()["voicechat_recorder_batch_seconds"]["sum"]
+                written = recorder.bytes_written.value()
+                shutil.rmtree(directory, ignore_errors=True)
+                frames = len(payloads) * args.speakers
+                print(f"{mode:<10}{file_format:<6}{'是' if use_mmap else '否':<8}{elapsed / frames * 1e6:>14.2f}"
+                      f"{busy:>10.2f}{written / busy / 1e6:>10.1f}{args.seconds / busy:>9.0f}x")
+
+
+def parse_capacity(spec):
+    """"2000:15,300:20" -> [(kbit/s, 秒), ...]"""
+    schedule = []
+    for part in spec.split(","):
+        kbps, seconds = part.split(":")
+        schedule.append((float(kbps), float(seconds)))
+    return schedule
+
+
+def simulate_uplink(ladder, schedule, adaptive, buffer_bytes, loss, delay, seed):
+    """在一条容量随时间变化的瓶颈链路上逐帧模拟一个一直在说话的发送者
+
+    链路是一个先进先出队列, 队列里的字节超过 buffer_bytes 时新帧丢弃, 另外每帧按
+    loss 的概率随机丢失; delay 为单向传播延迟, 报告也经过同样的延迟才回到发送者。
+    服务器端的统计 (StreamMonitor) 和发送端的控制器 (RateController) 都是实际使用的
+    代码, 时间全部是模拟时间, 随机数用固定的种子。返回每帧的 (时刻, 级别, 排队延迟),
+    丢失的帧排队延迟为 None; 以及控制器 (不调整时为 None)。
+    """
+    rng = random.Random(seed)
+    sizes = [stream_bitrate(codec, fmt) * FRAME_INTERVAL / 8 for codec, fmt in ladder]
+    controller = RateController(ladder) if adaptive else None
+    monitor = StreamMonitor()
+    boundaries = list(np.cumsum([seconds for _, seconds in schedule]))
+    total = boundaries[-1]
+    in_flight = deque()
+    reports = deque()
+    records = []
+    link_free = 0.0
+    next_report = REPORT_INTERVAL
+    t = 0.0
+    seq = 0
+    while t < total:
+        segment = next(i for i, end in enumerate(boundaries) if t < end)
+        capacity = schedule[segment][0] * 1000
+        level = controller.level if controller else 0
+        size = sizes[level]
+        start = max(t, link_free)
+        if (start - t) * capacity / 8 + size > buffer_bytes or rng.random() < loss:
+            records.append((t, level, None))
+        else:
+            link_free = start + size * 8 / capacity
+            in_flight.append((link_free + delay, seq, t, size))
+            records.append((t, level, link_free - t))
+        seq += 1
+        t += FRAME_INTERVAL
+        while in_flight and in_flight[0][0] <= t:
+            arrival, frame_seq, timestamp, frame_size = in_flight.popleft()
+            monitor.on_frame(frame_seq, timestamp, arrival, frame_size)
+        if t >= next_report:
+            next_report += REPORT_INTERVAL
+            stats = monitor.take(t)
+            reports.append((t + delay, Report(*stats) if stats else Report()))
+        while reports and reports[0][0] <= t:
+            _, report = reports.popleft()
+            if controller:
+                controller.update(report, t)
+    return records, controller
+
+
+def bench_congestion(args):
+    """发送端自适应码率的离线模拟: 固定码率和自适应码率在同一条瓶颈链路上的延迟、丢包和码率"""
+    schedule = parse_capacity(args.capacity)
+    fmt = check_format(*map(int, args.format.split("/")))
+    # 假设客户端按码率从高到低列出编码, 阶梯里每种码率都有一级
+    ladder = send_ladder(args.codec, sorted(CODEC_NAMES, key=CODEC_BITS.get, reverse=True), fmt)
+    bitrates = [stream_bitrate(codec, f) / 1000 for codec, f in ladder]
+    print("发送阶梯: " + ", ".join(f"{codec} {f.rate // 1000}k/{f.channels} {kbps:.0f}kbit/s"
+                                   for (codec, f), kbps in zip(ladder, bitrates)))
+    results = {}
+    for adaptive in (False, True):
+        results[adaptive] = simulate_uplink(ladder, schedule, adaptive, args.buffer * 1024, args.loss,
+                                            args.delay / 1000, args.seed)
+    print(f"{'时段':>10}{'容量kbit/s':>12}{'方式':>8}{'码率kbit/s':>12}{'平均排队ms':>12}{'P95排队ms':>12}"
+          f"{'丢失%':>8}")
+    start = 0.0
+    for kbps, seconds in schedule:
+        end = start + seconds
+        for adaptive in (False, True):
+            records = [r for r in results[adaptive][0] if start <= r[0] < end]
+            delivered = [r for r in records if r[2] is not None]
+            queued = [r[2] * 1000 for r in delivered]
+            rate = sum(bitrates[level] for _, level, _ in delivered) / max(1, len(records))
+            lost = (len(records) - len(delivered)) / max(1, len(records)) * 100
+            print(f"{start:>4.0f}-{end:<5.0f}{kbps:>12.0f}{'自适应' if adaptive else '固定':>8}{rate:>12.0f}"
+                  f"{np.mean(queued) if queued else 0:>12.1f}{percentile(queued, 95):>12.1f}{lost:>8.1f}")
+        start = end
+    stats = results[True][1].stats
+    print(f"自适应: 降级 {stats['down']} 次, 升级 {stats['up']} 次, 试探失败 {stats['failed_probes']} 次")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="语音聊天服务器基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("engine", help="对比服务器引擎")
+    p.add_argument("--engines", default="threaded,asyncio")
+    p.add_argument("--clients", default="10,50,100,200", help="逗号分隔的客户端数量")
+    p.add_argument("--talkers", type=int, default=2, help="同时说话的客户端数")
+    p.add_argument("--duration", type=float, default=5.0, help="每轮测试秒数")
+    p.add_argument("--max-latency", type=float, default=100.0, help="判定可承载的p95延迟上限(ms)")
+    p.set_defaults(func=bench_engine)
+
+    p = sub.add_parser("codec", help="编解码吞吐量")
+    p.add_argument("--codecs", default=",".join(CODEC_NAMES))
+    p.add_argument("--frames", type=int, default=500, help="测试帧数")
+    p.set_defaults(func=bench_codec)
+
+    p = sub.add_parser("vad", help="语音活动检测的速度和准确率")
+    p.add_argument("--frames", type=int, default=3000, help="每种信号的帧数")
+    p.add_argument("--snr", default="30,20,10,5", help="逗号分隔的信噪比(dB)")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_vad)
+
+    p = sub.add_parser("send", help="单个接收方的转发速率和延迟")
+    p.add_argument("--engines", default="threaded,asyncio")
+    p.add_argument("--duration", type=float, default=3.0, help="每轮测试秒数")
+    p.add_argument("--payload", type=int, default=FRAME_BYTES, help="每帧负载字节数")
+    p.set_defaults(func=bench_send)
+
+    p = sub.add_parser("rooms", help="多个小房间与一个大房间对比")
+    p.add_argument("--engines", default="threaded,asyncio")
+    p.add_argument("--clients", type=int, default=120, help="客户端总数")
+    p.add_argument("--talkers", type=int, default=12, help="同时说话的客户端数")
+    p.add_argument("--room-sizes", default="120,30,8,4", help="逗号分隔的每个房间人数")
+    p.add_argument("--duration", type=float, default=5.0, help="每轮测试秒数")
+    p.set_defaults(func=bench_rooms)
+
+    p = sub.add_parser("workers", help="多进程服务器的扩展性")
+    p.add_argument("--engine", choices=["threaded", "asyncio"], default="asyncio")
+    p.add_argument("--workers", default="1,2,4", help="逗号分隔的工作进程数")
+    p.add_argument("--clients", type=int, default=240, help="客户端总数")
+    p.add_argument("--room-size", type=int, default=6, help="每个房间人数")
+    p.add_argument("--talkers", type=int, default=0, help="说话人数, 默认每个房间一个")
+    p.add_argument("--loaders", type=int, default=os.cpu_count() or 1, help="负载进程数")
+    p.add_argument("--duration", type=float, default=5.0, help="每轮测试秒数")
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("relay", help="两个中继节点之间的流量")
+    p.add_argument("--engine", choices=["threaded", "asyncio"], default="asyncio")
+    p.add_argument("--listeners", default="5,20,50", help="逗号分隔的节点B上的收听者人数")
+    p.add_argument("--talkers", type=int, default=1, help="节点A上的说话人数")
+    p.add_argument("--duration", type=float, default=3.0, help="每轮测试秒数")
+    p.set_defaults(func=bench_relay)
+
+    p = sub.add_parser("dtx", help="不连续发送在静音期间的流量")
+    p.add_argument("--engine", choices=["threaded", "asyncio"], default="asyncio")
+    p.add_argument("--codecs", default="pcm,adpcm")
+    p.add_argument("--frames", type=int, default=1500, help="发送的帧数")
+    p.add_argument("--listeners", type=int, default=4, help="同一房间的收听者人数")
+    p.add_argument("--snr", type=float, default=20.0, help="说话段的信噪比(dB)")
+    p.add_argument("--speed", type=float, default=4.0, help="发送速率为实时的倍数")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_dtx)
+
+    p = sub.add_parser("speakers", help="只转发最活跃的 K 路说话人")
+    p.add_argument("--engine", choices=["threaded", "asyncio"], default="asyncio")
+    p.add_argument("--clients", type=int, default=16, help="同一房间的客户端数, 都在发送")
+    p.add_argument("--loud", type=int, default=2, help="同时说话 (音量高) 的人数")
+    p.add_argument("--limits", default="0,2,3", help="逗号分隔的 K, 0 表示全部转发")
+    p.add_argument("--turn", type=float, default=2.0, help="说话人轮换的间隔(秒)")
+    p.add_argument("--duration", type=float, default=6.0, help="每轮测试秒数")
+    p.set_defaults(func=bench_speakers)
+
+    p = sub.add_parser("pipeline", help="不用声卡运行完整的客户端链路")
+    p.add_argument("--engine", choices=["threaded", "asyncio"], default="asyncio")
+    p.add_argument("--codecs", default="pcm,adpcm")
+    p.add_argument("--transports", default="tcp,udp")
+    p.add_argument("--seconds", type=float, default=20.0, help="每轮发送的音频秒数")
+    p.add_argument("--speed", type=float, default=4.0, help="运行速率为实时的倍数")
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser("resample", help="服务器格式转换的速度和质量")
+    p.add_argument("--formats", default="48000/2,24000/1,12000/1",
+                   help="逗号分隔的 采样率/声道数, 两两转换")
+    p.add_argument("--frames", type=int, default=500, help="测试帧数")
+    p.set_defaults(func=bench_resample)
+
+    p = sub.add_parser("record", help="服务器端录音的数据路径耗时和写入吞吐量")
+    p.add_argument("--modes", default="room,speaker")
+    p.add_argument("--formats", default="wav,raw")
+    p.add_argument("--codec", default="adpcm", choices=CODEC_NAMES)
+    p.add_argument("--speakers", type=int, default=8, help="同时说话的人数")
+    p.add_argument("--seconds", type=float, default=30.0, help="每人的音频秒数")
+    p.add_argument("--preallocate", type=float, default=60.0, help="录音文件每次预分配的秒数")
+    p.set_defaults(func=bench_record)
+
+    p = sub.add_parser("congestion", help="自适应码率在模拟瓶颈链路上的离线模拟")
+    p.add_argument("--capacity", default="2000:15,300:20,100:15,1000:30", metavar="KBPS:SECONDS,...",
+                   help="链路容量随时间的变化")
+    p.add_argument("--codec", default="pcm", choices=CODEC_NAMES, help="协商的编码, 即阶梯的第 0 级")
+    p.add_argument("--format", default="48000/2", help="采集格式 采样率/声道数")
+    p.add_argument("--buffer", type=int, default=256, help="链路上最多排队的 KB (TCP 的发送缓冲区加路由器队列)")
+    p.add_argument("--loss", type=float, default=0.0, help="随机丢包率")
+    p.add_argument("--delay", type=float, default=20.0, help="单向传播延迟, 毫秒")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_congestion)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -2,15 +2,32 @@
 
 import socket
 import threading
-import pyaudio
 import time
-import queue
+from collections import deque
 import sys
-import numpy as np
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QLineEdit, QHBoxLayout, QTextEdit
+import argparse
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QLineEdit, QHBoxLayout, QTextEdit, QCheckBox
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer
 from PyQt5.QtGui import QFont
 
+from protocol import (FrameDecoder, encode_frame, encode_control, decode_control,
+                      decode_datagram, PT_AUDIO, PT_HELLO, PT_WELCOME,
+                      PT_UDP_REGISTER, PT_JOIN, PT_CN, PT_PING, PT_PONG, PT_CODEC, PT_REPORT, decode_cn, seq_diff,
+                      level_field, encode_ping, decode_pong, HEADER_SIZE)
+from codec import CODEC_NAMES, create_codec
+from audioformat import (AudioFormat, SUPPORTED_RATES, StreamConverter, check_format, format_message, frame_samples,
+                         parse_format)
+from congestion import REPORT_INTERVAL, RateController, Report, StreamMonitor, send_ladder, stream_bitrate, stream_message
+from jitter_buffer import JitterBuffer
+from mixer import mix_pcm
+from plc import LossConcealer
+from ringbuffer import RingBuffer
+from vad import VoiceActivityDetector, level_db
+from dtx import DtxEncoder, DTX_TIMEOUT
+from audio_device import PyAudioDevice, DEVICE_NAMES, device_factory
+from metrics import Registry, DEPTH_BUCKETS
+from latency import ClockSync, DelayBreakdown, PING_INTERVAL, PING_STARTUP_INTERVAL
+
 class AudioClient(QThread):
     status_signal = pyqtSignal(str)
     stats_signal = pyqtSignal(str)
@@ -20,61 +37,222 @@ class AudioClient(QThread):
         self.running = False
         self.sending_audio = False  # 控制是否发送音频
         self.s = None
-        self.p = None
-        self.playing_stream = None
-        self.recording_stream = None
-        
-        # 音频参数
-        self.chunk_size = 1024
-        self.audio_format = pyaudio.paInt16
+        self.udp = None  # UDP音频socket, 使用TCP传输时为None
+        self.decoder = None
+        self.client_id = None
+        # 所在房间, 握手时告诉服务器, 连接后可以切换
+        self.room = "default"
+        # 音频设备, 按设备时钟回调 on_capture/on_playout; 没有声卡时可换成 audio_device 里的虚拟设备
+        self.device_factory = PyAudioDevice
+        self.device = None
+        # 播放和到达时间使用的时钟, 创建设备后换成设备的时钟 (比实时快的虚拟设备有自己的时钟)
+        self.clock = time.time
+        
+        # 音频参数: 采样率 (12000/24000/48000) 和声道数 (1/2) 在连接前可以修改, 握手时告诉服务器,
+        # 与其他格式的客户端之间由服务器转换; 每帧的时长固定, 采样数随采样率变化
         self.channels = 2
         self.rate = 48000
-        
-        # 创建音频队列
-        self.audio_queue = queue.Queue(maxsize=20)
-        
-        # 创建抖动缓冲区
-        self.jitter_buffer_size = 3
-        self.jitter_buffer = []
-        
-        # 统计信息
-        self.stats = {
-            "packets_received": 0,
-            "packets_dropped": 0,
-            "start_time": time.time()
+        self.chunk_size = frame_samples(self.rate)
+        self.silence = bytes(self.chunk_size * self.channels * 2)
+        
+        # 音频编码: 握手时按优先级提供给服务器, 服务器选定后写入WELCOME
+        self.codec_preference = list(CODEC_NAMES)
+        self.codec = create_codec("pcm", self.channels)
+        # 接收的编码一开始与发送的相同, 网络拥塞时服务器可能换成码率更低的 (CODEC 控制帧)
+        self.receive_codec = self.codec
+        self.receive_frame_bytes = 0
+        self.receive_codecs = {}
+        
+        # 自适应码率 (congestion.py): 按服务器的报告调整发送的编码和格式, 以及希望收几路;
+        # fixed_rate 为 True 时只调整收几路, 一直按协商的编码和采集格式发送
+        self.fixed_rate = False
+        self.rate_control = None
+        # 实际发送用的编码和格式转换 (与采集格式相同时为 None), 只在录音线程里更换
+        self.send_codec = self.codec
+        self.send_converter = None
+        # 报告线程决定换发送流后由录音线程在下一帧前换, (编码名, AudioFormat)
+        self.pending_send_stream = None
+        # 每个发送者的接收统计, 随报告发给服务器
+        self.receive_monitors = {}
+        
+        # 接收线程到播放线程的音频环形缓冲区, 存放解码后的PCM, 满时覆盖最旧的帧
+        self.audio_ring = RingBuffer(20, self.chunk_size * self.channels * 2)
+        # TCP和UDP两个接收线程共用生产者一端, 写入时串行化
+        self.ring_lock = threading.Lock()
+        
+        # 每个发送者一个自适应抖动缓冲区, 键为发送者ID
+        self.jitter_buffers = {}
+        # 允许的迟到帧比例, 抖动缓冲区按此调整目标深度
+        self.late_target = 0.02
+        # 发送者超过这么久没有数据就释放其缓冲区
+        self.idle_timeout = 10
+        # 每个发送者一个丢包补偿器; pitch 按基音周期外推, repeat 重复上一帧
+        self.concealers = {}
+        self.plc_method = "pitch"
+        # 连续丢失多少帧以内用波形外推, 之后转为舒适噪声
+        self.max_conceal_frames = 3
+        
+        # 发送序列号
+        self.send_seq = 0
+        
+        # 语音活动检测: 按住说话时只发送有声的帧; 设为 None 时全部发送
+        self.vad = VoiceActivityDetector(self.channels)
+        # 进入说话状态之前被判为静音的最近几帧, 进入后补发, 避免字头被切掉
+        self.vad_preroll = deque(maxlen=max(0, self.vad.attack - 1))
+        # 不连续发送: 静音期间只发舒适噪声描述帧; 设为 None 时静音期间什么都不发
+        self.dtx = DtxEncoder(self.channels)
+        # 处于静音期的发送者 -> (噪声电平, 频谱倾斜, 描述帧序列号, 失效时间), 只在播放线程中使用
+        self.comfort = {}
+        
+        # 与服务器的时钟同步, 发出的帧时间戳换算成服务器时钟
+        self.clocksync = ClockSync()
+        # 每个发送者的延迟分解, 只在播放线程中更新
+        self.delays = {}
+        # 声卡的输入加输出延迟, 打开设备后读取
+        self.device_latency = 0.0
+        # 使用TCP时录音回调、探测线程和界面线程都会发帧, 整帧写入时串行化
+        self.send_lock = threading.Lock()
+        
+        # 运行指标: 接收、播放和录音线程各自更新计数, 不需要锁; 快照见 metrics_snapshot()
+        m = self.metrics = Registry()
+        self.counters = {
+            "packets_received": m.counter("voicechat_client_packets_received_total", "收到的音频和描述帧数"),
+            "bytes_received": m.counter("voicechat_client_bytes_received_total", "收到的帧字节数 (含帧头)"),
+            "frames_sent": m.counter("voicechat_client_frames_sent_total", "发出的音频和描述帧数"),
+            "bytes_sent": m.counter("voicechat_client_bytes_sent_total", "发出的帧字节数 (含帧头)"),
+            "frames_concealed": m.counter("voicechat_client_frames_concealed_total", "丢包补偿的帧数"),
+            "frames_comfort": m.counter("voicechat_client_frames_comfort_total", "按对方描述合成舒适噪声的帧数"),
+            "frames_suppressed": m.counter("voicechat_client_frames_suppressed_total", "按住说话时判为静音没有发送的帧数"),
         }
+        drops = m.counter("voicechat_client_drops_total", "丢弃的收到的帧数, 按原因", ["reason"])
+        # ring: 环形缓冲区满; decode: 无法解码; jitter: 迟到或重复, 抖动缓冲区不接收
+        self.drops = {reason: drops.labels(reason) for reason in ("ring", "decode", "jitter")}
+        delay = m.histogram("voicechat_client_delay_seconds",
+                            "每帧的各段延迟: network 从对方采集到本机收到, jitter 在抖动缓冲区里等待",
+                            ["component"])
+        self.delay_seconds = {name: delay.labels(name) for name in ("network", "jitter")}
+        self.rtt_seconds = m.histogram("voicechat_client_rtt_seconds", "与服务器之间的往返时间")
+        self.rate_changes = m.counter("voicechat_client_rate_changes_total", "自适应码率改变发送流的次数")
+        m.gauge("voicechat_client_send_bitrate", "当前发送流的码率 (bit/s, 含帧头)",
+                function=lambda: stream_bitrate(*self.rate_control.stream) if self.rate_control else 0)
+        m.gauge("voicechat_client_send_level", "当前发送流在降级阶梯上的级别, 0 表示协商的编码和格式",
+                function=lambda: self.rate_control.level if self.rate_control else 0)
+        m.gauge("voicechat_client_clock_offset_seconds", "服务器时钟减去本机时钟",
+                function=lambda: self.clocksync.offset)
+        m.gauge("voicechat_client_sender_delay_seconds", "每个发送者平滑后的各段延迟和总延迟",
+                ["sender", "component"], function=self.sender_delay_samples)
+        self.jitter_depth = m.histogram("voicechat_client_jitter_depth_frames",
+                                        "每次播放时各发送者抖动缓冲区的深度", buckets=DEPTH_BUCKETS)
+        m.gauge("voicechat_client_jitter_target_frames", "每个发送者抖动缓冲区的目标深度", ["sender"],
+                function=lambda: [((sender,), jb.target_depth) for sender, jb in list(self.jitter_buffers.items())])
+        self.stats_start = time.time()
 
-    def connect_to_server(self, ip, port):
+    def connect_to_server(self, ip, port, use_udp=False, room=None):
         """连接到服务器"""
+        if room:
+            self.room = room
         try:
+            self.configure_format()
+            # 先创建音频设备, run() 时才开始回调
+            self.device = self.device_factory(self.rate, self.channels, self.chunk_size)
+            self.device.open(self.on_capture, self.on_playout)
+            self.device_latency = sum(self.device.latency())
+            self.clock = self.device.clock
+            
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)
             self.s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)
             self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             
             self.s.connect((ip, port))
-            
-            # 初始化音频设备
-            self.p = pyaudio.PyAudio()
-            
-            self.playing_stream = self.p.open(format=self.audio_format, 
-                                            channels=self.channels, 
-                                            rate=self.rate, 
-                                            output=True,
-                                            frames_per_buffer=self.chunk_size)
-            self.recording_stream = self.p.open(format=self.audio_format, 
-                                            channels=self.channels, 
-                                            rate=self.rate, 
-                                            input=True,
-                                            frames_per_buffer=self.chunk_size)
+            self.handshake(ip, use_udp)
             
             self.running = True
-            self.status_signal.emit("已连接到服务器")
+            self.status_signal.emit(f"已连接到服务器 (编码: {self.codec.name}, 房间: {self.room})")
             return True
         except Exception as e:
             self.status_signal.emit(f"连接失败: {e}")
             return False
 
+    def configure_format(self):
+        """按 self.rate 和 self.channels 重建与音频格式有关的缓冲区和处理器, 格式不支持时抛出 ValueError"""
+        check_format(self.rate, self.channels)
+        self.chunk_size = frame_samples(self.rate)
+        self.silence = bytes(self.chunk_size * self.channels * 2)
+        if self.audio_ring.slot_bytes != len(self.silence):
+            self.audio_ring = RingBuffer(20, len(self.silence))
+        if self.vad is not None and self.vad.channels != self.channels:
+            self.vad = VoiceActivityDetector(self.channels)
+            self.vad_preroll = deque(maxlen=max(0, self.vad.attack - 1))
+        if self.dtx is not None and self.dtx.channels != self.channels:
+            self.dtx = DtxEncoder(self.channels)
+
+    def handshake(self, ip, use_udp):
+        """发送HELLO并等待服务器的WELCOME, 需要时建立UDP音频通道"""
+        self.decoder = FrameDecoder()
+        self.codec = create_codec("pcm", self.channels)
+        self.set_receive_codec("pcm")
+        self.clocksync = ClockSync()
+        hello = {
+            "transport": "udp" if use_udp else "tcp",
+            "codecs": self.codec_preference,
+            "room": self.room,
+            # 采集和播放使用同一个格式
+            "format": format_message(AudioFormat(self.rate, self.channels)),
+            "playout": format_message(AudioFormat(self.rate, self.channels)),
+            # 客户端自己做了语音活动检测, 服务器不用再检测
+            "vad": self.vad is not None,
+            # 能处理 CODEC 控制帧, 拥塞时服务器可以换接收编码
+            "codec_switch": True,
+            # 与服务器交换 REPORT 报告, 可能沿 congestion.send_ladder 的阶梯换发送流
+            "reports": True
+        }
+        self.s.sendall(encode_control(PT_HELLO, hello))
+        
+        welcome = None
+        self.s.settimeout(3)
+        try:
+            while welcome is None:
+                data = self.s.recv(65536)
+                if not data:
+                    raise ConnectionError("服务器关闭了连接")
+                for frame in self.decoder.feed(data):
+                    if frame.payload_type == PT_WELCOME:
+                        welcome = decode_control(frame.payload)
+                        # 之后收到的音频都是协商后的编码
+                        self.codec = create_codec(welcome.get("codec", "pcm"), self.channels)
+                        self.set_receive_codec(self.codec.name)
+                        self.send_codec = self.codec
+                    elif frame.payload_type == PT_AUDIO:
+                        self.queue_frame(frame)
+        finally:
+            self.s.settimeout(None)
+        
+        # 服务器不支持请求的格式时按 48kHz 双声道处理 (旧版本的服务器不回复格式), 这时无法通话
+        fmt = AudioFormat(self.rate, self.channels)
+        if parse_format(welcome.get("format")) != fmt or parse_format(welcome.get("playout")) != fmt:
+            raise ConnectionError(f"服务器不支持音频格式 {self.rate}Hz {self.channels}声道")
+        self.client_id = welcome.get("client_id")
+        self.room = welcome.get("room", self.room)
+        self.send_codec = self.codec
+        self.send_converter = None
+        self.pending_send_stream = None
+        self.receive_monitors = {}
+        ladder = [(self.codec.name, fmt)]
+        if not self.fixed_rate:
+            ladder = send_ladder(self.codec.name, self.codec_preference, fmt)
+        self.rate_control = RateController(ladder, time.monotonic())
+        if use_udp:
+            if not welcome.get("udp_port"):
+                raise ConnectionError("服务器未开启UDP传输")
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+            self.udp.connect((ip, welcome["udp_port"]))
+            # UDP可能丢包, 注册报文多发几次
+            register = encode_frame(welcome["token"].encode("ascii"), payload_type=PT_UDP_REGISTER)
+            for _ in range(3):
+                self.udp.send(register)
+
     def run(self):
         """启动音频处理线程"""
         if not self.running:
@@ -85,28 +263,76 @@ class AudioClient(QThread):
         receive_thread.daemon = True
         receive_thread.start()
         
-        # 启动播放线程
-        play_thread = threading.Thread(target=self.play_audio)
-        play_thread.daemon = True
-        play_thread.start()
+        if self.udp:
+            udp_thread = threading.Thread(target=self.receive_udp_data)
+            udp_thread.daemon = True
+            udp_thread.start()
+        
+        # 时钟同步探测; 比实时快的虚拟设备的时钟和服务器不同速, 不做同步
+        if self.device.speed == 1:
+            ping_thread = threading.Thread(target=self.ping_loop)
+            ping_thread.daemon = True
+            ping_thread.start()
+        
+        report_thread = threading.Thread(target=self.report_loop)
+        report_thread.daemon = True
+        report_thread.start()
         
-        # 启动发送线程
-        send_thread = threading.Thread(target=self.send_data_to_server)
-        send_thread.daemon = True
-        send_thread.start()
+        # 录音和播放由音频设备的回调驱动
+        self.device.start()
         
         # 启动统计线程
         stats_thread = threading.Thread(target=self.print_stats)
         stats_thread.daemon = True
         stats_thread.start()
 
+    def metrics_snapshot(self):
+        """可以直接转成 JSON 的运行指标快照, 另附每个发送者抖动缓冲区的状态"""
+        snapshot = self.metrics.snapshot()
+        snapshot["jitter_buffers"] = {
+            str(sender): dict(jb.stats, depth=jb.depth(), target_depth=jb.target_depth)
+            for sender, jb in list(self.jitter_buffers.items())}
+        snapshot["delays"] = {str(sender): delays.as_dict() for sender, delays in list(self.delays.items())}
+        snapshot["clock"] = {"rtt": self.clocksync.rtt, "offset": self.clocksync.offset}
+        snapshot["client_id"] = self.client_id
+        snapshot["room"] = self.room
+        snapshot["time"] = time.time()
+        return snapshot
+
+    def sender_delay_samples(self):
+        """每个发送者各段延迟的仪表值"""
+        return [((sender, name), value) for sender, delays in list(self.delays.items())
+                for name, value in delays.as_dict().items() if value is not None]
+
     def print_stats(self):
-        """定期打印统计信息"""
+        """定期打印统计信息, 计数为与上一次的差值"""
+        last = {}
         while self.running:
             time.sleep(5)  # 每5秒更新一次
-            elapsed = time.time() - self.stats["start_time"]
-            received = self.stats["packets_received"]
-            dropped = self.stats["packets_dropped"]
+            now = time.time()
+            elapsed = now - self.stats_start
+            counts = {name: counter.value() for name, counter in self.counters.items()}
+            counts["packets_dropped"] = sum(counter.value() for counter in self.drops.values())
+            delta = {name: value - last.get(name, 0) for name, value in counts.items()}
+            last = counts
+            received = delta["packets_received"]
+            dropped = delta["packets_dropped"]
+            concealed = delta["frames_concealed"]
+            suppressed = delta["frames_suppressed"]
+            comfort = delta["frames_comfort"]
+            buffers = list(self.jitter_buffers.values())
+            lost = sum(jb.stats["missing"] for jb in buffers)
+            late = sum(jb.stats["late"] for jb in buffers)
+            for jb in buffers:
+                jb.stats["missing"] = 0
+                jb.stats["late"] = 0
+            if buffers:
+                # 多个说话人时显示最深的那个缓冲区
+                jb = max(buffers, key=lambda b: b.target_depth)
+                depth, target = jb.depth(), jb.target_depth
+            else:
+                depth, target = 0, 0
+            frame_ms = self.chunk_size / self.rate * 1000
             
             if received > 0:
                 drop_rate = (dropped / (received + dropped)) * 100
@@ -115,37 +341,48 @@ class AudioClient(QThread):
                 drop_rate = 0
                 packets_per_second = 0
                 
-            stats_text = f"接收: {received}, 丢弃: {dropped}, 丢包率: {drop_rate:.1f}%, 速率: {packets_per_second:.1f}/s"
+            stats_text = (f"接收: {received}, 丢弃: {dropped}, 丢包率: {drop_rate:.1f}%, 丢失: {lost}, 迟到: {late}, 补偿: {concealed}, 舒适噪声: {comfort}, 静音未发: {suppressed}, "
+                          f"速率: {packets_per_second:.1f}/s, 缓冲: {depth}/{target}帧 ({target * frame_ms:.0f}ms)")
+            if self.clocksync.synced():
+                stats_text += (f"\n往返时间: {self.clocksync.rtt * 1000:.1f}ms, "
+                               f"时钟偏差: {self.clocksync.offset * 1000:+.1f}ms")
+            for sender, delays in sorted(list(self.delays.items())):
+                if delays.network is None or delays.jitter is None:
+                    continue
+                stats_text += (f"\n发送者{sender}延迟: 网络 {delays.network * 1000:.0f} + "
+                               f"缓冲 {delays.jitter * 1000:.0f} + 设备 {delays.device * 1000:.0f} = "
+                               f"{delays.total() * 1000:.0f}ms")
             self.stats_signal.emit(stats_text)
-            
-            # 重置统计
-            self.stats["packets_received"] = 0
-            self.stats["packets_dropped"] = 0
-            self.stats["start_time"] = time.time()
+            self.stats_start = now
 
     def receive_server_data(self):
-        """从服务器接收音频数据并放入队列"""
-        buffer = bytearray()
+        """从服务器接收音频帧并放入队列"""
+        decoder = self.decoder
         
         while self.running:
             try:
-                data = self.s.recv(4096)
+                data = self.s.recv(65536)
                 if not data:
-                    continue
-                
-                buffer.extend(data)
-                
-                if self.audio_queue.full():
-                    try:
-                        self.audio_queue.get_nowait()
-                        self.stats["packets_dropped"] += 1
-                    except queue.Empty:
-                        pass
-                
-                self.audio_queue.put(data)
-                self.stats["packets_received"] += 1
+                    if self.running:
+                        self.status_signal.emit("连接中断")
+                    break
                 
-                buffer = bytearray()
+                for frame in decoder.feed(data):
+                    if frame.payload_type in (PT_AUDIO, PT_CN):
+                        self.queue_frame(frame)
+                    elif frame.payload_type == PT_PONG:
+                        self.handle_pong(frame)
+                    elif frame.payload_type == PT_JOIN:
+                        reply = decode_control(frame.payload)
+                        self.room = reply.get("room", self.room)
+                        self.status_signal.emit(f"已进入房间 {self.room} (成员: {reply.get('members', 0)})")
+                    elif frame.payload_type == PT_REPORT:
+                        self.handle_report(decode_control(frame.payload))
+                    elif frame.payload_type == PT_CODEC:
+                        name = decode_control(frame.payload).get("codec")
+                        if name in CODEC_NAMES and name != self.receive_codec.name:
+                            self.set_receive_codec(name)
+                            self.status_signal.emit(f"服务器改用 {name} 编码发送 (编码: {self.codec.name})")
                 
             except socket.error as e:
                 if self.running:
@@ -156,86 +393,296 @@ class AudioClient(QThread):
                     self.status_signal.emit(f"处理接收数据时出错: {e}")
                 break
 
-    def play_audio(self):
-        """从队列中获取音频数据并播放"""
-        # 初始化抖动缓冲区
-        while self.running and len(self.jitter_buffer) < self.jitter_buffer_size:
-            try:
-                data = self.audio_queue.get(timeout=0.5)
-                self.jitter_buffer.append(data)
-            except queue.Empty:
-                if len(self.jitter_buffer) == 0:
-                    silence = b'\x00' * self.chunk_size * 2
-                    self.jitter_buffer.append(silence)
-                time.sleep(0.01)
-        
+    def receive_udp_data(self):
+        """从UDP接收音频帧, 乱序、迟到和丢失由抖动缓冲区处理"""
         while self.running:
             try:
-                if self.jitter_buffer:
-                    data_to_play = self.jitter_buffer.pop(0)
-                    try:
-                        self.playing_stream.write(data_to_play)
-                    except Exception as e:
-                        pass
-                
-                try:
-                    new_data = self.audio_queue.get(timeout=0.01)
-                    self.jitter_buffer.append(new_data)
-                except queue.Empty:
-                    if len(self.jitter_buffer) < 1:
-                        silence = b'\x00' * self.chunk_size * 2
-                        self.jitter_buffer.append(silence)
-                
-                while len(self.jitter_buffer) > self.jitter_buffer_size + 2:
-                    self.jitter_buffer.pop(0)
-                    self.stats["packets_dropped"] += 1
-                    
-            except Exception as e:
+                data = self.udp.recv(65536)
+                frame = decode_datagram(data)
+            except socket.error as e:
                 if self.running:
-                    pass
-                time.sleep(0.01)
+                    self.status_signal.emit(f"UDP接收错误: {e}")
+                break
+            except Exception:
+                continue
+            
+            if frame.payload_type == PT_PONG:
+                self.handle_pong(frame)
+            elif frame.payload_type in (PT_AUDIO, PT_CN):
+                self.queue_frame(frame)
+
+    def ping_loop(self):
+        """定期发送时钟同步探测, 刚连接时间隔短一些, 尽快得到估计"""
+        seq = 0
+        while self.running:
+            report = self.clocksync.report()
+            payload = encode_ping(*report) if report is not None else b""
+            try:
+                self.send_packet(encode_frame(payload, seq=seq, timestamp=self.clock(),
+                                              payload_type=PT_PING))
+            except OSError:
+                break
+            seq += 1
+            time.sleep(PING_STARTUP_INTERVAL if seq < self.clocksync.window else PING_INTERVAL)
+
+    def report_loop(self):
+        """定期向服务器报告收到的各发送者的丢包率和抖动, 以及希望最多收几路"""
+        while self.running:
+            time.sleep(REPORT_INTERVAL)
+            receive = {}
+            for sender, monitor in list(self.receive_monitors.items()):
+                stats = monitor.take(time.monotonic())
+                if stats is not None:
+                    receive[str(sender)] = [round(stats[0], 4), round(stats[1] * 1000, 1)]
+                elif sender not in self.jitter_buffers:
+                    # 已经离开的发送者
+                    self.receive_monitors.pop(sender, None)
+            report = {"receive": receive, "streams": self.rate_control.max_streams}
+            try:
+                with self.send_lock:
+                    self.s.sendall(encode_control(PT_REPORT, report))
+            except OSError:
+                break
+
+    def handle_report(self, message):
+        """服务器的报告: 按上行和下行的情况调整发送流和接收路数"""
+        peers = message.get("peers") or (None, None)
+        # 用最近一次测量的往返时间, 平滑值跟不上排队的变化
+        samples = self.clocksync.samples
+        report = Report(message.get("loss"), message.get("jitter"), message.get("delay"), message.get("rate"),
+                        message.get("queue", 0), bool(message.get("congested")), peers[0], peers[1],
+                        samples[-1][0] if samples else None)
+        send_changed, streams_changed = self.rate_control.update(report, time.monotonic())
+        if send_changed:
+            codec, fmt = self.pending_send_stream = self.rate_control.stream
+            self.rate_changes.inc()
+            self.status_signal.emit(f"发送改为 {codec} {fmt.rate}Hz {fmt.channels}声道 "
+                                    f"(约 {stream_bitrate(codec, fmt) / 1000:.0f}kbit/s)")
+        if streams_changed:
+            streams = self.rate_control.max_streams
+            self.status_signal.emit(f"请求服务器最多发 {streams} 路" if streams else "不再限制接收路数")
 
-    def send_data_to_server(self):
-        """录制并发送音频数据到服务器"""
+    def handle_pong(self, frame):
+        """收到服务器对探测的回复, 更新往返时间和时钟偏差"""
+        arrival = self.clock()
         try:
-            silence_threshold = 300
-            silence_counter = 0
-            max_silence_count = 10
-            
-            while self.running:
+            received, sent = decode_pong(frame.payload)
+        except Exception:
+            return
+        self.rtt_seconds.observe(self.clocksync.sample(frame.timestamp, received, sent, arrival))
+
+    def set_receive_codec(self, name):
+        """换接收音频的编码, 并按当前格式算出各编码一帧的长度"""
+        self.receive_codec = create_codec(name, self.channels)
+        self.receive_frame_bytes = len(self.receive_codec.encode(self.silence))
+        # 服务器降级时每种码率用我们最优先的那个编码, 帧长能确定是哪种编码
+        codecs = {}
+        for preferred in self.codec_preference:
+            codec = create_codec(preferred, self.channels)
+            codecs.setdefault(len(codec.encode(self.silence)), codec)
+        self.receive_codecs = codecs
+
+    def queue_frame(self, frame):
+        """把收到的音频帧直接解码进环形缓冲区, 缓冲区满时覆盖最旧的"""
+        with self.ring_lock:
+            ring = self.audio_ring
+            slot = ring.reserve()
+            if slot is None:
+                self.drops["ring"].inc()
+                return
+            try:
+                if frame.payload_type == PT_CN:
+                    # 描述帧原样放进槽位, 由播放线程解析
+                    nbytes = len(frame.payload)
+                    slot[:nbytes] = frame.payload
+                else:
+                    codec = self.receive_codec
+                    if len(frame.payload) != self.receive_frame_bytes:
+                        # CODEC 控制帧和 UDP 上的音频没有先后保证, 切换前后的帧按帧长选编码,
+                        # 认不出的按当前编码解码
+                        codec = self.receive_codecs.get(len(frame.payload), codec)
+                    nbytes = codec.decode_into(frame.payload, slot)
+            except Exception:
+                # 解码失败或长度超过槽位, 槽位不提交
+                ring.abort()
+                self.drops["decode"].inc()
+                return
+            arrival = self.clock()
+            tag = (frame.sender_id, frame.seq, frame.timestamp, arrival, frame.payload_type)
+            monitor = self.receive_monitors.get(frame.sender_id)
+            if monitor is None:
+                monitor = self.receive_monitors[frame.sender_id] = StreamMonitor()
+            monitor.on_frame(frame.seq, frame.timestamp, arrival, HEADER_SIZE + len(frame.payload))
+            overwritten = ring.commit(nbytes, tag)
+        if overwritten:
+            self.drops["ring"].inc(overwritten)
+        self.counters["packets_received"].inc()
+        self.counters["bytes_received"].inc(HEADER_SIZE + len(frame.payload))
+
+    def on_playout(self, frame_count):
+        """音频设备的播放回调: 返回 frame_count 个采样的PCM"""
+        try:
+            data = self.next_playout_frame() if self.running else self.silence
+        except Exception:
+            data = self.silence
+        size = frame_count * self.channels * 2
+        if len(data) != size:
+            data = data[:size].ljust(size, b'\x00')
+        return data
+
+    def next_playout_frame(self):
+        """从各发送者的抖动缓冲区取一帧混在一起, 缺帧时补偿"""
+        self.drain_audio_ring()
+        
+        now = self.clock()
+        chunks = []
+        for sender_id, jb in list(self.jitter_buffers.items()):
+            plc = self.concealers[sender_id]
+            self.jitter_depth.observe(jb.depth())
+            payload = jb.get(now)
+            if payload is not None:
+                chunks.append(plc.good(payload))
+                self.delays[sender_id].update("jitter", jb.wait)
+                self.delay_seconds["jitter"].observe(jb.wait)
+                continue
+            comfort = self.comfort.get(sender_id)
+            if comfort is not None:
+                if now < comfort[3]:
+                    # 对方在静音期, 按描述合成背景噪声, 不算丢包
+                    chunks.append(plc.comfort(comfort[0], comfort[1]))
+                    self.counters["frames_comfort"].inc()
+                    continue
+                del self.comfort[sender_id]
+            # 这个周期没有帧 (丢包、迟到或缓冲区在加深), 补一帧代替静音
+            payload = plc.conceal()
+            if payload is not None:
+                chunks.append(payload)
+                self.counters["frames_concealed"].inc()
+            elif not jb.depth() and now - jb.last_arrival > self.idle_timeout:
+                del self.jitter_buffers[sender_id]
+                del self.concealers[sender_id]
+                del self.delays[sender_id]
+                self.comfort.pop(sender_id, None)
+        
+        # 多个说话人同时说话时混在一起播放, 没有数据时播放静音保持设备时钟
+        return mix_pcm(chunks) if chunks else self.silence
+
+    def drain_audio_ring(self):
+        """把接收线程送来的帧全部复制进对应发送者的抖动缓冲区"""
+        frame_duration = self.chunk_size / self.rate
+        ring = self.audio_ring
+        while True:
+            entry = ring.peek()
+            if entry is None:
+                return
+            payload, (sender_id, seq, timestamp, arrival, payload_type) = entry
+            jb = self.jitter_buffers.get(sender_id)
+            if jb is None:
+                jb = JitterBuffer(frame_duration, self.chunk_size * self.channels * 2,
+                                  late_target=self.late_target)
+                self.jitter_buffers[sender_id] = jb
+                self.concealers[sender_id] = LossConcealer(
+                    self.chunk_size, self.channels, self.rate,
+                    method=self.plc_method, max_conceal=self.max_conceal_frames)
+                self.delays[sender_id] = DelayBreakdown(self.device_latency)
+            comfort = self.comfort.get(sender_id)
+            if payload_type == PT_CN:
                 try:
-                    # 只有在sending_audio为True时才发送音频
-                    if self.sending_audio:
-                        data = self.recording_stream.read(self.chunk_size, exception_on_overflow=False)
-                        
-                        try:
-                            audio_array = np.frombuffer(data, dtype=np.int16)
-                            volume_level = np.abs(audio_array).mean()
-                            
-                            if volume_level < silence_threshold:
-                                silence_counter += 1
-                                if silence_counter > max_silence_count:
-                                    if silence_counter % 3 == 0:
-                                        self.s.sendall(data)
-                                    time.sleep(0.01)
-                                    continue
-                            else:
-                                silence_counter = 0
-                        except Exception as e:
-                            pass
-                        
-                        self.s.sendall(data)
-                        time.sleep(0.001)
-                    else:
-                        # 如果不发送音频，只是休眠
-                        time.sleep(0.01)
-                    
-                except Exception as e:
-                    if self.running:
-                        pass
-                    break
-        finally:
-            pass
+                    level, tilt = decode_cn(payload)
+                    if comfort is None or seq_diff(seq, comfort[2]) > 0:
+                        self.comfort[sender_id] = (level, tilt, seq, arrival + DTX_TIMEOUT * frame_duration)
+                    jb.last_arrival = arrival
+                except Exception:
+                    self.drops["decode"].inc()
+            else:
+                # 描述帧之后的音频说明对方又开始说话了
+                if comfort is not None and seq_diff(seq, comfort[2]) > 0:
+                    del self.comfort[sender_id]
+                # 帧头时间戳是服务器时钟, 到达时间换算过去后相减
+                network = arrival + self.clocksync.offset - timestamp
+                self.delays[sender_id].update("network", network)
+                self.delay_seconds["network"].observe(max(0.0, network))
+                if not jb.put(seq, timestamp, payload, arrival):
+                    self.drops["jitter"].inc()
+            ring.release()
+
+    def on_capture(self, data, capture_time):
+        """音频设备的录音回调: 按下说话时把有声的录音块直接发出去"""
+        if not self.running:
+            return
+        vad = self.vad
+        try:
+            # 没按住说话时也继续检测, 让背景噪声电平保持最新
+            speech = vad.process(data) if vad is not None else True
+            if not self.sending_audio:
+                if vad is not None:
+                    vad.reset()
+                self.vad_preroll.clear()
+                if self.dtx is not None:
+                    self.dtx.reset()
+                return
+            if not speech:
+                self.vad_preroll.append((data, capture_time))
+                self.counters["frames_suppressed"].inc()
+                descriptor = self.dtx.silent_frame(data) if self.dtx is not None else None
+                if descriptor is not None:
+                    self.send_payload(descriptor, capture_time, PT_CN, vad.level_db)
+                return
+            if self.dtx is not None:
+                self.dtx.reset()
+            while self.vad_preroll:
+                self.send_frame(*self.vad_preroll.popleft())
+            self.send_frame(data, capture_time)
+        except (socket.error, BrokenPipeError):
+            if self.running:
+                self.status_signal.emit("连接中断")
+            self.running = False
+        except Exception as e:
+            if self.running:
+                self.status_signal.emit(f"发送时出错: {e}")
+
+    def send_frame(self, data, capture_time):
+        """把一块录音数据打包成帧发送"""
+        # 帧头带上音量, 服务器选择活跃说话人时不用解码
+        level = level_db(data, self.channels)
+        if self.pending_send_stream is not None:
+            self.switch_send_stream()
+        if self.send_converter is not None:
+            data = self.send_converter.convert(data)
+        self.send_payload(self.send_codec.encode(data), capture_time, level=level)
+
+    def switch_send_stream(self):
+        """换发送的编码和格式, 先用 CODEC 控制帧通知服务器, 之后的帧按新的流发送"""
+        codec, fmt = self.pending_send_stream
+        self.pending_send_stream = None
+        capture = AudioFormat(self.rate, self.channels)
+        self.send_codec = create_codec(codec, fmt.channels)
+        self.send_converter = StreamConverter(capture, fmt) if fmt != capture else None
+        with self.send_lock:
+            self.s.sendall(encode_control(PT_CODEC, stream_message(codec, fmt)))
+
+    def send_payload(self, payload, capture_time, payload_type=PT_AUDIO, level=0.0):
+        """发送一个音频或描述帧, 两者共用序列号; 时间戳换算成服务器时钟"""
+        packet = encode_frame(payload, seq=self.send_seq, timestamp=self.clocksync.to_server(capture_time),
+                              payload_type=payload_type, level=level_field(level))
+        self.send_packet(packet)
+        self.send_seq += 1
+        self.counters["frames_sent"].inc()
+        self.counters["bytes_sent"].inc(len(packet))
+
+    def send_packet(self, packet):
+        """从音频通道 (UDP或TCP) 发出一个完整的帧"""
+        if self.udp:
+            self.udp.send(packet)
+        else:
+            with self.send_lock:
+                self.s.sendall(packet)
+
+    def join_room(self, room):
+        """请求切换到另一个房间, 服务器确认后更新 self.room"""
+        if self.s and self.running:
+            with self.send_lock:
+                self.s.sendall(encode_control(PT_JOIN, {"room": room}))
 
     def start_sending(self):
         """开始发送音频"""
@@ -248,33 +695,30 @@ class AudioClient(QThread):
     def cleanup(self):
         """清理资源"""
         self.running = False
-        time.sleep(0.2)
         
-        if hasattr(self, 'playing_stream') and self.playing_stream:
+        if self.device:
             try:
-                self.playing_stream.stop_stream()
-                self.playing_stream.close()
+                self.device.close()
             except:
                 pass
+            self.device = None
         
-        if hasattr(self, 'recording_stream') and self.recording_stream:
+        if hasattr(self, 's') and self.s:
             try:
-                self.recording_stream.stop_stream()
-                self.recording_stream.close()
+                self.s.close()
             except:
                 pass
         
-        if hasattr(self, 'p') and self.p:
+        if self.udp:
             try:
-                self.p.terminate()
-            except:
-                pass
-        
-        if hasattr(self, 's') and self.s:
-            try:
-                self.s.close()
+                self.udp.close()
             except:
                 pass
+            self.udp = None
+        self.jitter_buffers = {}
+        self.concealers = {}
+        self.comfort = {}
+        self.delays = {}
 
 
 class VoiceChatWindow(QWidget):
@@ -309,12 +753,28 @@ class VoiceChatWindow(QWidget):
         port_layout.addWidget(port_label)
         port_layout.addWidget(self.port_input)
         
+        # 房间, 连接后可以切换
+        room_layout = QHBoxLayout()
+        room_label = QLabel('房间:')
+        self.room_input = QLineEdit('default')
+        self.room_btn = QPushButton('切换房间')
+        self.room_btn.setEnabled(False)
+        self.room_btn.clicked.connect(self.switch_room)
+        room_layout.addWidget(room_label)
+        room_layout.addWidget(self.room_input)
+        room_layout.addWidget(self.room_btn)
+        
+        # UDP音频传输选项, 弱网下避免TCP队头阻塞
+        self.udp_checkbox = QCheckBox('使用UDP传输音频')
+        
         # 连接按钮
         self.connect_btn = QPushButton('连接服务器')
         self.connect_btn.clicked.connect(self.connect_to_server)
         
         connect_layout.addLayout(ip_layout)
         connect_layout.addLayout(port_layout)
+        connect_layout.addLayout(room_layout)
+        connect_layout.addWidget(self.udp_checkbox)
         connect_layout.addWidget(self.connect_btn)
         
         # 状态显示
@@ -379,6 +839,7 @@ class VoiceChatWindow(QWidget):
             self.connected = False
             self.connect_btn.setText('连接服务器')
             self.talk_btn.setEnabled(False)
+            self.room_btn.setEnabled(False)
             self.status_label.setText('已断开连接')
             self.status_label.setStyleSheet("color: red; font-weight: bold;")
             self.log_text.append("已断开连接")
@@ -401,20 +862,35 @@ class VoiceChatWindow(QWidget):
         self.connect_btn.setText('连接中...')
         self.log_text.append(f"正在连接到 {ip}:{port}...")
         
+        use_udp = self.udp_checkbox.isChecked()
+        room = self.room_input.text().strip()
+        
         # 在后台线程中连接
         def connect():
-            success = self.audio_client.connect_to_server(ip, port)
+            success = self.audio_client.connect_to_server(ip, port, use_udp, room)
             if success:
                 self.connected = True
                 self.audio_client.start()
                 self.connect_btn.setText('断开连接')
                 self.talk_btn.setEnabled(True)
+                self.room_btn.setEnabled(True)
             else:
                 self.connect_btn.setText('连接服务器')
             self.connect_btn.setEnabled(True)
             
         threading.Thread(target=connect, daemon=True).start()
         
+    def switch_room(self):
+        """切换到输入框中的房间"""
+        room = self.room_input.text().strip()
+        if not self.connected or not room or room == self.audio_client.room:
+            return
+        try:
+            self.audio_client.join_room(room)
+            self.log_text.append(f"正在切换到房间 {room}...")
+        except OSError as e:
+            self.update_status(f"切换房间失败: {e}")
+        
     def start_talking(self):
         """开始说话"""
         if self.connected:
@@ -474,7 +950,22 @@ class VoiceChatWindow(QWidget):
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="语音聊天客户端")
+    parser.add_argument("--audio-device", default="pyaudio",
+                        help=f"音频设备: {', '.join(DEVICE_NAMES)}, 例如 tone:440 或 wav:in.wav,out.wav")
+    parser.add_argument("--rate", type=int, default=48000, choices=SUPPORTED_RATES,
+                        help="采样率, 低采样率节省带宽, 默认 48000")
+    parser.add_argument("--channels", type=int, default=2, choices=(1, 2), help="声道数, 默认 2")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="不做自适应码率, 一直按协商的编码和采集格式发送")
+    # 其余参数留给 Qt
+    args, qt_args = parser.parse_known_args()
+    try:
+        factory = device_factory(args.audio_device)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    app = QApplication(sys.argv[:1] + qt_args)
     
     # 设置应用样式
     app.setStyleSheet("""
@@ -498,6 +989,10 @@ if __name__ == "__main__":
     """)
     
     window = VoiceChatWindow()
+    window.audio_client.device_factory = factory
+    window.audio_client.rate = args.rate
+    window.audio_client.channels = args.channels
+    window.audio_client.fixed_rate = args.fixed_rate
     window.show()
     
     try:
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+"""内置音频编解码器
+
+原始 16位 PCM 双声道 48kHz 每个说话人约 1.5 Mbit/s, 几个人同时说话就会占满上行。
+这里提供几种不依赖额外原生库、只用 NumPy 实现的压缩编码:
+
+    pcm    原始 16位 PCM, 不压缩
+    ulaw   G.711 μ律, 每个采样 8 位, 2:1
+    alaw   G.711 A律, 每个采样 8 位, 2:1
+    adpcm  IMA-ADPCM, 每个采样 4 位, 约 4:1; 编码需要逐个采样递推, 单核只有实时速率
+           的十几到二十倍, 服务器端转码和混音的路数受它限制 (见 AdpcmCodec)
+
+所有编码器都是无状态的: 每一帧可以独立解码, 丢帧不会影响后面的帧。
+decode_into() 把解码结果直接写进调用方提供的缓冲区 (例如环形缓冲区的槽位),
+返回写入的字节数。数据长度或内容不合法 (例如被截断的帧) 时 decode() 抛出
+ValueError, 由调用方丢弃这一帧。
+连接建立时客户端在 HELLO 中按优先级列出支持的编码, 服务器选定一种写入 WELCOME。
+"""
+
+import numpy as np
+
+# 按优先级排列的编码名称
+CODEC_NAMES = ["adpcm", "ulaw", "alaw", "pcm"]
+# 每个采样的位数, 服务器对慢速接收方降级时按它找码率更低的编码
+CODEC_BITS = {"adpcm": 4, "ulaw": 8, "alaw": 8, "pcm": 16}
+
+
+class PcmCodec:
+    """不压缩的16位PCM"""
+
+    name = "pcm"
+
+    def __init__(self, channels=2):
+        self.channels = channels
+
+    def encode(self, pcm):
+        return bytes(pcm)
+
+    def decode(self, data):
+        return bytes(data)
+
+    def decode_into(self, data, out):
+        n = len(data)
+        out[:n] = data
+        return n
+
+
+def _search_segments(values, segment_ends):
+    """返回每个值所在的段号, 即第一个 >= 该值的段终点下标"""
+    return np.searchsorted(segment_ends, values, side="left")
+
+
+def _build_ulaw_tables():
+    """生成 μ律 编码查找表 (65536项) 和解码查找表 (256项)
+
+    算法与 ITU-T G.711 参考实现 (Sun g711.c) 一致。
+    """
+    pcm = np.arange(-32768, 32768, dtype=np.int32) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    val = np.minimum(np.abs(pcm), 8159) + (0x84 >> 2)
+    seg = _search_segments(val, np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]))
+    uval = (seg << 4) | ((val >> (np.minimum(seg, 7) + 1)) & 0xF)
+    uval = np.where(seg >= 8, 0x7F, uval)
+    encode = ((uval ^ mask) & 0xFF).astype(np.uint8)
+    # 编码表按 int16 的位模式 (uint16) 索引
+    encode = np.roll(encode, -32768)
+
+    code = ~np.arange(256, dtype=np.int32) & 0xFF
+    t = (((code & 0x0F) << 3) + 0x84) << ((code & 0x70) >> 4)
+    decode = np.where(code & 0x80, 0x84 - t, t - 0x84).astype(np.int16)
+    return encode, decode
+
+
+def _build_alaw_tables():
+    """生成 A律 编码查找表 (65536项) 和解码查找表 (256项)"""
+    pcm = np.arange(-32768, 32768, dtype=np.int32) >> 3
+    mask = np.where(pcm >= 0, 0xD5, 0x55)
+    val = np.where(pcm >= 0, pcm, -pcm - 1)
+    seg = _search_segments(val, np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF]))
+    shift = np.where(seg < 2, 1, np.minimum(seg, 7))
+    aval = (np.minimum(seg, 7) << 4) | ((val >> shift) & 0xF)
+    aval = np.where(seg >= 8, 0x7F, aval)
+    encode = ((aval ^ mask) & 0xFF).astype(np.uint8)
+    encode = np.roll(encode, -32768)
+
+    code = np.arange(256, dtype=np.int32) ^ 0x55
+    seg = (code & 0x70) >> 4
+    t = (code & 0x0F) << 4
+    t = np.where(seg == 0, t + 8, t + 0x108)
+    t = np.where(seg > 1, t << np.maximum(seg - 1, 0), t)
+    decode = np.where(code & 0x80, t, -t).astype(np.int16)
+    return encode, decode
+
+
+class LookupCodec:
+    """基于查找表的 G.711 编解码, 每个采样一次查表"""
+
+    def __init__(self, name, tables, channels=2):
+        self.name = name
+        self.encode_table, self.decode_table = tables
+        self.channels = channels
+
+    def encode(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.uint16, count=len(pcm) // 2)
+        return self.encode_table[samples].tobytes()
+
+    def decode(self, data):
+        codes = np.frombuffer(data, dtype=np.uint8)
+        return self.decode_table[codes].tobytes()
+
+    def decode_into(self, data, out):
+        codes = np.frombuffer(data, dtype=np.uint8)
+        target = np.frombuffer(out, dtype=np.int16, count=len(codes))
+        np.take(self.decode_table, codes, out=target)
+        return target.nbytes
+
+
+# IMA-ADPCM 标准表
+ADPCM_STEPS = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767], dtype=np.int32)
+ADPCM_INDEX_ADJUST = np.array([-1, -1, -1, -1, 2, 4, 6, 8], dtype=np.int32)
+
+# 重建差值表 [步长下标, 3位幅度码], 与参考实现的移位累加完全一致
+_steps = ADPCM_STEPS[:, None]
+_codes = np.arange(8)[None, :]
+ADPCM_DELTAS = ((_steps >> 3)
+                + np.where(_codes & 4, _steps, 0)
+                + np.where(_codes & 2, _steps >> 1, 0)
+                + np.where(_codes & 1, _steps >> 2, 0)).astype(np.int32)
+# 带符号的重建差值, 按 步长下标*16 + 4位码 一维索引, 省去二维花式索引和符号分支
+ADPCM_SIGNED_DELTAS = np.concatenate([ADPCM_DELTAS, -ADPCM_DELTAS], axis=1).reshape(-1)
+# 4位码 (含符号位) 对应的步长下标调整量
+ADPCM_INDEX_ADJUST_4 = np.tile(ADPCM_INDEX_ADJUST, 2)
+# 递推时的状态用 步长下标*16 表示, 和码按位或就是上面两个表的下标:
+# 按 步长下标*16 + 4位码 索引下一步的 步长下标*16, 以及按 步长下标*16 索引步长,
+# 每一步的下标调整和范围限制合成一次查表
+_keys = np.arange(89 * 16)
+ADPCM_NEXT_BASE = (np.clip((_keys >> 4) + ADPCM_INDEX_ADJUST_4[_keys & 15], 0, 88) << 4).astype(np.int32)
+ADPCM_BASE_STEPS = ADPCM_STEPS[_keys >> 4]
+del _steps, _codes, _keys
+
+# 每块头部: 起始采样 int16 + 步长下标 uint8
+ADPCM_BLOCK_HEADER = np.dtype([("predictor", "<i2"), ("index", "u1")])
+
+
+class AdpcmCodec:
+    """分块 IMA-ADPCM
+
+    ADPCM 的预测器逐个采样递推, 无法在时间方向上向量化。这里把每个声道切成若干
+    独立的小块, 每块自带起始采样和步长下标; 递推时每一步同时处理所有块, 循环次数
+    等于块长而不是帧长。块头开销约 5%, 换来每帧独立解码和可接受的 Python 开销。
+
+    解码时步长下标只取决于码, 循环里只递推查表下标 (每步两次 NumPy 调用), 预测值
+    用累加和一次算出, 只有累加结果超出 16 位范围时才逐步饱和重算。编码的量化依赖
+    上一步的预测值, 仍然每步十几次 NumPy 调用: 每帧的耗时主要是调用开销而不是
+    计算量, 单核每秒只能编码几百帧, 约为实时速率的十几倍 (解码约快十倍, 见
+    benchmark.py codec)。服务器给 ADPCM 接收方转码或混音时, 每个节拍每路不同的
+    输出都要编码一次, 十几路就会占满一个核心。
+    """
+
+    name = "adpcm"
+
+    def __init__(self, channels=2, block_samples=64):
+        self.channels = channels
+        self.block_samples = block_samples
+
+    def _lanes(self, samples):
+        """把交织的多声道采样排成 (块数, 块长) 的二维数组"""
+        frames = len(samples) // self.channels
+        blocks = frames // self.block_samples
+        if blocks * self.block_samples != frames:
+            raise ValueError(f"帧长 {frames} 不是块长 {self.block_samples} 的整数倍")
+        per_channel = samples[:frames * self.channels].reshape(frames, self.channels).T
+        return per_channel.reshape(self.channels * blocks, self.block_samples)
+
+    def encode(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+        lanes = self._lanes(samples).astype(np.int32)
+        count, length = lanes.shape
+
+        predictor = lanes[:, 0].copy()
+        # 初始步长按块内前两个采样的差值估计, 让块开头更快收敛
+        first_diff = np.abs(lanes[:, 1] - lanes[:, 0]) if length > 1 else np.zeros(count, np.int32)
+        index = np.clip(np.searchsorted(ADPCM_STEPS, first_diff), 0, 88).astype(np.int32)
+
+        header = np.empty(count, dtype=ADPCM_BLOCK_HEADER)
+        header["predictor"] = predictor
+        header["index"] = index
+
+        codes = np.zeros((length, count), dtype=np.int32)
+        columns = np.ascontiguousarray(lanes.T)
+        # 循环的耗时主要是 NumPy 调用开销, 尽量写进预先分配的数组, 少调用几次
+        base = index << 4
+        step = ADPCM_STEPS[index]
+        work = np.empty(count, dtype=np.int32)
+        sign = np.empty(count, dtype=np.int32)
+        for n in range(1, length):
+            code = codes[n]
+            np.subtract(columns[n], predictor, out=work)
+            # 负数算术右移后全为 1, 取出符号位 8
+            np.right_shift(work, 28, out=sign)
+            np.bitwise_and(sign, 8, out=sign)
+            np.abs(work, out=work)
+            np.left_shift(work, 2, out=work)
+            np.floor_divide(work, step, out=work)
+            np.minimum(work, 7, out=code)
+            code |= sign
+            key = np.bitwise_or(base, code, out=work)
+            predictor += ADPCM_SIGNED_DELTAS.take(key)
+            np.minimum(predictor, 32767, out=predictor)
+            np.maximum(predictor, -32768, out=predictor)
+            base = ADPCM_NEXT_BASE.take(key)
+            step = ADPCM_BASE_STEPS.take(base)
+        codes = codes.T
+
+        # 每块第一个采样在块头里, 对应的码位留空以保持两个码一字节对齐
+        packed = ((codes[:, 0::2] << 4) | codes[:, 1::2]).astype(np.uint8)
+        return header.tobytes() + packed.tobytes()
+
+    def decode(self, data):
+        """解码一帧, 数据长度不是整块或块头损坏时抛出 ValueError"""
+        block_bytes = ADPCM_BLOCK_HEADER.itemsize + self.block_samples // 2
+        count = len(data) // block_bytes
+        if not count or count * block_bytes != len(data) or count % self.channels:
+            raise ValueError(f"ADPCM 数据长度 {len(data)} 不是 {self.channels} 个声道的整块")
+        header_bytes = count * ADPCM_BLOCK_HEADER.itemsize
+        header = np.frombuffer(data, dtype=ADPCM_BLOCK_HEADER, count=count)
+        if header["index"].max() > 88:
+            raise ValueError("ADPCM 块头的步长下标超出范围")
+        packed = np.frombuffer(data, dtype=np.uint8, offset=header_bytes).reshape(count, -1)
+
+        # keys[n] 先放第 n 个码, 循环里就地换成 步长下标*16 + 码
+        keys = np.empty((self.block_samples, count), dtype=np.int32)
+        keys[0::2] = (packed >> 4).T
+        keys[1::2] = (packed & 0x0F).T
+        base = header["index"].astype(np.int32) << 4
+        for n in range(1, self.block_samples):
+            np.bitwise_or(base, keys[n], out=keys[n])
+            base = ADPCM_NEXT_BASE.take(keys[n])
+
+        out = np.empty((self.block_samples, count), dtype=np.int32)
+        out[0] = header["predictor"]
+        np.cumsum(ADPCM_SIGNED_DELTAS.take(keys[1:]), axis=0, out=out[1:])
+        out[1:] += out[0]
+        if out.min() < -32768 or out.max() > 32767:
+            # 中途饱和过的块和参考实现不同, 逐步限制范围重算
+            predictor = out[0].copy()
+            for n in range(1, self.block_samples):
+                predictor += ADPCM_SIGNED_DELTAS.take(keys[n])
+                np.minimum(predictor, 32767, out=predictor)
+                np.maximum(predictor, -32768, out=predictor)
+                out[n] = predictor
+        out = out.T.astype(np.int16)
+
+        # 还原成交织的多声道采样
+        blocks = count // self.channels
+        per_channel = out.reshape(self.channels, blocks * self.block_samples)
+        return per_channel.T.tobytes()
+
+    def decode_into(self, data, out):
+        pcm = self.decode(data)
+        out[:len(pcm)] = pcm
+        return len(pcm)
+
+
+_ULAW_TABLES = _build_ulaw_tables()
+_ALAW_TABLES = _build_alaw_tables()
+
+
+def create_codec(name, channels=2):
+    """按名称创建编解码器"""
+    if name == "pcm":
+        return PcmCodec(channels)
+    if name == "ulaw":
+        return LookupCodec("ulaw", _ULAW_TABLES, channels)
+    if name == "alaw":
+        return LookupCodec("alaw", _ALAW_TABLES, channels)
+    if name == "adpcm":
+        return AdpcmCodec(channels)
+    raise ValueError(f"不支持的编码: {name}")
+
+
+def negotiate_codec(offered):
+    """从客户端按优先级给出的编码列表中选第一个支持的, 都不支持时用 pcm"""
+    for name in offered or []:
+        if name in CODEC_NAMES:
+            return name
+    return "pcm"
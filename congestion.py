@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+"""接收报告和发送端的自适应码率
+
+原来发送端没有任何反馈, 上行再差也按协商的编码和格式全速发送, 网络跟不上时数据
+在发送缓冲区和路由器里排队, 延迟越积越大。现在每 REPORT_INTERVAL 秒交换一次报告
+(REPORT 控制帧, 见 protocol 模块说明):
+
+- 客户端 -> 服务器: 对收到的每个发送者的丢包率和抖动, 以及自己希望最多收几路流;
+  发送的编码和格式变化时另外用 CODEC 控制帧通知;
+- 服务器 -> 客户端: 这个客户端上行的丢包率、抖动、排队延迟和服务器实际收到的码率
+  (StreamMonitor),
+  服务器那边发给它的积压帧数, 以及其他收听者报告的它的丢包率和抖动 (取中位数,
+  个别收听者自己网络差由服务器的背压处理, 不让发送者为它降级)。服务器按策略没有
+  转发的帧 (活跃说话人选择、接收方的流数限制) 在收听者那边也是序列号空洞, 这期间
+  相关的报告不用 (POLICY_HOLD)。
+
+排队延迟按 "单向传输时间比最近一段时间的最小值多出多少" 估计: 帧头时间戳是采集
+时刻, 到达时刻减去它就是传输时间, 两边时钟的偏差是常数, 相减后抵消, 不需要时钟同步。
+
+RateController 根据服务器的报告调整:
+
+- 发送: 沿 send_ladder() 的阶梯逐级降低码率 (先换更低码率的编码, 再下混成单声道,
+  再降低采样率; 一帧的时长由协议固定, 帧越小字节越少)。过载 (排队延迟超过
+  DELAY_HIGH 或平滑后的丢包率超过 LOSS_HIGH) 时降到码率不超过服务器实际收到的
+  码率的 BETA 倍的那一级, 已经排队的越多降得越低, 以便在 DRAIN_TIME 秒左右排空;
+  之后 HOLD 秒内不再降。连续 probe_interval 秒没有排队时试探升一级, 升级后
+  PROBE_WINDOW 秒内又过载说明试探失败, 退回并把下次试探的间隔加倍 (最长
+  PROBE_MAX)。没有排队而丢包率低于 LOSS_HIGH 时认为是随机丢包, 不影响试探,
+  码率不会因为无线网络这类链路的丢包一直停在最低一级。
+- 接收: 服务器那边积压超过 QUEUE_HIGH 帧或服务器判断它拥塞 (见 backpressure.py) 时,
+  请求服务器只发最活跃的几路 (RECEIVE_STREAMS), 正常一段时间后恢复。
+
+控制器只依赖传入的报告和时刻, 不读系统时钟, benchmark.py congestion 用它在模拟的
+瓶颈链路上离线运行整个控制环。
+"""
+
+import statistics
+import threading
+from collections import deque, namedtuple
+
+from audioformat import (FRAME_DURATION, SUPPORTED_RATES, AudioFormat, format_message, parse_format,
+                         stream_frame_bytes, stream_name)
+from backpressure import STREAM_STEPS
+from codec import CODEC_BITS, CODEC_NAMES
+from protocol import HEADER_SIZE, seq_diff
+
+# 两次报告之间的秒数
+REPORT_INTERVAL = 1.0
+# 排队延迟 (秒) 的过载阈值与正常阈值, 介于两者之间时保持不变; 丢包率的过载阈值
+DELAY_HIGH = 0.08
+DELAY_LOW = 0.02
+LOSS_HIGH = 0.10
+# 丢包率的平滑系数
+LOSS_SMOOTHING = 0.3
+# 过载时的码率上限为服务器收到的码率的 BETA 倍, 并留出在 DRAIN_TIME 秒内排空已有排队的余量
+BETA = 0.85
+DRAIN_TIME = 4.0
+# 降级之后多少秒内不再降级
+HOLD = 2.0
+# 试探升级的间隔, 试探失败后加倍
+PROBE_INTERVAL = 5.0
+PROBE_MAX = 60.0
+PROBE_WINDOW = 3.0
+# 服务器那边积压超过这么多帧时少收几路; 恢复前需要正常的秒数
+QUEUE_HIGH = 4
+RECEIVE_RECOVER = 10.0
+# 接收流数的阶梯, 0 表示不限
+RECEIVE_STREAMS = (0,) + STREAM_STEPS
+# 估计最小传输时间的窗口 (报告周期数)
+BASE_WINDOW = 30
+# 序列号一次跳过这么多帧时不算丢包 (服务器这段时间没有转发这个说话人等)
+RESYNC_GAP = 25
+# 服务器按策略少转发过某个发送者的帧 (活跃说话人选择、接收方的流数限制) 之后这么多秒内,
+# 收听者报告的丢包率里混着这些空洞, 不作为发送者的 peers 丢包率
+POLICY_HOLD = 3 * REPORT_INTERVAL
+
+# 一次报告: 上行丢包率、抖动 (秒)、排队延迟 (秒)、服务器收到的码率 (bit/s), 上行没有帧时
+# 都为 None; 服务器积压帧数和是否判断下行拥塞; 其他收听者报告的丢包率和抖动 (没有时为 None);
+# 往返时间
+Report = namedtuple("Report", ["loss", "jitter", "delay", "rate", "queue", "congested", "peer_loss",
+                               "peer_jitter", "rtt"],
+                    defaults=(None, None, None, None, 0, False, None, None, None))
+
+
+def send_ladder(codec, offered, fmt):
+    """发送的降级阶梯 [(编码, AudioFormat), ...], 码率依次降低, 第 0 级是协商的结果"""
+    ladder = [(codec, fmt)]
+    bits = CODEC_BITS[codec]
+    for name in offered or []:
+        if name in CODEC_NAMES and CODEC_BITS[name] < bits:
+            bits = CODEC_BITS[name]
+            ladder.append((name, fmt))
+    codec = ladder[-1][0]
+    if fmt.channels > 1:
+        fmt = AudioFormat(fmt.rate, 1)
+        ladder.append((codec, fmt))
+    for rate in sorted(SUPPORTED_RATES, reverse=True):
+        if rate < fmt.rate:
+            ladder.append((codec, AudioFormat(rate, fmt.channels)))
+    return ladder
+
+
+def stream_bitrate(codec, fmt):
+    """一路流的码率 (bit/s), 含帧头"""
+    return (stream_frame_bytes(stream_name(codec, fmt)) + HEADER_SIZE) * 8 / FRAME_DURATION
+
+
+def stream_message(codec, fmt):
+    """报告和 CODEC 控制帧里的发送流"""
+    return {"codec": codec, "format": format_message(fmt)}
+
+
+def parse_stream_message(message):
+    """stream_message 的逆操作, 无效时返回 None"""
+    if not isinstance(message, dict) or message.get("codec") not in CODEC_NAMES:
+        return None
+    fmt = parse_format(message.get("format"), None)
+    if fmt is None:
+        return None
+    return message["codec"], fmt
+
+
+def median(values):
+    return statistics.median(values) if values else None
+
+
+class StreamMonitor:
+    """一路帧流的接收统计 (服务器上每个客户端的上行, 客户端上每个发送者)
+
+    接收线程调用 on_frame(), 报告线程调用 take()。
+    """
+
+    def __init__(self, window=BASE_WINDOW):
+        self.lock = threading.Lock()
+        self.base_seq = None
+        self.highest = None
+        self.received = 0
+        self.bytes = 0
+        self.started = None
+        # RFC 3550 的到达间隔抖动, 秒
+        self.jitter = 0.0
+        self.last_transit = None
+        self.transit_sum = 0.0
+        self.transit_min = None
+        # 每个周期的最小传输时间, 窗口里的最小值作为没有排队时的基准
+        self.base_transits = deque(maxlen=window)
+        # 最近一次 take() 的结果, 用于指标; 上个周期没有帧时为 None
+        self.last = None
+
+    def reset_base(self):
+        """帧头时间戳换了时钟 (客户端完成时钟同步), 传输时间的基准重新估计"""
+        with self.lock:
+            self.base_transits.clear()
+            self.last_transit = None
+            self.transit_min = None
+            self.transit_sum = 0.0
+            self.received = 0
+            self.base_seq = self.highest
+
+    def on_frame(self, seq, timestamp, arrival, size):
+        transit = arrival - timestamp
+        with self.lock:
+            self.bytes += size
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.last_transit = transit
+            self.transit_sum += transit
+            if self.transit_min is None or transit < self.transit_min:
+                self.transit_min = transit
+            if self.highest is None:
+                self.base_seq = seq - 1
+                self.highest = seq
+            elif seq_diff(seq, self.highest) > 0:
+                gap = seq_diff(seq, self.highest)
+                if gap > RESYNC_GAP:
+                    self.base_seq += gap - 1
+                self.highest = seq
+            self.received += 1
+
+    def take(self, now):
+        """取走这个周期的 (丢包率, 抖动, 排队延迟, 码率) 并开始新周期, 周期里没有帧时返回 None"""
+        with self.lock:
+            started, self.started = self.started, now
+            if not self.received:
+                # 静音期间没有帧, 传输时间的差值从下一段说话重新算起
+                self.last_transit = None
+                self.last = None
+                return None
+            expected = seq_diff(self.highest, self.base_seq)
+            loss = max(0, expected - self.received) / expected if expected > 0 else 0.0
+            self.base_transits.append(self.transit_min)
+            delay = max(0.0, self.transit_sum / self.received - min(self.base_transits))
+            rate = self.bytes * 8 / (now - started) if started is not None and now > started else None
+            result = self.last = (loss, self.jitter, delay, rate)
+            self.base_seq = self.highest
+            self.received = 0
+            self.bytes = 0
+            self.transit_sum = 0.0
+            self.transit_min = None
+        return result
+
+
+class RateController:
+    """发送端的码率控制和接收流数控制, 输入为服务器的报告"""
+
+    def __init__(self, ladder, now=0.0):
+        self.ladder = ladder
+        self.bitrates = [stream_bitrate(codec, fmt) for codec, fmt in ladder]
+        self.level = 0
+        self.loss = 0.0
+        self.hold_until = now
+        self.normal_since = None
+        self.probe_interval = PROBE_INTERVAL
+        self.probed_at = None
+        self.min_rtt = None
+        self.streams_level = 0
+        self.streams_hold_until = now
+        self.streams_normal_since = None
+        self.stats = {"down": 0, "up": 0, "failed_probes": 0}
+
+    @property
+    def stream(self):
+        """当前应该发送的 (编码, AudioFormat)"""
+        return self.ladder[self.level]
+
+    @property
+    def max_streams(self):
+        """当前希望最多收几路流, 0 表示不限"""
+        return RECEIVE_STREAMS[self.streams_level]
+
+    def queue_delay(self, report):
+        """上行排队延迟估计; 往返时间比最小值多出的部分按一半算在上行"""
+        delay = report.delay
+        if report.rtt is not None:
+            if self.min_rtt is None or report.rtt < self.min_rtt:
+                self.min_rtt = report.rtt
+            if delay is not None:
+                delay = max(delay, (report.rtt - self.min_rtt) / 2)
+        return delay
+
+    def update(self, report, now):
+        """处理一次报告, 返回 (发送级别是否改变, 接收流数是否改变)"""
+        return self.update_send(report, now), self.update_receive(report, now)
+
+    def update_send(self, report, now):
+        delay = self.queue_delay(report)
+        if delay is None:
+            # 没在说话, 上行没有测量, 什么也不改
+            return False
+        loss = max(report.loss or 0.0, report.peer_loss or 0.0)
+        self.loss += (loss - self.loss) * LOSS_SMOOTHING
+        loss = self.loss
+        if delay > DELAY_HIGH or loss > LOSS_HIGH:
+            self.normal_since = None
+            if self.probed_at is not None and now - self.probed_at < PROBE_WINDOW:
+                # 刚升级就过载, 试探失败, 下次等更久
+                self.probe_interval = min(PROBE_MAX, self.probe_interval * 2)
+                self.probed_at = None
+                self.stats["failed_probes"] += 1
+                self.hold_until = now
+            if now >= self.hold_until and self.level < len(self.ladder) - 1:
+                self.level = self.decreased_level(report.rate, delay)
+                self.hold_until = now + HOLD
+                self.stats["down"] += 1
+                return True
+            return False
+        if delay > DELAY_LOW:
+            self.normal_since = None
+            return False
+        if self.probed_at is not None and now - self.probed_at >= PROBE_WINDOW:
+            # 试探成功, 试探间隔逐步缩回
+            self.probed_at = None
+            self.probe_interval = max(PROBE_INTERVAL, self.probe_interval / 2)
+        if self.normal_since is None:
+            self.normal_since = now
+        if self.level > 0 and now - self.normal_since >= self.probe_interval and now >= self.hold_until:
+            self.level -= 1
+            self.probed_at = now
+            self.normal_since = now
+            self.stats["up"] += 1
+            return True
+        return False
+
+    def decreased_level(self, rate, delay):
+        """过载时的新级别, 至少降一级"""
+        level = self.level + 1
+        if rate:
+            target = rate * min(BETA, 1 - delay / DRAIN_TIME)
+            while level < len(self.ladder) - 1 and self.bitrates[level] > target:
+                level += 1
+        return level
+
+    def update_receive(self, report, now):
+        if report.queue > QUEUE_HIGH or report.congested:
+            self.streams_normal_since = None
+            if now >= self.streams_hold_until and self.streams_level < len(RECEIVE_STREAMS) - 1:
+                self.streams_level += 1
+                self.streams_hold_until = now + HOLD
+                return True
+            return False
+        if self.streams_normal_since is None:
+            self.streams_normal_since = now
+        if self.streams_level > 0 and now - self.streams_normal_since >= RECEIVE_RECOVER:
+            self.streams_level -= 1
+            self.streams_normal_since = now
+            return True
+        return False
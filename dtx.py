@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""不连续发送 (DTX)
+
+按住说话但没有出声时, 语音活动检测判为静音的帧不再发送。只是什么都不发的话,
+接收方分不清是对方停顿还是网络丢包, 要么做丢包补偿, 要么突然变成完全静音。
+
+静音期间发送方改为每 DTX_INTERVAL 帧发一个 CN 帧, 描述这段时间背景噪声的电平
+和频谱倾斜 (见 protocol.encode_cn), 进入静音的第一帧立即发一次。接收方收到后用
+plc.comfort_noise 在本地合成同样的噪声, 直到对方重新开始说话; 超过 DTX_TIMEOUT
+帧没有新的描述 (对方松开了按键或断线) 就不再合成。
+"""
+
+import numpy as np
+
+from plc import noise_features
+from protocol import encode_cn
+
+# 静音期间两个描述帧之间的帧数 (约170ms)
+DTX_INTERVAL = 8
+# 接收方超过这么多帧没有收到描述就停止合成噪声
+DTX_TIMEOUT = 3 * DTX_INTERVAL
+
+
+class DtxEncoder:
+    """发送方: 累积静音帧的噪声特征, 到时间时给出描述帧负载"""
+
+    def __init__(self, channels=2, interval=DTX_INTERVAL):
+        self.channels = channels
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        """重新开始一段静音, 下一个静音帧立即给出描述"""
+        self.count = 0
+        self.frames = 0
+        self.energy = 0.0
+        self.tilt = 0.0
+
+    def silent_frame(self, pcm):
+        """输入一帧不发送的 int16 PCM, 需要发描述帧时返回负载, 否则返回 None"""
+        samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+        frame = samples[:len(samples) // self.channels * self.channels].reshape(-1, self.channels)
+        if len(frame):
+            rms, r1 = noise_features(frame.astype(np.float32))
+            self.energy += rms * rms
+            self.tilt += r1
+            self.frames += 1
+
+        due = self.count % self.interval == 0
+        self.count += 1
+        if not due or not self.frames:
+            return None
+        # 描述的是上一次描述以来所有静音帧的平均
+        payload = encode_cn(np.sqrt(self.energy / self.frames), self.tilt / self.frames)
+        self.frames = 0
+        self.energy = 0.0
+        self.tilt = 0.0
+        return payload
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+"""广播用的有界帧日志
+
+转发模式下每个收到的帧只追加一次到日志, 不再逐个放入每个接收方的队列。每个接收
+方的发送线程各自保存一个读游标, 从日志里按顺序取自己还没发的帧; 积压超过允许
+的帧数时只保留最新的几帧, 跳过的帧数就是这个接收方丢弃的帧数。接收方自己发的帧
+本来就不发给它, 既不占积压也不算丢弃。
+
+写入方只在追加时持有日志自己的小锁 (多个说话人的接收线程之间串行化), 读取方
+不加锁: 日志项是不可变对象, 槽位里取到的对象如果下标不对, 说明读的时候已经被
+新的帧覆盖, 同样按丢弃计数。
+"""
+
+import threading
+from collections import namedtuple
+
+# sender 为发送方连接 (接收方跳过自己发的帧), packet_for(codec) 返回按该编码打包好的帧
+LogEntry = namedtuple("LogEntry", ["index", "sender", "packet_for"])
+
+
+class FrameLog:
+    """一组接收方共享的只追加帧日志"""
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.entries = [None] * capacity
+        # 下一个要写入的下标, 单调递增
+        self.head = 0
+        self.lock = threading.Lock()
+        # 订阅者的唤醒事件, 增删时整体替换, 写入方不加锁遍历
+        self.waiters = ()
+        self.stats = {"frames": 0, "dropped": 0}
+
+    def subscribe(self, event):
+        """登记一个接收方, 有新帧时设置 event; 返回从当前位置开始的读游标"""
+        with self.lock:
+            self.waiters = self.waiters + (event,)
+            return self.head
+
+    def unsubscribe(self, event):
+        with self.lock:
+            self.waiters = tuple(e for e in self.waiters if e is not event)
+
+    def append(self, sender, packet_for):
+        """追加一帧并唤醒所有接收方"""
+        with self.lock:
+            index = self.head
+            self.entries[index % self.capacity] = LogEntry(index, sender, packet_for)
+            self.head = index + 1
+            self.stats["frames"] += 1
+            waiters = self.waiters
+        for event in waiters:
+            event.set()
+
+    def read(self, cursor, max_backlog=None, reader=None):
+        """取游标之后 reader 以外的发送方的帧, 返回 (日志项列表, 新游标, 丢弃的帧数)
+
+        max_backlog 限制返回的帧数, 超出时丢弃较旧的帧。
+        """
+        head = self.head
+        start = max(cursor, head - self.capacity)
+        # 已经被覆盖的帧不知道是谁发的, 都按丢弃计数
+        dropped = start - cursor
+        entries = []
+        for index in range(start, head):
+            entry = self.entries[index % self.capacity]
+            if entry is None or entry.index != index:
+                dropped += 1
+                continue
+            if reader is None or entry.sender is not reader:
+                entries.append(entry)
+        if max_backlog is not None and len(entries) > max_backlog:
+            dropped += len(entries) - max_backlog
+            entries = entries[len(entries) - max_backlog:]
+        if dropped:
+            with self.lock:
+                self.stats["dropped"] += dropped
+        return entries, head, dropped
+
+    def take_stats(self):
+        """返回并清零统计"""
+        with self.lock:
+            stats = dict(self.stats)
+            for key in self.stats:
+                self.stats[key] = 0
+        return stats
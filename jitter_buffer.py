@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""自适应抖动缓冲区
+
+每个发送者一个缓冲区, 按序列号存放收到的帧, 播放线程每个播放周期取一帧。
+
+目标深度根据网络抖动在线估计: 记录最近一段时间每个帧的传输时间 (到达时间 -
+采集时间戳, 两端时钟偏差是常数, 相减后抵消), 以其中最快的一帧为基准, 取相对
+延迟的 (1 - 允许迟到率) 分位数, 换算成帧数作为目标深度。迟到率超过设定值时再
+额外加一帧余量, 长时间低于设定值时逐步收回。缓冲的帧数超过目标时丢掉最旧的帧
+追赶, 因此在网络变好后延迟也会降下来; 低于目标时隔一个周期暂停一次取帧
+(由播放端补一帧), 让缓冲区涨上去。
+
+乱序到达的帧按序列号放回正确位置; 播放位置已经过去的帧算作迟到并丢弃。
+
+帧数据存放在预先分配的 int16 数组里, 按序列号取模映射到槽位, get() 返回槽位的
+memoryview, 在下一次 put() 覆盖该槽位之前有效。
+"""
+
+import math
+from collections import deque
+
+import numpy as np
+
+from protocol import SEQ_MODULO, seq_diff
+
+
+class JitterBuffer:
+    """单个发送者的自适应抖动缓冲区, 只在播放线程中使用"""
+
+    def __init__(self, frame_duration, frame_bytes=1024 * 2 * 2, min_depth=1, max_depth=25,
+                 late_target=0.02, window=250):
+        self.frame_duration = frame_duration
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        # 允许的迟到帧比例, 目标深度以此为准
+        self.late_target = late_target
+
+        # 槽位比最大深度多留几个, 网络恢复时一次涌来的帧在追赶前也放得下
+        self.slots = max_depth + 8
+        self.frame_bytes = frame_bytes
+        self.store = np.zeros((self.slots, (frame_bytes + 1) // 2), dtype=np.int16)
+        self.views = [memoryview(row).cast("B") for row in self.store]
+        self.slot_seq = [None] * self.slots
+        self.lengths = [0] * self.slots
+        self.arrivals = [0.0] * self.slots
+        self.count = 0
+        self.next_seq = None
+        self.playing = False
+        self.buffering_since = None
+        self.last_arrival = 0.0
+        self.stretched = False
+        # 上一次 get() 返回的帧在缓冲区里等待的时间, 秒
+        self.wait = 0.0
+
+        # RFC 3550 的到达间隔抖动估计, 秒
+        self.jitter = 0.0
+        self.last_transit = None
+        self.transits = deque(maxlen=window)
+        # 最近每个帧是否迟到, 用来校正余量
+        self.late_history = deque(maxlen=window)
+        self.margin = 0
+        self.target_depth = min_depth + 1
+
+        self.stats = {
+            "received": 0,
+            "late": 0,
+            "missing": 0,
+            "rebuffers": 0,
+            "discarded": 0,
+            "stretched": 0
+        }
+
+    def depth(self):
+        """当前缓冲的帧数"""
+        return self.count
+
+    def delay(self):
+        """当前缓冲带来的播放延迟, 秒"""
+        return self.count * self.frame_duration
+
+    def put(self, seq, timestamp, payload, arrival):
+        """加入一帧, 返回是否被接收"""
+        self.last_arrival = arrival
+        self.stats["received"] += 1
+        self.update_delay_estimate(arrival - timestamp)
+
+        late = self.playing and seq_diff(seq, self.next_seq) < 0
+        self.late_history.append(1 if late else 0)
+        if late:
+            self.stats["late"] += 1
+            self.update_target()
+            return False
+        i = seq % self.slots
+        if self.slot_seq[i] == seq:
+            return False
+
+        if not self.count and not self.playing:
+            self.buffering_since = arrival
+        if self.slot_seq[i] is None:
+            self.count += 1
+        else:
+            # 槽位被更早的帧占着, 说明积压已经超过容量, 丢掉旧的
+            self.stats["discarded"] += 1
+        n = min(len(payload), self.frame_bytes)
+        self.views[i][:n] = payload[:n]
+        self.lengths[i] = n
+        self.slot_seq[i] = seq
+        self.arrivals[i] = arrival
+        self.update_target()
+        return True
+
+    def take(self, seq):
+        """取出某个序列号的帧, 不在缓冲区中时返回 None"""
+        i = seq % self.slots
+        if self.slot_seq[i] != seq:
+            return None
+        self.slot_seq[i] = None
+        self.count -= 1
+        return self.views[i][:self.lengths[i]]
+
+    def update_delay_estimate(self, transit):
+        if self.last_transit is not None:
+            d = abs(transit - self.last_transit)
+            self.jitter += (d - self.jitter) / 16
+        self.last_transit = transit
+        self.transits.append(transit)
+
+    def update_target(self):
+        """根据相对延迟分布和实际迟到率更新目标深度"""
+        if not self.transits:
+            return
+        base = min(self.transits)
+        relative = sorted(t - base for t in self.transits)
+        index = min(len(relative) - 1, int(len(relative) * (1 - self.late_target)))
+        depth = math.ceil(relative[index] / self.frame_duration) + self.min_depth
+
+        # 每积累一个窗口的五分之一检查一次实际迟到率
+        history = self.late_history
+        if len(history) >= 50 and self.stats["received"] % 50 == 0:
+            late_rate = sum(history) / len(history)
+            if late_rate > self.late_target:
+                self.margin = min(self.margin + 1, 4)
+            elif late_rate < self.late_target / 4 and self.margin > 0:
+                self.margin -= 1
+
+        self.target_depth = max(self.min_depth, min(self.max_depth, depth + self.margin))
+
+    def get(self, now):
+        """每个播放周期调用一次, 返回该周期的负载; 没有可播放的帧时返回 None"""
+        if not self.playing:
+            if not self.count:
+                return None
+            waited = now - self.buffering_since if self.buffering_since is not None else 0
+            # 攒够目标深度再开始, 或者等待时间已经相当于目标深度 (一句话很短的情况)
+            if self.count < self.target_depth and waited < self.target_depth * self.frame_duration:
+                return None
+            buffered = [s for s in self.slot_seq if s is not None]
+            self.next_seq = min(buffered, key=lambda s: seq_diff(s, buffered[0]))
+            self.playing = True
+
+        # 缓冲低于目标 (留一帧回差) 时暂停一个周期, 最多隔一个周期一次
+        if self.count < self.target_depth - 1 and not self.stretched:
+            self.stretched = True
+            self.stats["stretched"] += 1
+            return None
+        self.stretched = False
+
+        # 缓冲超过目标 (留一帧回差) 时丢掉最旧的一帧追赶
+        if self.count > self.target_depth + 1:
+            if self.take(self.next_seq) is not None:
+                self.stats["discarded"] += 1
+            self.next_seq = (self.next_seq + 1) % SEQ_MODULO
+
+        payload = self.take(self.next_seq)
+        if payload is not None:
+            self.wait = now - self.arrivals[self.next_seq % self.slots]
+        self.next_seq = (self.next_seq + 1) % SEQ_MODULO
+        if payload is None:
+            if self.count:
+                # 后面还有帧, 这一帧丢了或者还没到
+                self.stats["missing"] += 1
+            else:
+                # 缓冲取空, 重新缓冲到目标深度
+                self.playing = False
+                self.buffering_since = None
+                self.stats["rebuffers"] += 1
+        return payload
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""端到端延迟测量
+
+ClockSync 根据 PING/PONG 的四个时刻 (见 protocol 模块说明) 估计与服务器之间的往返
+时间和时钟偏差。排队会让某次往返变长, 而且去程和回程排队不对称时偏差也会算偏,
+所以偏差取最近 window 次测量里往返时间最短的那一次; 往返时间另外按 RFC 6298 的
+方法平滑, 用于显示和上报。
+
+DelayBreakdown 记录一个发送者的声音从采集到播放经过的各段延迟:
+
+- 网络: 从对方采集 (帧头时间戳, 服务器时钟) 到本机收到, 含对方的编码和发送、
+  服务器转发, 需要双方都已完成时钟同步;
+- 缓冲: 从收到到交给声卡, 主要是抖动缓冲区的等待;
+- 设备: 声卡报告的输入和输出延迟, 对方的输入延迟按与本机相同估计。
+
+三段之和就是 "从嘴到耳" 的延迟估计。
+"""
+
+from collections import deque
+
+# 两次时钟同步探测之间的秒数
+PING_INTERVAL = 2.0
+# 刚连接时探测得快一些, 前 window 次的间隔
+PING_STARTUP_INTERVAL = 0.25
+# 各段延迟的平滑系数
+DELAY_SMOOTHING = 1 / 16
+
+
+class ClockSync:
+    """与服务器之间的往返时间和时钟偏差估计"""
+
+    def __init__(self, window=8):
+        self.window = window
+        # 最近几次测量的 (往返时间, 偏差)
+        self.samples = deque(maxlen=window)
+        # 平滑的往返时间, 秒; 还没有测量时为 None
+        self.rtt = None
+        # 服务器时钟 - 本机时钟, 秒; 没有同步之前按两边时钟一致处理
+        self.offset = 0.0
+
+    def synced(self):
+        return self.rtt is not None
+
+    def sample(self, t0, t1, t2, t3):
+        """加入一次测量: 本机发出 t0, 服务器收到 t1, 服务器回复 t2, 本机收到 t3; 返回这次的往返时间"""
+        rtt = max(0.0, (t3 - t0) - (t2 - t1))
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self.samples.append((rtt, offset))
+        self.rtt = rtt if self.rtt is None else self.rtt + (rtt - self.rtt) / 8
+        self.offset = min(self.samples)[1]
+        return rtt
+
+    def report(self):
+        """PING 帧里上报的 (往返时间, 偏差), 还没有测量时返回 None"""
+        if self.rtt is None:
+            return None
+        return self.rtt, self.offset
+
+    def to_server(self, t):
+        """把本机时刻换算成服务器时钟"""
+        return t + self.offset
+
+
+class DelayBreakdown:
+    """一个发送者的各段延迟, 平滑值, 秒; 只在播放线程中更新"""
+
+    def __init__(self, device=0.0):
+        self.network = None
+        self.jitter = None
+        self.device = device
+
+    def update(self, name, value):
+        current = getattr(self, name)
+        if current is None:
+            setattr(self, name, value)
+        else:
+            setattr(self, name, current + (value - current) * DELAY_SMOOTHING)
+
+    def total(self):
+        return (self.network or 0.0) + (self.jitter or 0.0) + self.device
+
+    def as_dict(self):
+        return {"network": self.network, "jitter": self.jitter, "device": self.device,
+                "total": self.total()}
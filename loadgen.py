@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+"""无界面负载生成器
+
+在本机回环地址上启动服务器 (或连接已有的服务器), 用多个负载进程模拟 N 个客户端:
+按 --talk-fraction 的比例说话, 说话人按实时速率发送编码后的合成语音, 其余客户端
+只收听。所有客户端都完成握手后在同一时刻开始发送。
+
+测量服务器 (及其工作进程) 的CPU占用、每帧从采集到送达的转发延迟分位数、吞吐量
+和丢帧率, 结果以 JSON 输出, 便于对比不同引擎和参数或跟踪性能回退:
+
+    python loadgen.py --engines threaded,asyncio --clients 50,100 --talk-fraction 0.05
+    python loadgen.py --clients 200 --room-size 8 --server-args "--workers 2" -o result.json
+    python loadgen.py --connect 192.168.1.10:2000 --clients 20 --transport udp
+
+丢帧率按房间计算: 转发模式下每个说话人发出的帧应当送达同一房间的其他每个成员;
+--server-args 里有 --active-speakers K 时每个房间只有 K 路应当送达, 有 --mix 时
+每个节拍每个收听者应当收到一路混音 (只有自己在说话的说话人不收)。
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import shlex
+import socket
+import sys
+import time
+
+import numpy as np
+
+from benchmark import (FRAME_INTERVAL, free_port, process_tree_cpu_seconds, start_server,
+                       stop_server, synthetic_speech)
+from codec import CODEC_NAMES, create_codec
+from protocol import (FrameDecoder, decode_control, decode_datagram, encode_control, encode_frame,
+                      level_field, PT_AUDIO, PT_HELLO, PT_UDP_REGISTER, PT_WELCOME)
+from vad import level_db
+
+# 开始发送前留给所有负载进程完成握手的时间, 秒
+START_DELAY = 2.0
+# 停止发送后继续接收的时间, 秒
+DRAIN_TIME = 1.0
+# 合成语音循环使用的帧数
+SOURCE_FRAMES = 100
+
+
+def handshake(host, port, room, codec_name, transport):
+    """建立一个模拟客户端的连接, 返回 (TCP socket, UDP socket 或 None)"""
+    s = socket.create_connection((host, port), timeout=5)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    hello = {"transport": transport, "codecs": [codec_name], "room": room, "vad": True}
+    s.sendall(encode_control(PT_HELLO, hello))
+    decoder = FrameDecoder()
+    welcome = None
+    while welcome is None:
+        data = s.recv(65536)
+        if not data:
+            raise ConnectionError("服务器关闭了连接")
+        for frame in decoder.feed(data):
+            if frame.payload_type == PT_WELCOME:
+                welcome = decode_control(frame.payload)
+    s.settimeout(None)
+    udp = None
+    if transport == "udp":
+        if not welcome.get("udp_port"):
+            s.close()
+            raise ConnectionError("服务器未开启UDP传输")
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+        udp.connect((host, welcome["udp_port"]))
+        register = encode_frame(welcome["token"].encode("ascii"), payload_type=PT_UDP_REGISTER)
+        for _ in range(3):
+            udp.send(register)
+    return s, udp
+
+
+def run_clients(job):
+    """负载进程: 模拟 job["rooms"] 里的客户端, 返回原始统计"""
+    codec = create_codec(job["codec"])
+    source = synthetic_speech(SOURCE_FRAMES)
+    payloads = [codec.encode(pcm) for pcm in source]
+    levels = [level_field(level_db(pcm)) for pcm in source]
+
+    sel = selectors.DefaultSelector()
+    socks = []
+    talkers = []
+    result = {"sent": {}, "received": 0, "received_bytes": 0, "latencies": [],
+              "connect_errors": 0, "send_errors": 0, "max_lag": 0.0}
+    try:
+        for room, talking in zip(job["rooms"], job["talking"]):
+            try:
+                s, udp = handshake(job["host"], job["port"], room, job["codec"], job["transport"])
+            except (OSError, ConnectionError):
+                result["connect_errors"] += 1
+                continue
+            socks.append(s)
+            sel.register(s, selectors.EVENT_READ, (FrameDecoder(), True))
+            if udp is not None:
+                socks.append(udp)
+                sel.register(udp, selectors.EVENT_READ, (None, False))
+            if talking:
+                talkers.append((room, udp or s))
+
+        delay = job["start_at"] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        start = time.perf_counter()
+        end = start + job["duration"]
+        next_send = start
+        seq = 0
+        latencies = result["latencies"]
+        while True:
+            now = time.perf_counter()
+            if now >= end + DRAIN_TIME:
+                break
+            if now >= next_send and now < end:
+                result["max_lag"] = max(result["max_lag"], now - next_send)
+                index = seq % len(payloads)
+                for room, sock in talkers:
+                    packet = encode_frame(payloads[index], seq=seq, timestamp=time.time(),
+                                          level=levels[index])
+                    try:
+                        if sock.type == socket.SOCK_DGRAM:
+                            sock.send(packet)
+                        else:
+                            sock.sendall(packet)
+                    except OSError:
+                        result["send_errors"] += 1
+                        continue
+                    result["sent"][room] = result["sent"].get(room, 0) + 1
+                seq += 1
+                next_send += FRAME_INTERVAL
+            timeout = max(0.0, min(next_send, end + DRAIN_TIME) - time.perf_counter())
+            for key, _ in sel.select(timeout):
+                decoder, stream = key.data
+                try:
+                    data = key.fileobj.recv(262144)
+                except OSError:
+                    data = b""
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                arrival = time.time()
+                if stream:
+                    frames = decoder.feed(data)
+                else:
+                    try:
+                        frames = [decode_datagram(data)]
+                    except Exception:
+                        continue
+                for frame in frames:
+                    if frame.payload_type != PT_AUDIO:
+                        continue
+                    result["received"] += 1
+                    result["received_bytes"] += len(frame.payload)
+                    latencies.append(arrival - frame.timestamp)
+        return result
+    finally:
+        sel.close()
+        for sock in socks:
+            sock.close()
+
+
+def assign_clients(n, room_size, talk_fraction):
+    """把 n 个客户端分到房间里, 返回 (房间名列表, 是否说话列表); 说话人尽量平均分到各房间"""
+    count = max(1, -(-n // room_size)) if room_size else 1
+    rooms = [f"load{i % count}" for i in range(n)]
+    talkers = max(1, int(round(n * talk_fraction))) if talk_fraction > 0 else 0
+    talking = [i < talkers for i in range(n)]
+    return rooms, talking
+
+
+def server_mode(server_args):
+    """从传给服务器的参数里取出影响应收帧数的选项, 返回 (是否混音, 活跃说话人数)"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--mix", action="store_true")
+    parser.add_argument("--active-speakers", type=int, default=0)
+    known, _ = parser.parse_known_args(server_args)
+    return known.mix, known.active_speakers
+
+
+def expected_frames(sent, members, talkers, mix=False, active_speakers=0):
+    """按服务器模式计算每个房间应当送达的帧数之和
+
+    sent 为每个房间所有说话人发出的帧数, members 和 talkers 为每个房间的人数和说话人数。
+    """
+    expected = 0
+    for room, count in sent.items():
+        speaking = talkers[room]
+        if mix:
+            # 说话人步调一致, 节拍数约等于每个说话人发出的帧数
+            listeners = members[room] - speaking + (speaking if speaking > 1 else 0)
+            expected += count // speaking * listeners
+        else:
+            if active_speakers:
+                count = count * min(active_speakers, speaking) // speaking
+            expected += count * (members[room] - 1)
+    return expected
+
+
+def run_once(args, engine, n):
+    """对一种引擎和客户端数运行一轮, 返回结果字典"""
+    rooms, talking = assign_clients(n, args.room_size, args.talk_fraction)
+    proc = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        host, port = host or "127.0.0.1", int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        server_args = shlex.split(args.server_args)
+        if args.transport == "udp" and "--udp" not in server_args:
+            server_args.append("--udp")
+        proc = start_server(engine, port, server_args)
+        # 多进程服务器需要时间启动工作进程
+        time.sleep(args.settle)
+    loaders = max(1, min(args.loaders, n))
+    start_at = time.time() + START_DELAY + n * 0.002
+    jobs = []
+    for k in range(loaders):
+        indices = range(k, n, loaders)
+        jobs.append({"host": host, "port": port, "codec": args.codec, "transport": args.transport,
+                     "duration": args.duration, "start_at": start_at,
+                     "rooms": [rooms[i] for i in indices], "talking": [talking[i] for i in indices]})
+    try:
+        with multiprocessing.Pool(loaders) as pool:
+            pending = pool.map_async(run_clients, jobs)
+            # 只统计发送期间的CPU, 不含握手和启动
+            time.sleep(max(0.0, start_at - time.time()))
+            cpu_before = process_tree_cpu_seconds(proc.pid) if proc else None
+            wall_before = time.perf_counter()
+            time.sleep(args.duration)
+            cpu_after = process_tree_cpu_seconds(proc.pid) if proc else None
+            wall = time.perf_counter() - wall_before
+            results = pending.get()
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    members = {}
+    speaking = {}
+    for room, talker in zip(rooms, talking):
+        members[room] = members.get(room, 0) + 1
+        speaking[room] = speaking.get(room, 0) + talker
+    sent = {}
+    for r in results:
+        for room, count in r["sent"].items():
+            sent[room] = sent.get(room, 0) + count
+    frames_sent = sum(sent.values())
+    mix, active_speakers = server_mode(shlex.split(args.server_args))
+    expected = expected_frames(sent, members, speaking, mix, active_speakers)
+    received = sum(r["received"] for r in results)
+    latencies = np.array([x for r in results for x in r["latencies"]]) * 1000
+
+    cpu = None
+    if cpu_before is not None and cpu_after is not None:
+        cpu = (cpu_after - cpu_before) / wall * 100
+    latency = None
+    if len(latencies):
+        latency = {"mean": float(latencies.mean()),
+                   "p50": float(np.percentile(latencies, 50)),
+                   "p95": float(np.percentile(latencies, 95)),
+                   "p99": float(np.percentile(latencies, 99)),
+                   "max": float(latencies.max())}
+    return {
+        "engine": None if args.connect else engine,
+        "server_args": args.server_args,
+        "clients": n,
+        "talkers": sum(talking),
+        "rooms": len(members),
+        "codec": args.codec,
+        "transport": args.transport,
+        "duration": args.duration,
+        "server_cpu_percent": cpu,
+        "frames": {
+            "sent": frames_sent,
+            "expected": expected,
+            "received": received,
+            "drop_rate": 1 - received / expected if expected else 0.0,
+        },
+        "throughput": {
+            "sent_fps": frames_sent / args.duration,
+            "received_fps": received / args.duration,
+            "received_bytes_per_s": sum(r["received_bytes"] for r in results) / args.duration,
+        },
+        "latency_ms": latency,
+        "errors": {
+            "connect": sum(r["connect_errors"] for r in results),
+            "send": sum(r["send_errors"] for r in results),
+        },
+        # 负载进程落后于发送节拍的最大时间, 较大时说明负载进程本身成了瓶颈
+        "loader_max_lag_ms": max(r["max_lag"] for r in results) * 1000,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="语音聊天服务器的无界面负载测试, 结果以 JSON 输出")
+    parser.add_argument("--engines", default="threaded", help="逗号分隔的服务器引擎")
+    parser.add_argument("--clients", default="50", help="逗号分隔的客户端数量")
+    parser.add_argument("--talk-fraction", type=float, default=0.1, help="说话的客户端比例")
+    parser.add_argument("--room-size", type=int, default=0, help="每个房间的人数, 0 表示全部在一个房间")
+    parser.add_argument("--codec", choices=CODEC_NAMES, default="pcm")
+    parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp")
+    parser.add_argument("--duration", type=float, default=5.0, help="每轮发送的秒数")
+    parser.add_argument("--loaders", type=int, default=os.cpu_count() or 1, help="负载进程数")
+    parser.add_argument("--server-args", default="", help="传给 server.py 的其他参数")
+    parser.add_argument("--settle", type=float, default=1.0, help="启动服务器后等待的秒数")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="连接已有的服务器而不是启动新的")
+    parser.add_argument("-o", "--output", help="把 JSON 写入文件, 默认输出到标准输出")
+    args = parser.parse_args(argv)
+    if not 0 <= args.talk_fraction <= 1:
+        parser.error("--talk-fraction 必须在 0-1 之间")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    engines = [args.engines.split(",")[0]] if args.connect else args.engines.split(",")
+    runs = []
+    for engine in engines:
+        for n in (int(x) for x in args.clients.split(",")):
+            print(f"运行: 引擎 {engine}, 客户端 {n}", file=sys.stderr)
+            runs.append(run_once(args, engine, n))
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpu_count": os.cpu_count(), "runs": runs}
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
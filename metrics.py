@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+"""运行指标
+
+计数器、仪表和固定分桶的直方图, 可以通过本机 HTTP 端口以 Prometheus 文本格式
+导出 (/metrics), 也可以取出字典快照 (/metrics.json, 客户端的 snapshot())。
+
+计数器和直方图在数据路径上更新, 不能为此争用一把全局锁: 每个线程第一次更新时
+分到自己的一份计数, 之后只写自己的那份 (GIL 下单线程的 += 不会丢失), 导出时
+把各线程的计数相加。线程结束时它的那份并入基数后删除, 线程引擎每个连接两个线程,
+连接来来去去时份数不会一直增加。读到的值可能比正在进行的更新晚一点, 对监控没有影响。
+
+仪表一般在导出时调用函数取值 (连接数、每个客户端的队列深度), 数据路径上没有开销。
+"""
+
+import bisect
+import json
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 耗时直方图的分桶上界, 秒
+TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                0.1, 0.25, 0.5, 1.0)
+# 队列深度直方图的分桶上界, 帧
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class ShardOwner:
+    """放在线程局部存储里, 线程结束时随之释放, 触发把这个线程的那份并入基数"""
+
+
+class ShardedValues:
+    """每个线程一份的数值数组, 读取时逐项相加"""
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        # 还在运行的线程的份, 键为 id(数组); 已经结束的线程的计数并入 base
+        self.shards = {}
+        self.base = [0] * size
+        self.lock = threading.Lock()
+
+    def shard(self):
+        values = getattr(self.local, "values", None)
+        if values is None:
+            values = [0] * self.size
+            owner = ShardOwner()
+            # 只在线程第一次更新时加锁
+            with self.lock:
+                self.shards[id(values)] = values
+            weakref.finalize(owner, self.retire, values)
+            self.local.owner = owner
+            self.local.values = values
+        return values
+
+    def retire(self, values):
+        """线程已经结束, 它的计数并入基数"""
+        with self.lock:
+            if self.shards.pop(id(values), None) is not None:
+                for i, value in enumerate(values):
+                    self.base[i] += value
+
+    def totals(self):
+        with self.lock:
+            shards = list(self.shards.values())
+            base = list(self.base)
+        return [base[i] + sum(values[i] for values in shards) for i in range(self.size)]
+
+
+class Counter:
+    """只增不减的计数"""
+
+    def __init__(self):
+        self.values = ShardedValues(1)
+
+    def inc(self, amount=1):
+        self.values.shard()[0] += amount
+
+    def value(self):
+        return self.values.totals()[0]
+
+
+class Gauge:
+    """可增可减的当前值, 或者导出时调用 function 取值"""
+
+    def __init__(self, function=None):
+        self.function = function
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.function() if self.function is not None else self.current
+
+
+class Histogram:
+    """固定分桶的直方图, 分桶上界为 buckets, 另有一个 +Inf 桶"""
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        # 各桶计数, +Inf 桶, 总和
+        self.values = ShardedValues(len(self.buckets) + 2)
+
+    def observe(self, value):
+        values = self.values.shard()
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def value(self):
+        """返回 {"buckets": [(上界, 累计数), ...], "count": n, "sum": s}"""
+        totals = self.values.totals()
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), totals[:-1]):
+            running += count
+            cumulative.append((bound, running))
+        return {"buckets": cumulative, "count": running, "sum": totals[-1]}
+
+
+class MetricFamily:
+    """同名、标签不同的一组指标"""
+
+    def __init__(self, name, help_text, kind, labelnames, factory):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+        # 给出时导出前调用, 返回 [(标签值元组, 值), ...], 用于标签集合会变化的仪表
+        self.collector = None
+
+    def labels(self, *values):
+        """取某组标签值对应的指标, 第一次使用时创建; 数据路径上应缓存返回值"""
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def samples(self):
+        """返回 [(标签值元组, 值), ...]"""
+        if self.collector is not None:
+            return [(tuple(str(v) for v in labels), value) for labels, value in self.collector()]
+        return [(labels, child.value()) for labels, child in list(self.children.items())]
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """一个进程 (或一个客户端) 的所有指标"""
+
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, help_text, kind, labelnames, factory):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = MetricFamily(name, help_text, kind, labelnames, factory)
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        """没有标签时直接返回计数器, 否则返回 MetricFamily, 用 labels() 取计数器"""
+        family = self.register(name, help_text, "counter", labelnames, Counter)
+        return family if labelnames else family.labels()
+
+    def histogram(self, name, help_text, labelnames=(), buckets=TIME_BUCKETS):
+        family = self.register(name, help_text, "histogram", labelnames, lambda: Histogram(buckets))
+        return family if labelnames else family.labels()
+
+    def gauge(self, name, help_text, labelnames=(), function=None):
+        """没有标签时 function 返回一个值; 有标签时返回 [(标签值元组, 值), ...]"""
+        family = self.register(name, help_text, "gauge", labelnames, Gauge)
+        if labelnames:
+            family.collector = function
+            return family
+        gauge = family.labels()
+        gauge.function = function
+        return gauge
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, value in family.samples():
+                if family.kind == "histogram":
+                    for bound, count in value["buckets"]:
+                        le = (("le", format_value(float(bound))),)
+                        lines.append(f"{family.name}_bucket"
+                                     f"{format_labels(family.labelnames, labels, le)} {count}")
+                    suffix = format_labels(family.labelnames, labels)
+                    lines.append(f"{family.name}_sum{suffix} {format_value(value['sum'])}")
+                    lines.append(f"{family.name}_count{suffix} {value['count']}")
+                else:
+                    lines.append(f"{family.name}{format_labels(family.labelnames, labels)} "
+                                 f"{format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """可以直接转成 JSON 的字典: 指标名 -> 值, 有标签时为 {"标签=值,...": 值}"""
+        result = {}
+        for family in list(self.families.values()):
+            samples = {}
+            for labels, value in family.samples():
+                if family.kind == "histogram":
+                    value = {"buckets": {("+Inf" if b == float("inf") else str(b)): n
+                                         for b, n in value["buckets"]},
+                             "count": value["count"], "sum": value["sum"]}
+                key = ",".join(f"{k}={v}" for k, v in zip(family.labelnames, labels))
+                samples[key] = value
+            result[family.name] = samples.get("", {}) if not family.labelnames else samples
+        return result
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path in ("/", "/metrics"):
+            body = self.registry.render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(self.registry.snapshot(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不为每次抓取打印访问日志
+        pass
+
+
+def serve_metrics(registry, host="127.0.0.1", port=9100):
+    """在后台线程里启动 HTTP 导出端口, 返回 HTTP 服务器对象"""
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""服务器端 N-1 混音
+
+转发模式下每个说话人的原始PCM都要发给所有其他人, 下行带宽和处理量随人数平方增长,
+客户端还会把不同说话人的数据块首尾相接地播放。混音模式下服务器在固定节拍上把每个
+说话人的一帧对齐, 在 int32 累加器里求和, 再为每个收听者减去他自己的声音 (N-1 混音),
+饱和截断回 int16 后只发一帧。不管多少人同时说话, 每个客户端的下行都只有一路流。
+"""
+
+from collections import deque
+
+import numpy as np
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+
+class Mixer:
+    """按节拍对齐各说话人的帧并生成 N-1 混音
+
+    push() 可以在任意线程调用, mix() 由节拍线程/定时器调用;
+    调用方负责用锁保护两者的并发访问。
+    """
+
+    def __init__(self, frame_samples=1024 * 2, max_backlog=4, prebuffer=2):
+        # 一帧的采样数 (所有声道合计)
+        self.frame_samples = frame_samples
+        # 每个说话人最多积压的帧数, 超出丢弃最旧的
+        self.max_backlog = max_backlog
+        # 说话人开始参与混音前需要先攒够的帧数, 吸收网络抖动
+        self.prebuffer = prebuffer
+        self.pending = {}
+        self.active = set()
+        self.dropped = 0
+        self.accumulator = np.zeros(frame_samples, dtype=np.int32)
+        self.scratch = np.zeros(frame_samples, dtype=np.int32)
+
+    def to_samples(self, payload):
+        """把PCM负载转成固定长度的 int16 数组, 长度不符时补零或截断"""
+        samples = np.frombuffer(payload, dtype=np.int16, count=len(payload) // 2)
+        if len(samples) == self.frame_samples:
+            return samples
+        fixed = np.zeros(self.frame_samples, dtype=np.int16)
+        n = min(len(samples), self.frame_samples)
+        fixed[:n] = samples[:n]
+        return fixed
+
+    def push(self, key, payload, timestamp):
+        """加入某个说话人的一帧"""
+        q = self.pending.get(key)
+        if q is None:
+            q = self.pending[key] = deque()
+        if len(q) >= self.max_backlog:
+            q.popleft()
+            self.dropped += 1
+        q.append((self.to_samples(payload), timestamp))
+
+    def remove(self, key):
+        self.pending.pop(key, None)
+        self.active.discard(key)
+
+    def mix(self, listeners):
+        """完成一个节拍的混音
+
+        返回 (输出列表, 最早采集时间戳), 输出列表为 (收听者, PCM字节);
+        本节拍没有任何人说话时返回空列表。
+        """
+        contributions = {}
+        oldest = None
+        for key, q in self.pending.items():
+            if key not in self.active:
+                if len(q) < self.prebuffer:
+                    continue
+                self.active.add(key)
+            if not q:
+                # 积压耗尽, 重新预缓冲
+                self.active.discard(key)
+                continue
+            samples, timestamp = q.popleft()
+            contributions[key] = samples
+            if oldest is None or timestamp < oldest:
+                oldest = timestamp
+
+        if not contributions:
+            return [], None
+
+        acc = self.accumulator
+        acc[:] = 0
+        for samples in contributions.values():
+            acc += samples
+
+        # 没说话的收听者听到的都是完整混音, 只算一次
+        full_mix = None
+        out = []
+        for listener in listeners:
+            own = contributions.get(listener)
+            if own is None:
+                if full_mix is None:
+                    full_mix = np.clip(acc, INT16_MIN, INT16_MAX).astype(np.int16).tobytes()
+                out.append((listener, full_mix))
+            elif len(contributions) > 1:
+                np.subtract(acc, own, out=self.scratch)
+                np.clip(self.scratch, INT16_MIN, INT16_MAX, out=self.scratch)
+                out.append((listener, self.scratch.astype(np.int16).tobytes()))
+            # 只有自己在说话时没有东西可听
+        return out, oldest
+
+
+def mix_pcm(payloads):
+    """把几路等长的 int16 PCM 相加并饱和截断, 用于客户端同时播放多个说话人
+
+    输入可以是 bytes 或缓冲区视图, 返回 bytes。
+    """
+    if len(payloads) == 1:
+        return bytes(payloads[0])
+    acc = np.zeros(len(payloads[0]) // 2, dtype=np.int32)
+    for payload in payloads:
+        samples = np.frombuffer(payload, dtype=np.int16, count=len(payload) // 2)
+        n = min(len(samples), len(acc))
+        acc[:n] += samples[:n]
+    return np.clip(acc, INT16_MIN, INT16_MAX).astype(np.int16).tobytes()
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""丢包补偿 (Packet Loss Concealment)
+
+抖动缓冲区在某个播放周期拿不出帧 (丢包、迟到、缓冲区正在加深) 时, 直接播放静音
+会产生咔哒声。这里按以下顺序补一帧:
+
+1. 前 max_conceal 个连续丢失的帧: 用最近的波形外推。pitch 方式在历史波形上用
+   归一化自相关找基音周期, 按周期重复最后一个周期的波形; 找不到明显周期 (清音、
+   噪声) 或使用 repeat 方式时重复上一帧。外推的音量在这几帧内线性衰减到0。
+2. 之后的 comfort_frames 帧: 按估计的背景噪声电平和频谱倾斜生成舒适噪声。
+3. 再之后不再输出, 由播放端按静音处理。
+
+收到正常帧后用几毫秒的交叉淡入接回真实信号。
+"""
+
+import numpy as np
+
+
+def comfort_noise(samples, channels, level, tilt, rng):
+    """生成舒适噪声
+
+    level 为目标均方根电平; tilt 为一阶自回归系数 (-1..1), 正值偏低频, 负值偏高频,
+    0 为白噪声。在频域整形后做逆变换, 整帧一次完成。
+    """
+    if level <= 0:
+        return np.zeros((samples, channels), dtype=np.float32)
+    white = rng.standard_normal((samples, channels))
+    spectrum = np.fft.rfft(white, axis=0)
+    omega = np.linspace(0, np.pi, spectrum.shape[0])
+    shape = 1 / np.abs(1 - tilt * np.exp(-1j * omega))
+    noise = np.fft.irfft(spectrum * shape[:, None], n=samples, axis=0)
+    rms = np.sqrt(np.mean(noise ** 2))
+    if rms > 0:
+        noise *= level / rms
+    return noise.astype(np.float32)
+
+
+def noise_features(frame):
+    """返回一帧 (采样数, 声道数) 浮点数组的均方根电平和一阶自相关系数 (-1..1)
+
+    自相关系数即 comfort_noise 的 tilt 参数的估计值。
+    """
+    rms = float(np.sqrt(np.mean(frame ** 2)))
+    mono = frame.mean(axis=1)
+    energy = float(np.dot(mono, mono))
+    r1 = float(np.dot(mono[1:], mono[:-1])) / energy if energy > 0 else 0.0
+    return rms, max(-0.95, min(0.95, r1))
+
+
+class LossConcealer:
+    """单个发送者的丢包补偿器, 只在播放线程中使用"""
+
+    def __init__(self, frame_samples, channels=2, rate=48000, method="pitch",
+                 max_conceal=3, comfort_frames=25):
+        # 每帧每声道的采样数
+        self.frame_samples = frame_samples
+        self.channels = channels
+        self.method = method
+        self.max_conceal = max_conceal
+        self.comfort_frames = comfort_frames
+
+        # 基音搜索范围 50Hz..400Hz, 相关窗口 10ms
+        self.min_lag = rate // 400
+        self.max_lag = rate // 50
+        self.window = rate // 100
+        history_len = max(2 * frame_samples, self.max_lag + self.window)
+        self.history = np.zeros((history_len, channels), dtype=np.float32)
+        # 交叉淡入长度 2ms
+        self.fade = min(frame_samples, rate // 500)
+
+        self.losses = 0
+        self.active = False
+        self.period = 0
+        self.phase = 0
+        self.gain = 1.0
+
+        # 背景噪声估计: 电平取最小值跟踪, 频谱倾斜取安静帧的一阶自相关
+        self.noise_level = None
+        self.noise_tilt = 0.0
+        self.rng = np.random.default_rng()
+
+    def good(self, payload):
+        """收到正常帧: 更新历史, 丢包后接回时做交叉淡入, 返回要播放的PCM"""
+        frame = np.frombuffer(payload, dtype=np.int16).reshape(-1, self.channels).astype(np.float32)
+        if self.losses and self.losses <= self.max_conceal:
+            n = min(self.fade, len(frame))
+            ramp = np.linspace(0, 1, n, dtype=np.float32)[:, None]
+            tail = self.extrapolate(n, advance=False) * self.gain
+            frame[:n] = frame[:n] * ramp + tail * (1 - ramp)
+            payload = np.clip(frame, -32768, 32767).astype(np.int16).tobytes()
+        elif self.losses:
+            n = min(self.fade, len(frame))
+            frame[:n] *= np.linspace(0, 1, n, dtype=np.float32)[:, None]
+            payload = np.clip(frame, -32768, 32767).astype(np.int16).tobytes()
+
+        self.push_history(frame)
+        self.track_noise(frame)
+        self.losses = 0
+        self.active = True
+        return payload
+
+    def comfort(self, level, tilt):
+        """发送方处于静音 (DTX) 时按它发来的噪声描述生成一帧, 收到正常帧时淡入接回"""
+        self.losses = self.max_conceal + 1
+        self.active = True
+        frame = comfort_noise(self.frame_samples, self.channels, level, tilt, self.rng)
+        return np.clip(frame, -32768, 32767).astype(np.int16).tobytes()
+
+    def conceal(self):
+        """补一帧, 返回PCM; 已经补够或者还没有收到过正常帧时返回 None"""
+        if not self.active:
+            return None
+        self.losses += 1
+
+        if self.losses <= self.max_conceal:
+            if self.losses == 1:
+                self.period = self.find_period() if self.method == "pitch" else 0
+                self.phase = 0
+            start_gain = 1 - (self.losses - 1) / self.max_conceal
+            end_gain = 1 - self.losses / self.max_conceal
+            frame = self.extrapolate(self.frame_samples)
+            frame *= np.linspace(start_gain, end_gain, self.frame_samples, dtype=np.float32)[:, None]
+            self.gain = end_gain
+        elif self.losses <= self.max_conceal + self.comfort_frames:
+            frame = comfort_noise(self.frame_samples, self.channels,
+                                  self.noise_level or 0.0, self.noise_tilt, self.rng)
+        else:
+            self.active = False
+            return None
+
+        return np.clip(frame, -32768, 32767).astype(np.int16).tobytes()
+
+    def push_history(self, frame):
+        n = len(frame)
+        if n >= len(self.history):
+            self.history[:] = frame[-len(self.history):]
+        else:
+            self.history[:-n] = self.history[n:]
+            self.history[-n:] = frame
+
+    def track_noise(self, frame):
+        rms, r1 = noise_features(frame)
+        if self.noise_level is None or rms < self.noise_level:
+            self.noise_level = rms
+        else:
+            # 电平慢慢向上爬, 背景噪声变大时几秒内跟上
+            self.noise_level *= 1.02
+        if rms <= self.noise_level * 1.5 and rms > 0:
+            self.noise_tilt = 0.9 * self.noise_tilt + 0.1 * r1
+
+    def find_period(self):
+        """在历史波形上找基音周期, 找不到明显周期时返回0"""
+        mono = self.history.mean(axis=1)
+        n = len(mono)
+        target = mono[n - self.window:]
+        target_energy = float(np.dot(target, target))
+        if target_energy <= 0:
+            return 0
+        # 所有候选延迟的窗口一次取出, 用矩阵乘法算相关
+        region = mono[n - self.window - self.max_lag:n - self.min_lag]
+        windows = np.lib.stride_tricks.sliding_window_view(region, self.window)
+        corr = windows @ target
+        energy = np.einsum("ij,ij->i", windows, windows)
+        score = corr / np.sqrt(energy * target_energy + 1e-9)
+        peak = float(score.max())
+        if peak < 0.5:
+            return 0
+        # 周期的整数倍相关也很高, 取延迟最小的那个接近最高分的峰, 避免倍频错误。
+        # windows[0] 对应最大延迟, 下标越大延迟越小
+        end = int(np.nonzero(score >= 0.9 * peak)[0][-1])
+        start = end
+        while start > 0 and score[start - 1] >= 0.9 * peak:
+            start -= 1
+        best = start + int(np.argmax(score[start:end + 1]))
+        return self.max_lag - best
+
+    def extrapolate(self, samples, advance=True):
+        """从历史波形外推 samples 个采样 (未乘衰减), advance 为 False 时不推进相位"""
+        period = self.period
+        if period <= 0:
+            # 没有基音周期时重复上一帧
+            period = self.frame_samples
+        template = self.history[-period:]
+        index = (self.phase + np.arange(samples)) % period
+        if advance:
+            self.phase = (self.phase + samples) % period
+        return template[index]
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+"""语音数据帧协议
+
+TCP 是字节流, 一次 recv() 拿到的数据可能是半个帧, 也可能是好几个帧粘在一起,
+所以所有音频和控制数据都按帧发送。每个帧由固定长度的帧头和负载组成,
+帧头格式(网络字节序):
+
+    负载长度   uint32
+    发送者ID   uint32   客户端发送时填0, 由服务器在转发时填入连接ID
+    序列号     uint32   每个发送者独立递增, 溢出后回绕
+    采集时间戳 float64  音频采集时刻 (time.time(), 秒)
+    负载类型   uint8
+    音量       uint8    这一帧的电平 (dB, 与 vad.level_db 刻度相同), 0 表示未提供
+
+UDP 传输时一个数据报正好是一个完整的帧, 格式相同。
+
+控制帧的负载是 UTF-8 编码的 JSON 对象。连接建立后客户端先发送 HELLO,
+服务器回复 WELCOME (带连接ID, 以及 UDP 端口和注册令牌); 使用 UDP 的客户端
+再从自己的 UDP 端口发送 UDP_REGISTER (负载为令牌), 服务器据此记下它的地址。
+
+每个客户端属于一个房间, 只和同一房间的成员互相收发音频。HELLO 里可以带房间名,
+连接后发送 JOIN {"room": 名称} 切换房间, 服务器回复 JOIN 确认当前房间和成员数。
+
+服务器之间可以建立中继连接: 连接双方先发送 RELAY {"node": 节点号, "rooms": [...]},
+房间列表为希望对方转来的房间, 之后有变化时再次发送。房间内的音频帧用 RELAY_FRAME
+转发, 负载为房间名、编码名和原样的转发帧 (见 encode_room_frame)。中继模式下发送者
+ID 的高 8 位是分配该ID的节点号, 多个节点的ID不会重复。
+
+发送方在按住发言但没有说话时不发音频, 改为低频率发送 CN (舒适噪声描述) 帧,
+负载只有 3 字节: 噪声电平 (int16 采样的均方根, uint16) 和频谱倾斜 (一阶自相关
+系数乘以 127, int8)。CN 帧和音频帧共用序列号, 服务器像音频一样原样转发, 接收方
+按描述在本地合成噪声, 直到收到下一帧音频。
+
+客户端定期发送 PING 测量往返时间和与服务器的时钟偏差 (NTP 的方法): 帧头时间戳为
+客户端发送时刻 t0, 序列号为探测序号, 负载为上一次的测量结果 (往返时间和偏差,
+两个 float64, 还没有结果时为空), 供服务器统计。服务器用 PONG 回复, 序列号和时间戳
+原样带回, 负载为服务器收到和回复的时刻 t1、t2。客户端在 t3 收到后:
+
+    往返时间 = (t3 - t0) - (t2 - t1)
+    时钟偏差 = ((t1 - t0) + (t2 - t3)) / 2      服务器时钟 - 客户端时钟
+
+完成同步的客户端发送的音频帧时间戳换算成服务器时钟, 接收方加上自己的偏差就能
+算出从采集到收到的单向延迟。使用 UDP 传输时 PING 和 PONG 也走 UDP。
+
+接收方跟不上时服务器可以改用更低码率的编码发给它 (HELLO 里 "codec_switch" 为 true
+的客户端), 用 CODEC {"codec": 名称} 通知; 之后发给它的音频帧都是新编码。CODEC 走
+TCP, 与 UDP 上的音频之间没有先后保证, 客户端丢弃帧长与当前编码不符的音频帧。
+
+双方每秒交换一次 REPORT 报告 (见 congestion.py), 都走 TCP。客户端的报告为
+{"receive": {发送者ID: [丢包率, 抖动毫秒]}, "streams": 希望最多收几路 (0 为不限)};
+服务器的报告为 {"loss", "jitter", "delay", "rate"}
+(这个客户端上一秒的上行丢包率、抖动和排队延迟 (秒) 以及收到的码率 (bit/s),
+没有收到音频时不带), "queue" (发给它的积压帧数), "congested" 和 "peers"
+(其他收听者报告的它的丢包率和抖动的中位数)。客户端自适应码率时用 CODEC
+{"codec": 名称, "format": 格式} 告诉服务器它改用的发送编码和格式; 同样因为与
+UDP 上的音频没有先后保证, 服务器按帧长认出切换前后的帧 (见 server.frame_stream)。
+"""
+
+import json
+import struct
+import time
+from collections import namedtuple
+
+HEADER = struct.Struct("!IIIdBB")
+HEADER_SIZE = HEADER.size
+
+# 单帧负载上限, 超过说明数据流已经错位
+MAX_PAYLOAD_SIZE = 1 << 20
+
+SEQ_MODULO = 1 << 32
+
+# 负载类型
+PT_AUDIO = 0
+PT_HELLO = 1
+PT_WELCOME = 2
+PT_UDP_REGISTER = 3
+PT_JOIN = 4
+PT_RELAY = 5
+PT_RELAY_FRAME = 6
+PT_CN = 7
+PT_PING = 8
+PT_PONG = 9
+PT_CODEC = 10
+PT_REPORT = 11
+
+# 发送者ID中节点号所在的位置, 低 24 位为节点内的连接ID
+NODE_ID_SHIFT = 24
+MAX_NODE_ID = 255
+
+NAME_LENGTH = struct.Struct("!B")
+CN_DESCRIPTOR = struct.Struct("!Hb")
+CLOCK_TIMES = struct.Struct("!dd")
+
+Frame = namedtuple("Frame", ["sender_id", "seq", "timestamp", "payload_type", "payload", "level"],
+                   defaults=(0,))
+
+
+class ProtocolError(Exception):
+    """数据流无法按帧解析"""
+
+
+def encode_frame(payload, sender_id=0, seq=0, timestamp=None, payload_type=PT_AUDIO, level=0):
+    """把负载打包成一个完整的帧"""
+    if timestamp is None:
+        timestamp = time.time()
+    header = HEADER.pack(len(payload), sender_id, seq % SEQ_MODULO, timestamp, payload_type, level)
+    return header + bytes(payload)
+
+
+def encode_control(payload_type, message, sender_id=0):
+    """把字典编码成控制帧"""
+    payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return encode_frame(payload, sender_id, payload_type=payload_type)
+
+
+def decode_control(payload):
+    """解析控制帧负载, 返回字典"""
+    try:
+        message = json.loads(payload.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError(f"控制帧格式错误: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("控制帧必须是JSON对象")
+    return message
+
+
+def decode_datagram(data):
+    """把一个UDP数据报解析成帧"""
+    if len(data) < HEADER_SIZE:
+        raise ProtocolError(f"数据报太短: {len(data)}")
+    length, sender_id, seq, timestamp, payload_type, level = HEADER.unpack_from(data)
+    if HEADER_SIZE + length != len(data):
+        raise ProtocolError(f"数据报长度不符: {len(data)} != {HEADER_SIZE + length}")
+    return Frame(sender_id, seq, timestamp, payload_type, bytes(data[HEADER_SIZE:]), level)
+
+
+def encode_room_frame(room, codec, packet):
+    """在一个完整的转发帧前面加上房间名和编码名, 用于服务器之间转发"""
+    name = room.encode("utf-8")
+    return b"".join((NAME_LENGTH.pack(len(name)), name,
+                     NAME_LENGTH.pack(len(codec)), codec.encode("ascii"), packet))
+
+
+def decode_room_frame(data):
+    """encode_room_frame 的逆操作, 返回 (房间名, 编码名, 帧)"""
+    (length,) = NAME_LENGTH.unpack_from(data, 0)
+    room = bytes(data[1:1 + length]).decode("utf-8")
+    offset = 1 + length
+    (length,) = NAME_LENGTH.unpack_from(data, offset)
+    codec = bytes(data[offset + 1:offset + 1 + length]).decode("ascii")
+    return room, codec, decode_datagram(data[offset + 1 + length:])
+
+
+def encode_cn(level, tilt):
+    """把噪声电平和频谱倾斜打包成 CN 帧负载"""
+    level = max(0, min(65535, int(round(level))))
+    tilt = max(-127, min(127, int(round(tilt * 127))))
+    return CN_DESCRIPTOR.pack(level, tilt)
+
+
+def decode_cn(payload):
+    """encode_cn 的逆操作, 返回 (电平, 倾斜)"""
+    if len(payload) < CN_DESCRIPTOR.size:
+        raise ProtocolError(f"CN 帧太短: {len(payload)}")
+    level, tilt = CN_DESCRIPTOR.unpack_from(payload)
+    return float(level), tilt / 127
+
+
+def encode_ping(rtt, offset):
+    """把上一次测得的往返时间和时钟偏差打包成 PING 帧负载"""
+    return CLOCK_TIMES.pack(rtt, offset)
+
+
+def decode_ping(payload):
+    """encode_ping 的逆操作, 返回 (往返时间, 偏差), 负载为空时返回 None"""
+    if not payload:
+        return None
+    if len(payload) < CLOCK_TIMES.size:
+        raise ProtocolError(f"PING 帧太短: {len(payload)}")
+    return CLOCK_TIMES.unpack_from(payload)
+
+
+def encode_pong(received, sent):
+    """把服务器收到 PING 和发出 PONG 的时刻打包成 PONG 帧负载"""
+    return CLOCK_TIMES.pack(received, sent)
+
+
+def decode_pong(payload):
+    """encode_pong 的逆操作, 返回 (收到时刻, 发出时刻)"""
+    if len(payload) < CLOCK_TIMES.size:
+        raise ProtocolError(f"PONG 帧太短: {len(payload)}")
+    return CLOCK_TIMES.unpack_from(payload)
+
+
+def level_field(level_db):
+    """把电平 (dB) 转成帧头的音量字段, 保证非0以区别于未提供"""
+    return max(1, min(255, int(round(level_db))))
+
+
+def seq_diff(a, b):
+    """计算序列号 a - b, 考虑回绕, 结果在 [-2^31, 2^31) 之间"""
+    return (a - b + (SEQ_MODULO >> 1)) % SEQ_MODULO - (SEQ_MODULO >> 1)
+
+
+class FrameDecoder:
+    """从字节流中增量重组帧
+
+    每次 recv() 得到的数据交给 feed(), 返回其中所有已经完整的帧,
+    不完整的尾部留在缓冲区里等待下一次数据。
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """加入新收到的数据, 返回解析出的帧列表"""
+        self.buffer.extend(data)
+        frames = []
+        offset = 0
+        available = len(self.buffer)
+
+        while available - offset >= HEADER_SIZE:
+            length, sender_id, seq, timestamp, payload_type, level = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_PAYLOAD_SIZE:
+                raise ProtocolError(f"帧长度异常: {length}")
+            end = offset + HEADER_SIZE + length
+            if end > available:
+                break
+            payload = bytes(self.buffer[offset + HEADER_SIZE:end])
+            frames.append(Frame(sender_id, seq, timestamp, payload_type, payload, level))
+            offset = end
+
+        if offset:
+            del self.buffer[:offset]
+        return frames
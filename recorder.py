@@ -0,0 +1,497 @@
+#!/usr/bin/python3
+"""服务器端录音
+
+房间的音频在服务器上直接写入文件, 不需要另外接一个录音客户端走抖动缓冲和播放。
+
+数据路径 (接收线程、asyncio 事件循环) 上的 record() 只把帧和到达时间追加到队列,
+不解码也不做磁盘操作; 积压超过上限时丢弃新帧并计数, 不会阻塞。单独的写线程每隔
+FLUSH_INTERVAL 秒 (积压较多时提前) 取走队列里的全部帧, 解码、按时间排好后每个文件
+合并成少数几次大块写入。
+
+录音方式:
+
+- room: 每个房间一个 WAV 文件, 所有说话人转成 48kHz 双声道后混在一起;
+- speaker: 每个说话人一个 WAV 文件, 保持其开始录音时的格式 (说话人中途因为自适应
+  码率换了格式时转换回这个格式), 同一房间的文件从同一时刻开始, 可以直接对齐;
+- 文件格式为 raw 时不解码, 原样保存收到的帧: .raw 为依次拼接的负载, .idx 为每帧一条
+  定长索引 (INDEX_ENTRY), .json 说明各发送者的流 (编码和格式) 和索引的字段。
+
+帧在时间线上的位置 (时间槽, 一帧一个) 按序列号接着上一帧排, 到达时间与之相差超过
+REALIGN_FRAMES 帧时 (说话人静音了一段时间、重新连接) 按到达时间重新对齐。没有声音的
+时间槽不写, 在文件里是空洞, 读出来是静音。房间混音的时间槽等 SETTLE_DELAY 秒再写出,
+更晚到的帧丢弃。
+
+输出文件可以按块预分配 (preallocate 秒), 写到末尾时再分配下一块, 减少文件系统碎片;
+预分配后还可以用内存映射写入 (use_mmap)。WAV 文件头在每次写入后更新, 服务器异常退出时
+已经写入的部分仍然可以播放; 正常退出时截掉预分配多出的部分。
+
+WAV 文件头里的长度是 32 位的, 一个文件的数据最多 MAX_WAV_DATA 字节 (48kHz 双声道约
+6.2 小时), 录音更长时按整帧接着写到 名称-part2.wav、名称-part3.wav ..., 各部分首尾相接。
+"""
+
+import atexit
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from audioformat import DEFAULT_FORMAT, FRAME_DURATION, StreamCodecs, StreamConverter, frame_samples, stream_format
+from protocol import PT_AUDIO, seq_diff
+
+# 写线程两次处理之间的秒数
+FLUSH_INTERVAL = 0.5
+# 队列里积压这么多帧时提前唤醒写线程
+BATCH_FRAMES = 256
+# 队列积压上限 (帧), 超出时丢弃新帧
+MAX_BACKLOG = 20000
+# 房间混音的时间槽等待迟到帧的秒数
+SETTLE_DELAY = 0.2
+# 到达时间与按序列号推算的位置相差超过这么多帧时重新对齐
+REALIGN_FRAMES = 10
+# 一个房间这么久没有新帧就结束这段录音, 之后再有声音时开始新文件
+IDLE_TIMEOUT = 60.0
+# 开启内存映射但没有指定预分配时, 每次分配的秒数
+MMAP_CHUNK_SECONDS = 60.0
+
+RECORD_MODES = ("room", "speaker")
+RECORD_FORMATS = ("wav", "raw")
+# raw 格式的索引: 时间槽, 发送者ID, 序列号, 负载长度, 帧头时间戳, 负载类型, 负载在 .raw 里的偏移
+INDEX_ENTRY = struct.Struct("!IIIIdBQ")
+INDEX_FIELDS = ["slot", "sender_id", "seq", "length", "timestamp", "payload_type", "offset"]
+WAV_HEADER_SIZE = 44
+# RIFF 块长度 (36 + 数据字节数) 是 uint32, 一个 WAV 文件的数据部分不能超过
+MAX_WAV_DATA = 0xFFFFFFFF - 36
+
+
+def wav_header(fmt, data_bytes):
+    """16位 PCM 的 WAV 文件头"""
+    block = fmt.channels * 2
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_bytes, b"WAVE", b"fmt ", 16, 1,
+                       fmt.channels, fmt.rate, fmt.rate * block, block, 16, b"data", data_bytes)
+
+
+def file_name(room):
+    """房间名中不能用于文件名的字符换成下划线"""
+    return re.sub(r"[^\w.-]", "_", room) or "_"
+
+
+def contiguous_runs(frames):
+    """把 {时间槽: 数据} 按时间槽分成连续的几段, 返回 [(第一个时间槽, [数据, ...]), ...]"""
+    runs = []
+    for slot in sorted(frames):
+        if runs and slot == runs[-1][0] + len(runs[-1][1]):
+            runs[-1][1].append(frames[slot])
+        else:
+            runs.append((slot, [frames[slot]]))
+    return runs
+
+
+class OutputFile:
+    """按偏移写入的输出文件, 可以按块预分配, 预分配后可以用内存映射写入"""
+
+    def __init__(self, path, chunk=0, use_mmap=False):
+        self.path = path
+        self.file = open(path, "w+b")
+        # 每次预分配的字节数, 0 表示不预分配
+        self.chunk = chunk
+        self.use_mmap = use_mmap and chunk > 0
+        self.map = None
+        self.allocated = 0
+        # 已写入数据的末尾
+        self.end = 0
+
+    def reserve(self, size):
+        if not self.chunk or size <= self.allocated:
+            return
+        size = max(size, self.allocated + self.chunk)
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if hasattr(os, "posix_fallocate"):
+            self.file.flush()
+            os.posix_fallocate(self.file.fileno(), self.allocated, size - self.allocated)
+        else:
+            self.file.truncate(size)
+        self.allocated = size
+        if self.use_mmap:
+            self.map = mmap.mmap(self.file.fileno(), size)
+
+    def write_at(self, offset, data):
+        end = offset + len(data)
+        self.reserve(end)
+        if self.map is not None:
+            self.map[offset:end] = data
+        else:
+            self.file.seek(offset)
+            self.file.write(data)
+        self.end = max(self.end, end)
+        return len(data)
+
+    def flush(self):
+        if self.map is None:
+            self.file.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        # 截掉预分配但没有用到的部分
+        self.file.truncate(self.end)
+        self.file.close()
+
+
+class WavTrack:
+    """一路 WAV 录音, 按时间槽写入整帧; 超过一个文件的长度上限时分成几个部分"""
+
+    def __init__(self, path, fmt, preallocate=0.0, use_mmap=False):
+        self.fmt = fmt
+        self.base = path[:-len(".wav")] if path.endswith(".wav") else path
+        self.frame_bytes = frame_samples(fmt.rate) * fmt.channels * 2
+        self.part_frames = MAX_WAV_DATA // self.frame_bytes
+        self.chunk = int(preallocate / FRAME_DURATION) * self.frame_bytes
+        self.use_mmap = use_mmap
+        # 部分序号 (从0开始) -> OutputFile; 只保留最近的两个部分, 更早的已经写完
+        self.parts = {}
+        self.part(0)
+
+    def part(self, index):
+        out = self.parts.get(index)
+        if out is None:
+            name = f"{self.base}.wav" if index == 0 else f"{self.base}-part{index + 1}.wav"
+            out = self.parts[index] = OutputFile(name, self.chunk, self.use_mmap)
+            out.write_at(0, wav_header(self.fmt, 0))
+            for old in [i for i in self.parts if i < index - 1]:
+                done = self.parts.pop(old)
+                done.write_at(0, wav_header(self.fmt, done.end - WAV_HEADER_SIZE))
+                done.close()
+        return out
+
+    def write(self, frames):
+        """写入 {时间槽: PCM}, 返回写入的字节数"""
+        written = 0
+        touched = {}
+        for first, run in contiguous_runs(frames):
+            while run:
+                index, offset = divmod(first, self.part_frames)
+                if index not in self.parts and index < max(self.parts):
+                    # 已经关闭的部分, 这么迟的帧不再写
+                    count = min(len(run), self.part_frames - offset)
+                else:
+                    out = self.part(index)
+                    count = min(len(run), self.part_frames - offset)
+                    written += out.write_at(WAV_HEADER_SIZE + offset * self.frame_bytes, b"".join(run[:count]))
+                    touched[index] = out
+                first += count
+                run = run[count:]
+        for out in touched.values():
+            if not out.file.closed:
+                out.write_at(0, wav_header(self.fmt, out.end - WAV_HEADER_SIZE))
+                out.flush()
+        return written
+
+    def close(self):
+        for out in self.parts.values():
+            out.close()
+        self.parts = {}
+
+
+class RawTrack:
+    """原样保存的帧: .raw 负载, .idx 索引, .json 说明"""
+
+    def __init__(self, base, start_time, preallocate=0.0, use_mmap=False):
+        self.base = base
+        self.start_time = start_time
+        frames = int(preallocate / FRAME_DURATION)
+        # 按 48kHz 双声道 PCM 的大小预分配, 压缩编码时一块能用更久
+        self.data = OutputFile(base + ".raw", frames * frame_samples(DEFAULT_FORMAT.rate) * 4, use_mmap)
+        self.index = OutputFile(base + ".idx", frames * INDEX_ENTRY.size, use_mmap)
+        self.streams = {}
+        self.frames = 0
+        self.write_info()
+
+    def write_info(self):
+        # 预分配时 .idx 末尾可能有没用到的部分, 以这里的帧数为准
+        info = {"start_time": self.start_time, "frame_duration": FRAME_DURATION,
+                "index_format": INDEX_ENTRY.format, "index_fields": INDEX_FIELDS, "frames": self.frames,
+                "streams": {str(sender): stream for sender, stream in self.streams.items()}}
+        with open(self.base + ".json", "w", encoding="utf-8") as f:
+            json.dump(info, f, ensure_ascii=False, indent=2)
+
+    def write(self, entries):
+        """写入 [(时间槽, 发送者ID, 流名称, 帧), ...], 返回写入的字节数"""
+        if not entries:
+            return 0
+        offset = self.data.end
+        payloads = []
+        index = []
+        for slot, sender_id, stream, frame in entries:
+            self.streams[sender_id] = stream
+            payloads.append(frame.payload)
+            index.append(INDEX_ENTRY.pack(slot, sender_id, frame.seq, len(frame.payload), frame.timestamp,
+                                          frame.payload_type, offset))
+            offset += len(frame.payload)
+        written = self.data.write_at(self.data.end, b"".join(payloads))
+        written += self.index.write_at(self.index.end, b"".join(index))
+        self.data.flush()
+        self.index.flush()
+        self.frames += len(entries)
+        self.write_info()
+        return written
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class RoomRecording:
+    """一个房间的一段录音, 只在写线程中使用"""
+
+    def __init__(self, recorder, room, start):
+        self.recorder = recorder
+        self.room = room
+        # 时间槽 0 对应的到达时刻 (time.monotonic())
+        self.start = start
+        self.last_arrival = start
+        self.prefix = os.path.join(recorder.directory,
+                                   f"{file_name(room)}-{time.strftime('%Y%m%d-%H%M%S')}")
+        # 发送者ID -> [上一帧序列号, 上一帧时间槽]
+        self.senders = {}
+        # 键为 None (整个房间一个文件) 或发送者ID -> WavTrack / RawTrack
+        self.tracks = {}
+        # 等待写出的帧: wav 为 {键: {时间槽: PCM}}, 房间混音为 {时间槽: int32 累加}; raw 为 {键: [条目]}
+        self.pending = {}
+        self.mix = {}
+        # 房间混音已经写出到的时间槽 (不含)
+        self.written = 0
+        self.converters = {}
+
+    def slot(self, sender_id, seq, arrival):
+        """帧在时间线上的位置"""
+        now = round((arrival - self.start) / FRAME_DURATION)
+        last = self.senders.get(sender_id)
+        if last is None:
+            self.senders[sender_id] = [seq, now]
+            return now
+        diff = seq_diff(seq, last[0])
+        slot = last[1] + diff
+        if abs(slot - now) > REALIGN_FRAMES:
+            slot = now
+        elif diff <= 0:
+            # 乱序或重复的帧放回原来的位置, 不改变时间线
+            return slot
+        last[0] = seq
+        last[1] = slot
+        return slot
+
+    def add(self, arrival, sender_id, stream, frame):
+        """加入一帧, 返回是否保留 (太迟的帧丢弃)"""
+        self.last_arrival = max(self.last_arrival, arrival)
+        slot = self.slot(sender_id, frame.seq, arrival)
+        if slot < 0:
+            return False
+        recorder = self.recorder
+        key = sender_id if recorder.mode == "speaker" else None
+        if recorder.file_format == "raw":
+            self.pending.setdefault(key, []).append((slot, sender_id, stream, frame))
+            return True
+        if frame.payload_type != PT_AUDIO:
+            # 舒适噪声描述帧不写, 静音期间是空洞
+            return True
+        pcm = recorder.codecs[stream].decode(frame.payload)
+        if key is not None:
+            self.pending.setdefault(key, {})[slot] = (stream_format(stream), pcm)
+            return True
+        if slot < self.written:
+            return False
+        pcm = self.convert(sender_id, stream_format(stream), DEFAULT_FORMAT, pcm)
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        mixed = self.mix.get(slot)
+        if mixed is None:
+            mixed = self.mix[slot] = np.zeros(frame_samples(DEFAULT_FORMAT.rate) * DEFAULT_FORMAT.channels,
+                                              dtype=np.int32)
+        n = min(len(samples), len(mixed))
+        mixed[:n] += samples[:n]
+        return True
+
+    def track(self, key, fmt=DEFAULT_FORMAT):
+        track = self.tracks.get(key)
+        if track is None:
+            recorder = self.recorder
+            name = self.prefix if key is None else f"{self.prefix}-{key}"
+            if recorder.file_format == "raw":
+                track = RawTrack(name, time.time() - (time.monotonic() - self.start),
+                                 recorder.preallocate, recorder.use_mmap)
+            else:
+                track = WavTrack(name + ".wav", fmt, recorder.preallocate, recorder.use_mmap)
+            self.tracks[key] = track
+        return track
+
+    def flush(self, now, final=False):
+        """写出已经可以写的帧, 返回写入的字节数"""
+        written = 0
+        for key, frames in self.pending.items():
+            if self.recorder.file_format == "raw":
+                written += self.track(key).write(frames)
+            elif frames:
+                track = self.track(key, next(iter(frames.values()))[0])
+                # 重采样器带状态, 按时间槽的顺序转换
+                written += track.write({slot: self.convert(key, fmt, track.fmt, pcm)
+                                        for slot, (fmt, pcm) in sorted(frames.items())})
+        self.pending = {}
+        if self.mix:
+            limit = round((now - self.start - SETTLE_DELAY) / FRAME_DURATION)
+            if final:
+                limit = max(self.mix) + 1
+            ready = {slot: np.clip(self.mix.pop(slot), -32768, 32767).astype(np.int16).tobytes()
+                     for slot in [s for s in self.mix if s < limit]}
+            if ready:
+                written += self.track(None).write(ready)
+            self.written = max(self.written, limit)
+        return written
+
+    def convert(self, key, source, target, pcm):
+        """把一帧 PCM 转成目标格式, 每个 (键, 源格式) 一个转换器"""
+        if source == target:
+            return pcm
+        converter = self.converters.get((key, source))
+        if converter is None:
+            converter = self.converters[(key, source)] = StreamConverter(source, target)
+        return converter.convert(pcm)
+
+    def close(self):
+        for track in self.tracks.values():
+            track.close()
+        self.tracks = {}
+
+
+class SessionRecorder:
+    """服务器端录音, 写线程在创建时启动
+
+    rooms 为要录音的房间名集合, None 表示所有房间。指标注册到 registry。
+    """
+
+    def __init__(self, directory, registry, rooms=None, mode="room", file_format="wav", preallocate=0.0,
+                 use_mmap=False, max_backlog=MAX_BACKLOG):
+        if mode not in RECORD_MODES:
+            raise ValueError(f"未知的录音方式: {mode}")
+        if file_format not in RECORD_FORMATS:
+            raise ValueError(f"未知的录音文件格式: {file_format}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.rooms = set(rooms) if rooms is not None else None
+        self.mode = mode
+        self.file_format = file_format
+        self.use_mmap = use_mmap
+        self.preallocate = preallocate or (MMAP_CHUNK_SECONDS if use_mmap else 0.0)
+        self.max_backlog = max_backlog
+        self.codecs = StreamCodecs()
+        # (到达时刻, 房间名, 发送者ID, 流名称, 帧); deque 的两端操作是线程安全的
+        self.queue = deque()
+        self.wake = threading.Event()
+        self.stopping = False
+        # 房间名 -> RoomRecording, 只在写线程中使用
+        self.recordings = {}
+        self.open_files = 0
+
+        m = registry
+        self.frames = m.counter("voicechat_recorder_frames_total", "写入录音的帧数")
+        self.bytes_written = m.counter("voicechat_recorder_bytes_written_total", "写入录音文件的字节数")
+        drops = m.counter("voicechat_recorder_drops_total", "没有写入录音的帧数, 按原因", ["reason"])
+        # backlog: 写线程跟不上, 队列满; late: 房间混音的时间槽已经写出; decode: 帧数据无法解码
+        self.drops = {reason: drops.labels(reason) for reason in ("backlog", "late", "decode")}
+        self.batch_seconds = m.histogram("voicechat_recorder_batch_seconds", "写线程处理一批帧的耗时")
+        m.gauge("voicechat_recorder_backlog_frames", "等待写线程处理的帧数", function=lambda: len(self.queue))
+        m.gauge("voicechat_recorder_open_files", "正在写入的录音文件数", function=lambda: self.open_files)
+        self.last_stats = {}
+        self.last_stats_time = time.monotonic()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        # 正常退出时写出剩余的帧并截掉预分配多出的部分
+        atexit.register(self.close)
+
+    def record(self, room, sender_id, stream, frame, arrival=None):
+        """在数据路径上调用: 只把帧放入队列, 不阻塞
+
+        stream 为发送者的流名称 (编码和采集格式), arrival 为到达时刻 (time.monotonic()),
+        默认取当前时间。
+        """
+        if self.rooms is not None and room not in self.rooms:
+            return
+        if len(self.queue) >= self.max_backlog:
+            self.drops["backlog"].inc()
+            return
+        self.queue.append((time.monotonic() if arrival is None else arrival, room, sender_id, stream, frame))
+        if len(self.queue) >= BATCH_FRAMES:
+            self.wake.set()
+
+    def run(self):
+        """写线程"""
+        while not self.stopping:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self.process()
+            except Exception as e:
+                print(f"录音出错: {e}")
+        self.process(final=True)
+
+    def process(self, final=False):
+        """处理队列里的帧并写出, 只在写线程中调用"""
+        start = time.perf_counter()
+        count = len(self.queue)
+        kept = 0
+        for _ in range(count):
+            arrival, room, sender_id, stream, frame = self.queue.popleft()
+            recording = self.recordings.get(room)
+            if recording is None:
+                recording = self.recordings[room] = RoomRecording(self, room, arrival)
+            try:
+                added = recording.add(arrival, sender_id, stream, frame)
+            except ValueError:
+                self.drops["decode"].inc()
+                continue
+            if added:
+                kept += 1
+            else:
+                self.drops["late"].inc()
+        now = time.monotonic()
+        written = 0
+        for room, recording in list(self.recordings.items()):
+            written += recording.flush(now, final)
+            if final or now - recording.last_arrival > IDLE_TIMEOUT:
+                recording.close()
+                del self.recordings[room]
+        self.open_files = sum(len(r.tracks) for r in self.recordings.values())
+        self.frames.inc(kept)
+        self.bytes_written.inc(written)
+        if count or written:
+            self.batch_seconds.observe(time.perf_counter() - start)
+
+    def close(self):
+        """停止写线程, 写出剩余的帧并关闭所有文件"""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+
+    def take_stats(self):
+        """返回上次调用以来的统计"""
+        now = time.monotonic()
+        values = {"frames": self.frames.value(), "bytes": self.bytes_written.value(),
+                  "dropped": sum(counter.value() for counter in self.drops.values())}
+        stats = {name: value - self.last_stats.get(name, 0) for name, value in values.items()}
+        stats["seconds"] = now - self.last_stats_time
+        stats["backlog"] = len(self.queue)
+        stats["files"] = self.open_files
+        self.last_stats = values
+        self.last_stats_time = now
+        return stats
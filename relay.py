@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+"""服务器之间的中继
+
+一个服务器进程既是容量上限也是单点故障。中继模式下多个服务器 (节点) 用 TCP
+连接互相转发房间里的音频, 同一个房间的成员可以分散在不同的节点上:
+
+- 每个节点有自己的节点号 (--node-id), 分配给客户端的ID高 8 位是节点号,
+  跨节点转发后仍然不会重复;
+- 中继连接两端用 RELAY 消息告诉对方自己需要哪些房间: 本节点有成员的房间, 加上
+  其他中继连接需要的房间 (不把对方自己要的房间再报回去), 因此可以串成链或树;
+- 一帧对每条需要该房间的中继连接只发一次, 不管对方节点上有多少个成员;
+- 收到的帧在本节点转发给房间成员, 再转给其他需要该房间的中继连接, 但不发回
+  来源连接。节点按 (发送者ID, 序列号) 丢弃重复和迟到的帧, 自己节点发出的帧转
+  一圈回来时也直接丢弃, 连成环也不会无限转发。
+
+中继连接在服务器内部和普通客户端连接一样收发 (线程引擎的收发线程或事件循环),
+只是不属于任何房间, 只通过私有发送队列接收中继帧。
+"""
+
+import socket
+import threading
+import time
+
+from protocol import (encode_control, encode_frame, decode_control, decode_room_frame,
+                      encode_room_frame, seq_diff, NODE_ID_SHIFT, PT_RELAY, PT_RELAY_FRAME)
+
+# 连不上对端时的重试间隔, 秒
+RETRY_INTERVAL = 2.0
+# 中继连接要承载整个房间的帧, 发送队列比普通客户端长
+RELAY_QUEUE_SIZE = 256
+# 发送者这么久没有帧转过来就丢掉它的去重记录, 秒
+SEQ_EXPIRE = 10.0
+
+
+def parse_peer(value):
+    """把 HOST:PORT 解析成地址元组"""
+    host, _, port = value.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+class RelayManager:
+    """一个节点的所有中继连接"""
+
+    def __init__(self, server, node_id, peers=()):
+        self.server = server
+        self.node_id = node_id
+        self.peers = list(peers)
+        # 中继连接 -> 对端需要的房间集合, 对端节点号
+        self.wanted = {}
+        self.nodes = {}
+        # 中继连接 -> 上一次发给对端的房间集合, 没有变化时不重发
+        self.announced = {}
+        # 主动连接的对端地址 -> 连接
+        self.peer_conns = {}
+        # 每个发送者最后转发的序列号和时间, 用于去重, prune() 定期清掉不再发送的
+        self.last_seq = {}
+        self.lock = threading.Lock()
+        self.stats = {"received": 0, "sent": 0, "duplicates": 0}
+
+    def start(self):
+        for addr in self.peers:
+            threading.Thread(target=self.dial_loop, args=(addr,), daemon=True).start()
+
+    def dial_loop(self, addr):
+        """保持到一个对端的连接, 断开后按间隔重连"""
+        failed = False
+        while True:
+            if self.peer_conns.get(addr) is None:
+                try:
+                    sock = socket.create_connection(addr, timeout=3)
+                    sock.settimeout(None)
+                    self.server.configure_client_socket(sock)
+                    print(f"已连接中继节点: {addr[0]}:{addr[1]}")
+                    failed = False
+                    self.server.start_peer(sock, addr)
+                except OSError as e:
+                    if not failed:
+                        print(f"无法连接中继节点 {addr[0]}:{addr[1]}: {e}")
+                        failed = True
+            time.sleep(RETRY_INTERVAL)
+
+    def is_relay(self, c):
+        return c in self.wanted
+
+    def attach(self, c, addr=None):
+        """把一个连接登记为中继连接, 调用方持有服务器锁"""
+        if c in self.wanted:
+            return
+        # 中继连接不属于任何房间
+        self.server.leave_room_locked(c)
+        self.server.resize_queue(c, RELAY_QUEUE_SIZE)
+        self.wanted[c] = set()
+        self.nodes[c] = None
+        if addr is not None:
+            self.peer_conns[addr] = c
+        self.announce_locked()
+
+    def detach(self, c):
+        """移除中继连接, 调用方持有服务器锁"""
+        if c not in self.wanted:
+            return
+        del self.wanted[c]
+        self.nodes.pop(c, None)
+        self.announced.pop(c, None)
+        for addr in [a for a, conn in self.peer_conns.items() if conn is c]:
+            del self.peer_conns[addr]
+        self.announce_locked()
+
+    def handle_hello(self, c, payload):
+        """收到对端的 RELAY 消息: 登记连接并更新对端需要的房间"""
+        message = decode_control(payload)
+        with self.server.lock:
+            if c not in self.wanted:
+                print(f"中继节点 {message.get('node')} 已连接")
+                self.attach(c)
+            self.nodes[c] = message.get("node")
+            self.wanted[c] = set(message.get("rooms") or ())
+            # 其他连接需要的房间跟着变了, 需要的话重新通告
+            self.announce_locked()
+
+    def announce_locked(self):
+        """向每条中继连接通告需要的房间, 调用方持有服务器锁"""
+        local = set(self.server.active_rooms_locked())
+        for c in list(self.wanted):
+            rooms = set(local)
+            for other, wanted in self.wanted.items():
+                if other is not c:
+                    rooms |= wanted
+            if self.announced.get(c) == rooms:
+                continue
+            self.announced[c] = rooms
+            message = {"node": self.node_id, "rooms": sorted(rooms)}
+            self.server.queue_packet(c, encode_control(PT_RELAY, message))
+
+    def targets(self, source, room):
+        """需要该房间的中继连接, 不含 source"""
+        return [c for c, wanted in list(self.wanted.items()) if c is not source and room in wanted]
+
+    def publish(self, room, codec, packet):
+        """把本节点客户端的一帧转给需要该房间的中继连接"""
+        targets = self.targets(None, room)
+        if targets:
+            self.send(targets, encode_room_frame(room, codec, packet))
+
+    def send(self, targets, body):
+        message = encode_frame(body, payload_type=PT_RELAY_FRAME)
+        for c in targets:
+            self.server.queue_packet(c, message)
+        with self.lock:
+            self.stats["sent"] += len(targets)
+
+    def handle_frame(self, c, payload):
+        """处理对端转来的一帧: 去重后在本节点转发, 再原样转给其他中继连接"""
+        room, codec, frame = decode_room_frame(payload)
+        sender_id = frame.sender_id
+        with self.lock:
+            self.stats["received"] += 1
+            last = self.last_seq.get(sender_id)
+            # 自己节点的帧绕回来, 或者从另一条路径已经收到过
+            if (sender_id >> NODE_ID_SHIFT == self.node_id
+                    or (last is not None and seq_diff(frame.seq, last[0]) <= 0)):
+                self.stats["duplicates"] += 1
+                return
+            self.last_seq[sender_id] = (frame.seq, time.monotonic())
+        self.server.deliver_remote(room, codec, frame)
+        targets = self.targets(c, room)
+        if targets:
+            self.send(targets, payload)
+
+    def prune(self, now):
+        """丢掉超过 SEQ_EXPIRE 没有帧的发送者的去重记录, 由服务器的周期检查调用"""
+        with self.lock:
+            stale = [s for s, (_, at) in self.last_seq.items() if now - at >= SEQ_EXPIRE]
+            for sender_id in stale:
+                del self.last_seq[sender_id]
+
+    def take_stats(self):
+        """返回并清零统计"""
+        with self.lock:
+            stats = dict(self.stats)
+            for key in self.stats:
+                self.stats[key] = 0
+        stats["links"] = len(self.wanted)
+        return stats
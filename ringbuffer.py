@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+"""预分配的单生产者/单消费者环形缓冲区
+
+音频在两端原来都是每帧新建一个 bytes 对象, 经 queue.Queue 和列表传递。这里用一个
+预先分配好的 int16 二维数组作为固定数量的槽位, 每个槽位存一帧 (长度不超过槽位
+大小的任意字节), 生产者和消费者都通过槽位的 memoryview 直接读写, 稳定运行后
+不再为帧数据分配内存。
+
+缓冲区满时新的帧覆盖最旧的帧。生产者和消费者各自只修改自己的下标, 不需要锁
+(依赖 GIL 保证单个属性读写的原子性); 多个线程往同一个缓冲区写时由调用方串行化。
+消费者用 peek() / peek_many() 取得槽位的视图后, 在 release() 之前这些槽位不会
+被覆盖: 双方先声明自己要占用的条目再检查对方, 冲突时生产者放弃这次写入。
+"""
+
+import numpy as np
+
+
+class RingBuffer:
+    """固定容量的帧环形缓冲区
+
+    每个条目除了数据外还可以附带一个任意的 tag (例如帧头信息)。
+    """
+
+    def __init__(self, slots, slot_bytes, dtype=np.int16):
+        self.slots = slots
+        itemsize = np.dtype(dtype).itemsize
+        self.slot_bytes = (slot_bytes + itemsize - 1) // itemsize * itemsize
+        self.data = np.zeros((slots, self.slot_bytes // itemsize), dtype=dtype)
+        # 每个槽位按字节访问的视图, 只创建一次
+        self.views = [memoryview(row).cast("B") for row in self.data]
+        self.lengths = [0] * slots
+        self.tags = [None] * slots
+
+        # 下标单调递增, 条目 i 存放在槽位 i % slots
+        self.write_index = 0
+        self.read_index = 0
+        # 生产者正在写入的条目, 消费者正在使用的第一个条目, -1 表示没有
+        self.writing = -1
+        self.pinned = -1
+        # 消费者正在使用的条目之后的下标, release() 时读下标移到这里
+        self.pinned_end = -1
+
+        self.written = 0
+        self.overwritten = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def depth(self):
+        """当前缓冲的条目数"""
+        return max(0, min(self.slots, self.write_index - self.read_index))
+
+    def reserve(self):
+        """生产者: 取得下一个槽位的可写视图, 写完后调用 commit()
+
+        缓冲区已满且要覆盖的条目正被消费者使用时返回 None, 这次写入放弃。
+        """
+        w = self.write_index
+        self.writing = w
+        pinned = self.pinned
+        if pinned >= 0 and w - self.slots >= pinned:
+            self.writing = -1
+            self.rejected += 1
+            return None
+        return self.views[w % self.slots]
+
+    def commit(self, nbytes, tag=None):
+        """生产者: 提交 reserve() 取得的槽位, 返回因此被覆盖的旧条目数 (0 或 1)"""
+        w = self.writing
+        i = w % self.slots
+        self.lengths[i] = nbytes
+        self.tags[i] = tag
+        lost = 1 if w - self.read_index >= self.slots else 0
+        self.write_index = w + 1
+        self.writing = -1
+
+        self.written += 1
+        self.overwritten += lost
+        depth = self.write_index - self.read_index
+        if depth > self.max_depth:
+            self.max_depth = min(depth, self.slots)
+        return lost
+
+    def abort(self):
+        """生产者: 放弃 reserve() 取得的槽位"""
+        self.writing = -1
+
+    def write(self, data, tag=None):
+        """生产者: 复制一帧进缓冲区, 返回因此丢掉的条目数 (0 或 1)
+
+        超过槽位大小或者无法写入时丢掉的是这一帧本身。
+        """
+        n = len(data)
+        if n > self.slot_bytes:
+            self.rejected += 1
+            return 1
+        view = self.reserve()
+        if view is None:
+            return 1
+        view[:n] = data
+        return self.commit(n, tag)
+
+    def peek(self):
+        """消费者: 返回队头条目 (数据视图, tag), 没有数据时返回 None
+
+        视图在 release() 之前有效; 已经被生产者覆盖的条目直接跳过。
+        """
+        while True:
+            w = self.write_index
+            r = self.read_index
+            if r < w - self.slots:
+                r = self.read_index = w - self.slots
+            if r >= w:
+                return None
+            self.pinned = r
+            # 声明占用后再确认生产者没有正在或已经覆盖这个条目
+            if self.writing >= r + self.slots or self.write_index > r + self.slots:
+                self.pinned = -1
+                self.read_index = r + 1
+                continue
+            self.pinned_end = r + 1
+            i = r % self.slots
+            return self.views[i][:self.lengths[i]], self.tags[i]
+
+    def peek_many(self, limit=None):
+        """消费者: 返回从队头开始所有已提交条目的数据视图列表, 没有数据时返回空列表
+
+        用于一次系统调用发出多个帧; 视图在 release() 之前有效。
+        """
+        if self.peek() is None:
+            return []
+        r = self.pinned
+        end = self.write_index
+        if limit is not None:
+            end = min(end, r + limit)
+        self.pinned_end = end
+        views = []
+        for index in range(r, end):
+            i = index % self.slots
+            views.append(self.views[i][:self.lengths[i]])
+        return views
+
+    def release(self):
+        """消费者: 用完 peek() / peek_many() 返回的条目后调用"""
+        if self.pinned >= 0:
+            self.read_index = self.pinned_end
+            self.pinned = -1
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+"""房间
+
+服务器上的客户端按房间分组, 音频只在同一房间的成员之间转发或混音, 不同房间
+互不影响。每个房间有自己的成员集合、广播帧日志、混音器 (混音模式)、活跃说话人选择
+(转发模式下可选) 和统计。
+"""
+
+from audioformat import stream_format
+from framelog import FrameLog
+
+DEFAULT_ROOM = "default"
+# 房间名最大长度, 超出部分截断
+MAX_ROOM_NAME = 64
+
+
+def room_name(value):
+    """规范化客户端给出的房间名, 无效时使用默认房间"""
+    if not isinstance(value, str):
+        return DEFAULT_ROOM
+    value = value.strip()[:MAX_ROOM_NAME]
+    return value or DEFAULT_ROOM
+
+
+class Room:
+    """一个房间的成员和转发状态
+
+    members 只在持有服务器锁时修改, 数据路径上取 list() 副本遍历。
+    """
+
+    def __init__(self, name, mix=False, active_speakers=0):
+        self.name = name
+        self.members = set()
+        self.frame_log = FrameLog()
+        self.mixer = None
+        if mix:
+            from mixer import Mixer
+            # 混音统一在 48kHz 双声道下进行, 其他格式的输入和输出由服务器转换
+            self.mixer = Mixer(frame_samples=1024 * 2)
+        # 混音时每个收听者本来就只收一路, 只在转发模式下选择说话人
+        self.speakers = None
+        if active_speakers and not mix:
+            from speakers import ActiveSpeakers
+            self.speakers = ActiveSpeakers(active_speakers)
+        # 成员的播放格式集合, 转发时按这些格式转换; 由服务器锁保护, 更新时整体替换
+        self.formats = frozenset()
+        # 帧日志不用时 (asyncio 引擎) 转发计数记在这里, 由服务器锁保护
+        self.stats = {"frames": 0, "dropped": 0, "mixed_frames": 0}
+
+    def update_formats(self, client_codecs):
+        """按成员接收的流重新计算播放格式集合, 调用方持有服务器锁"""
+        self.formats = frozenset(stream_format(client_codecs.get(c, "pcm")) for c in self.members)
+
+    def take_stats(self):
+        """返回并清零本房间的统计, 调用方持有服务器锁"""
+        stats = dict(self.stats)
+        for key in self.stats:
+            self.stats[key] = 0
+        log_stats = self.frame_log.take_stats()
+        stats["frames"] += log_stats["frames"]
+        stats["dropped"] += log_stats["dropped"]
+        return stats
@@ -1,17 +1,38 @@
 #!/usr/bin/python3
 
 import socket
+import math
 import threading
 import time
-import queue
 import sys
+import itertools
+import argparse
+import secrets
+import signal
+
+from protocol import (FrameDecoder, encode_frame, encode_control, decode_control,
+                      decode_datagram, seq_diff, PT_AUDIO, PT_HELLO, PT_WELCOME,
+                      PT_UDP_REGISTER, PT_JOIN, PT_RELAY, PT_RELAY_FRAME, PT_CN, HEADER_SIZE,
+                      PT_PING, PT_PONG, PT_CODEC, PT_REPORT, MAX_NODE_ID, NODE_ID_SHIFT, HEADER, decode_cn,
+                      decode_ping, encode_pong, ProtocolError)
+from codec import negotiate_codec
+from audioformat import (DEFAULT_FORMAT, FRAME_DURATION, StreamCodecs, StreamConverter, format_message,
+                         parse_format, stream_format, stream_frame_bytes, stream_name, valid_stream)
+from ringbuffer import RingBuffer
+from rooms import DEFAULT_ROOM, Room, room_name
+from vad import VoiceActivityDetector, level_db
+from metrics import Registry, DEPTH_BUCKETS, serve_metrics
+from recorder import RECORD_FORMATS, RECORD_MODES, SessionRecorder
+from backpressure import (BACKPRESSURE_ACTIONS, EVAL_INTERVAL, SLOW_POLICIES, BackpressurePolicy,
+                          ClientPressure, downgrade_ladder, send_buffer_size, unsent_bytes)
+from congestion import POLICY_HOLD, REPORT_INTERVAL, StreamMonitor, median, parse_stream_message, send_ladder
 
 class Server:
-    def __init__(self):
+    def __init__(self, ip="0.0.0.0", port=2000, mix=False, udp=False, reuse_port=False, vad=False,
+                 active_speakers=0):
             # 使用0.0.0.0表示监听所有可用的网络接口，包括局域网
-            self.ip = "0.0.0.0"
-            # 可选：使用127.0.0.1仅监听本机连接
-            # self.ip = "127.0.0.1"
+            self.ip = ip
+            # 可选：传入127.0.0.1仅监听本机连接 (--host 127.0.0.1)
             
             try:
                 print("可用的IP地址:")
@@ -19,18 +40,19 @@ class Server:
                 ip_list = socket.gethostbyname_ex(hostname)[2]
                 for i, ip in enumerate(ip_list):
                     print(f"{i+1}. {ip}")
-                print(f"服务器将监听所有网络接口 (0.0.0.0)")
+                print(f"服务器将监听: {self.ip}")
             except Exception as e:
                 print(f"获取IP地址时出错: {e}")
                 print("继续使用0.0.0.0作为监听地址")
             
             while 1:
                 try:
-                    self.port = 2000
-
                     self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                     # 设置套接字选项，允许地址重用
                     self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    if reuse_port:
+                        # 多进程模式: 所有工作进程监听同一个端口, 由内核分配连接
+                        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                     # 增加接收缓冲区大小
                     self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)  # 增加到128KB
                     self.s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)  # 增加到128KB
@@ -39,7 +61,9 @@ class Server:
                         self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                     except:
                         print("无法设置TCP_NODELAY，继续执行")
-                    self.s.bind((self.ip, self.port))
+                    self.s.bind((self.ip, port))
+                    # 端口传0时由系统分配, 这里取实际端口
+                    self.port = self.s.getsockname()[1]
 
                     break
                 except Exception as e:
@@ -49,37 +73,241 @@ class Server:
             self.connections = []
             # 为每个客户端创建一个队列字典，键为客户端socket，值为队列
             self.client_queues = {}
+            # 每个客户端一个事件, 有数据放入发送队列或广播日志时唤醒对应的发送线程
+            self.client_events = {}
+            # 房间名 -> 房间, 客户端 -> 所在房间; 音频只在同一房间内转发或混音
+            # 转发的音频帧只追加一次到所在房间的广播日志, 各发送线程按自己的游标读取
+            self.rooms = {}
+            self.client_rooms = {}
+            # 每个客户端的连接ID, 转发时写入帧头的发送者ID
+            self.client_ids = {}
+            self.next_client_id = itertools.count(1)
+            # 每个客户端待发送队列的长度，增加到20提供更多缓冲
+            self.queue_size = 20
+            # 发送队列是预分配的环形缓冲区, 每个槽位能放下的最大帧 (帧头+负载), 更大的帧丢弃
+            self.queue_slot_bytes = HEADER_SIZE + 8192
+            # 转发、混音和控制消息都可能写发送队列, 环形缓冲区只有一个生产者端, 写入时串行化
+            self.queue_lock = threading.Lock()
+            # 每个客户端接收的流 (协商的编码和播放格式) 和发送的流 (编码和采集格式),
+            # 用 audioformat.stream_name 表示; 没有握手的客户端按 48kHz 双声道原始PCM处理
+            self.client_codecs = {}
+            self.client_sources = {}
+            # 编解码器都是无状态的, 所有连接共用, 按流名称第一次用到时创建
+            self.codecs = StreamCodecs()
+            # 格式转换器带状态 (重采样的历史采样), 键为 (所有者, 源格式, 目标格式),
+            # 所有者是发送者ID或混音输出, 每个键只在一个线程里使用
+            self.converters = {}
             # 添加锁以保护共享资源
             self.lock = threading.Lock()
-            # 统计信息
-            self.stats = {
-                "total_packets": 0,
-                "dropped_packets": 0
-            }
+            # 统计信息, 帧数、丢弃数和混音帧数按房间统计; 其余计数见 init_metrics()
+            self.init_metrics()
+            # 每个客户端上一次发送时积压的帧数, 由线程引擎的发送线程更新
+            self.client_backlog = {}
+            # 每个客户端在 PING 里报告的 (往返时间, 时钟偏差); 报告过的客户端发来的时间戳是服务器时钟
+            self.client_clocks = {}
+            
+            # 服务器端语音活动检测: 对自己不做检测的客户端, 静音帧不转发也不混音
+            self.vad = vad
+            self.client_vads = {}
+            # 转发模式下每个房间只转发最活跃的几路, 0 表示全部转发
+            self.active_speakers = active_speakers
+            # 慢速接收方的处理策略, 以及每个客户端的发送压力 (backpressure.ClientPressure)
+            self.backpressure = BackpressurePolicy(queue_size=self.queue_size)
+            self.client_pressure = {}
+            # 自适应码率 (congestion.py): 每个客户端的上行统计 (StreamMonitor), 每 REPORT_INTERVAL 秒
+            # 随报告发给客户端; 发送者ID -> {接收方ID: (丢包率, 抖动, 报告时刻)}, 来自接收方的报告
+            self.client_uplinks = {}
+            self.peer_reports = {}
+            # 发送者ID -> 最近一次因活跃说话人选择没有转发它的帧的时刻; 这类按策略少转发的帧
+            # 在收听者那边也是序列号空洞, 不是网络丢包, 不能算进发送者的 peers 丢包率
+            self.filtered_at = {}
+            # 收报告的客户端可能改用的发送流, 帧长 -> 流名称, 用来认出和 CODEC 控制帧乱序的音频帧
+            self.client_send_streams = {}
+            self.reported_at = time.monotonic()
+            
+            # UDP音频传输: TCP只用于握手和控制帧, 音频走同端口号的UDP
+            self.udp = None
+            if udp:
+                self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+                self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)
+                # 多进程模式下每个进程用系统分配的UDP端口, 保证一个客户端的数据报都到同一个进程
+                self.udp.bind((self.ip, 0 if reuse_port else self.port))
+                self.udp_port = self.udp.getsockname()[1]
+            # 客户端 -> UDP地址, UDP地址 -> 客户端, 注册令牌 -> 客户端
+            self.udp_addrs = {}
+            self.udp_clients = {}
+            self.udp_tokens = {}
+            # 每个UDP客户端最后收到的序列号, 用于丢弃迟到和重复的数据报
+            self.udp_last_seq = {}
+            
+            # 混音模式: 服务器把每个房间的说话人混成一路, 每个节拍给每个客户端发一帧
+            self.mix = mix
+            # 混音节拍, 与客户端每帧的时长 (48kHz 下1024个采样) 一致
+            self.frame_interval = FRAME_DURATION
+            self.mix_lock = threading.Lock()
+            self.mix_seq = 0
+            
+            # 多进程模式下与其他工作进程之间的总线 (workers.WorkerBus), 单进程时为 None
+            self.bus = None
+            # 中继模式下与其他服务器节点之间的连接 (relay.RelayManager), 不启用时为 None
+            self.relay = None
+            # 服务器端录音 (recorder.SessionRecorder), 不启用时为 None
+            self.recorder = None
             
             # 启动统计信息线程
             threading.Thread(target=self.print_stats, daemon=True).start()
-            
-            self.accept_connections()
+
+    def serve_forever(self):
+        """运行服务器主循环, 线程引擎即为accept循环"""
+        if self.mix:
+            threading.Thread(target=self.mix_loop, daemon=True).start()
+        if self.udp:
+            threading.Thread(target=self.handle_udp_receive, daemon=True).start()
+        if self.bus:
+            threading.Thread(target=self.bus.run, daemon=True).start()
+        if self.relay:
+            self.relay.start()
+        threading.Thread(target=self.backpressure_loop, daemon=True).start()
+        self.accept_connections()
+
+    def init_metrics(self):
+        """创建运行指标, 数据路径上使用的指标对象缓存为属性"""
+        m = self.metrics = Registry()
+        frames_in = m.counter("voicechat_frames_in_total", "收到的帧数", ["type"])
+        self.frames_in = {PT_AUDIO: frames_in.labels("audio"), PT_CN: frames_in.labels("cn")}
+        self.control_frames_in = frames_in.labels("control")
+        self.bytes_in = m.counter("voicechat_bytes_in_total", "收到的帧字节数 (含帧头)")
+        self.frames_out = m.counter("voicechat_frames_out_total", "发给客户端的帧数")
+        self.bytes_out = m.counter("voicechat_bytes_out_total", "发给客户端的字节数")
+        drops = m.counter("voicechat_drops_total", "没有发出或没有转发的帧数, 按原因", ["reason"])
+        self.drops = {reason: drops.labels(reason)
+                      for reason in ("queue_full", "late", "vad", "inactive_speaker", "udp_send",
+                                     "slow_consumer", "stream_limit", "decode")}
+        actions = m.counter("voicechat_backpressure_actions_total",
+                            "对慢速接收方的处理次数, 按动作", ["action"])
+        self.backpressure_actions = {action: actions.labels(action) for action in BACKPRESSURE_ACTIONS}
+        self.send_seconds = m.histogram("voicechat_send_seconds", "一次发送系统调用的耗时")
+        self.fanout_seconds = m.histogram("voicechat_fanout_seconds",
+                                          "处理一个音频帧的耗时 (检测、转码、分发到房间成员)")
+        self.queue_depth_frames = m.histogram("voicechat_queue_depth_frames",
+                                              "每次发送时该客户端积压的帧数", buckets=DEPTH_BUCKETS)
+        self.rtt_seconds = m.histogram("voicechat_rtt_seconds", "客户端报告的与服务器之间的往返时间")
+        self.uplink_delay_seconds = m.histogram("voicechat_uplink_delay_seconds",
+                                                "音频帧从客户端采集到服务器收到的时间 (只统计已完成时钟同步的客户端)")
+        m.gauge("voicechat_client_rtt_seconds", "每个客户端最近报告的往返时间", ["client"],
+                function=lambda: [((self.client_ids.get(c, 0),), rtt)
+                                  for c, (rtt, _) in list(self.client_clocks.items())])
+        m.gauge("voicechat_client_clock_offset_seconds", "每个客户端报告的时钟偏差 (服务器时钟减去客户端时钟)",
+                ["client"], function=lambda: [((self.client_ids.get(c, 0),), offset)
+                                              for c, (_, offset) in list(self.client_clocks.items())])
+        m.gauge("voicechat_connections", "当前连接数", function=lambda: len(self.connections))
+        m.gauge("voicechat_rooms", "有成员的房间数", function=lambda: len(self.active_rooms()))
+        m.gauge("voicechat_client_queue_depth", "每个客户端当前积压的帧数", ["client"],
+                function=lambda: [((self.client_ids.get(c, 0),), self.queue_depth(c))
+                                  for c in list(self.client_queues)])
+        m.gauge("voicechat_client_send_blocked_ratio", "每个客户端上个评估周期里阻塞在发送上的时间比例",
+                ["client"], function=lambda: [((self.client_ids.get(c, 0),), p.blocked_ratio)
+                                              for c, p in list(self.client_pressure.items())])
+        m.gauge("voicechat_client_unsent_bytes", "每个客户端的内核发送缓冲区里未发出的字节数 (仅 Linux)",
+                ["client"], function=lambda: [((self.client_ids.get(c, 0),), p.unsent)
+                                              for c, p in list(self.client_pressure.items())])
+        m.gauge("voicechat_client_downgrade_level", "每个客户端当前的降级级别, 0 表示没有降级",
+                ["client"], function=lambda: [((self.client_ids.get(c, 0),), p.level)
+                                              for c, p in list(self.client_pressure.items())])
+        m.gauge("voicechat_client_uplink_loss_ratio", "每个客户端上一个报告周期的上行丢包率", ["client"],
+                function=lambda: [((self.client_ids.get(c, 0),), u.last[0])
+                                  for c, u in list(self.client_uplinks.items()) if u.last])
+        m.gauge("voicechat_client_uplink_delay_seconds", "每个客户端上一个报告周期的上行排队延迟估计", ["client"],
+                function=lambda: [((self.client_ids.get(c, 0),), u.last[2])
+                                  for c, u in list(self.client_uplinks.items()) if u.last])
+        m.gauge("voicechat_client_uplink_bitrate", "每个客户端上一个报告周期服务器收到的码率 (bit/s)", ["client"],
+                function=lambda: [((self.client_ids.get(c, 0),), u.last[3] or 0)
+                                  for c, u in list(self.client_uplinks.items()) if u.last])
+        m.gauge("voicechat_slow_clients", "当前处于拥塞状态的客户端数",
+                function=lambda: sum(p.congested for p in list(self.client_pressure.values())))
+
+    def queue_depth(self, c):
+        """客户端当前积压的帧数"""
+        return self.client_backlog.get(c, 0)
 
     def print_stats(self):
-        """定期打印服务器统计信息"""
+        """定期打印服务器统计信息, 计数器打印的是与上一次的差值"""
+        last = {}
+
+        def delta(name, counter):
+            value = counter.value()
+            diff = value - last.get(name, 0)
+            last[name] = value
+            return diff
+
         while True:
             time.sleep(10)  # 每10秒打印一次
             try:
+                late = delta("late", self.drops["late"])
+                vad_skipped = delta("vad", self.drops["vad"])
+                cn_frames = delta("cn", self.frames_in[PT_CN])
+                skipped = delta("inactive", self.drops["inactive_speaker"])
+                actions = {action: delta(action, counter) for action, counter in self.backpressure_actions.items()}
+                slow_dropped = delta("slow_consumer", self.drops["slow_consumer"])
+                stream_limited = delta("stream_limit", self.drops["stream_limit"])
                 with self.lock:
-                    total = self.stats["total_packets"]
-                    dropped = self.stats["dropped_packets"]
+                    room_stats = {name: room.take_stats() for name, room in self.rooms.items()}
+                    total = sum(st["frames"] for st in room_stats.values())
+                    dropped = sum(st["dropped"] for st in room_stats.values())
                     if total > 0:
                         drop_rate = (dropped / total) * 100
                     else:
                         drop_rate = 0
                     
-                    print(f"服务器统计: 总数据包: {total}, 丢弃: {dropped}, 丢包率: {drop_rate:.2f}%")
-                    print(f"当前连接数: {len(self.connections)}")
-                    # 重置统计
-                    self.stats["total_packets"] = 0
-                    self.stats["dropped_packets"] = 0
+                    print(f"服务器统计: 总帧数: {total}, 丢弃: {dropped}, 丢包率: {drop_rate:.2f}%")
+                    if self.udp:
+                        print(f"UDP客户端数: {len(self.udp_addrs)}, 迟到丢弃: {late}")
+                    if self.vad:
+                        print(f"服务器端VAD: {len(self.client_vads)}个客户端, 跳过静音帧: {vad_skipped}")
+                    if cn_frames:
+                        print(f"舒适噪声描述帧: {cn_frames}")
+                    if self.mix:
+                        mixed = sum(st["mixed_frames"] for st in room_stats.values())
+                        backlog = sum(room.mixer.dropped for room in self.rooms.values())
+                        print(f"混音输出帧数: {mixed}, 混音积压丢弃: {backlog}")
+                    if self.active_speakers and not self.mix:
+                        switches = sum(room.speakers.take_stats()["switches"] for room in self.rooms.values())
+                        print(f"活跃说话人: 每个房间最多 {self.active_speakers} 路, "
+                              f"未转发帧数: {skipped}, 切换次数: {switches}")
+                    if len(self.rooms) > 1:
+                        for name, st in room_stats.items():
+                            print(f"  房间 {name}: 成员 {len(self.rooms[name].members)}, "
+                                  f"帧数 {st['frames']}, 丢弃 {st['dropped']}")
+                    print(f"当前连接数: {len(self.connections)}, 房间数: {len(self.rooms)}")
+                    clocks = list(self.client_clocks.values())
+                    if clocks:
+                        rtts = [rtt * 1000 for rtt, _ in clocks]
+                        print(f"时钟同步: {len(clocks)}个客户端, 往返时间 平均 {sum(rtts) / len(rtts):.1f}ms, "
+                              f"最大 {max(rtts):.1f}ms")
+                    uplinks = [u.last for u in self.client_uplinks.values() if u.last]
+                    if uplinks:
+                        delays = [delay * 1000 for _, _, delay, _ in uplinks]
+                        print(f"上行: {len(uplinks)}个客户端在发送, 排队延迟 平均 {sum(delays) / len(delays):.1f}ms, "
+                              f"最大 {max(delays):.1f}ms, 最大丢包率 {max(u[0] for u in uplinks) * 100:.1f}%")
+                    congested = sum(p.congested for p in self.client_pressure.values())
+                    if congested or any(actions.values()):
+                        downgraded = sum(1 for p in self.client_pressure.values() if p.level)
+                        print(f"慢速客户端: 拥塞 {congested}, 已降级 {downgraded}, 缩短队列 {actions['drop_oldest']} 次, "
+                              f"降级 {actions['downgrade']} 次, 升级 {actions['upgrade']} 次, "
+                              f"断开 {actions['disconnect']} 个, 丢弃旧帧 {slow_dropped}, 限流未发 {stream_limited}")
+                    if self.bus:
+                        bus = self.bus.take_stats()
+                        print(f"总线: 发出 {bus['sent']}, 收到 {bus['received']}, 丢弃 {bus['dropped']}")
+                    if self.relay:
+                        relay = self.relay.take_stats()
+                        print(f"中继: 连接 {relay['links']}, 发出 {relay['sent']}, "
+                              f"收到 {relay['received']}, 重复丢弃 {relay['duplicates']}")
+                    if self.recorder:
+                        rec = self.recorder.take_stats()
+                        print(f"录音: {rec['files']}个文件, 写入 {rec['frames']} 帧 "
+                              f"{rec['bytes'] / rec['seconds'] / 1e6:.2f}MB/s, 积压 {rec['backlog']} 帧, "
+                              f"丢弃 {rec['dropped']}")
             except Exception as e:
                 print(f"打印统计信息时出错: {e}")
 
@@ -90,77 +318,138 @@ class Server:
         while True:
             try:
                 c, addr = self.s.accept()
-                # 设置客户端socket的缓冲区大小
-                c.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)  # 增加到128KB
-                c.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)  # 增加到128KB
-                # 设置TCP_NODELAY选项，禁用Nagle算法
-                try:
-                    c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                except:
-                    pass
-                # 设置TCP保活选项
-                try:
-                    c.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                except:
-                    pass
+                self.configure_client_socket(c)
                 
                 print(f"新连接来自: {addr[0]}:{addr[1]}")
-
-                with self.lock:
-                    self.connections.append(c)
-                    # 增加队列大小到20，提供更多缓冲
-                    self.client_queues[c] = queue.Queue(maxsize=20)
-
-                # 为每个客户端创建接收和发送线程
-                threading.Thread(target=self.handle_client_receive, args=(c, addr), daemon=True).start()
-                threading.Thread(target=self.handle_client_send, args=(c,), daemon=True).start()
+                self.start_connection(c, addr)
             except Exception as e:
                 print(f"接受连接时出错: {e}")
     
+    def start_connection(self, c, addr):
+        """登记一个已连接的socket并开始收发, 返回代表该连接的对象"""
+        self.add_client(c, RingBuffer(self.queue_size, self.queue_slot_bytes))
+
+        # 为每个客户端创建接收和发送线程
+        threading.Thread(target=self.handle_client_receive, args=(c, addr), daemon=True).start()
+        threading.Thread(target=self.handle_client_send, args=(c,), daemon=True).start()
+        return c
+    
+    def start_peer(self, sock, addr):
+        """登记一条主动建立的中继连接"""
+        c = self.start_connection(sock, addr)
+        with self.lock:
+            self.relay.attach(c, addr)
+    
+    def resize_queue(self, c, size):
+        """换一个更长的发送队列, 发送线程下一轮开始使用"""
+        with self.queue_lock:
+            if c in self.client_queues:
+                self.client_queues[c] = RingBuffer(size, self.queue_slot_bytes)
+    
+    def configure_client_socket(self, c):
+        """设置客户端socket选项"""
+        # 设置客户端socket的缓冲区大小
+        c.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)  # 增加到128KB
+        c.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)  # 增加到128KB
+        # 设置TCP_NODELAY选项，禁用Nagle算法
+        try:
+            c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except:
+            pass
+        # 设置TCP保活选项
+        try:
+            c.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except:
+            pass
+
+    def add_client(self, c, q):
+        """登记新客户端及其待发送队列"""
+        with self.lock:
+            self.connections.append(c)
+            self.client_ids[c] = next(self.next_client_id)
+            self.client_queues[c] = q
+            self.client_events[c] = threading.Event()
+            # 没有握手的客户端不认识 CODEC 控制帧, 只能限制流数
+            self.client_pressure[c] = ClientPressure(downgrade_ladder("pcm", limit_streams=not self.mix),
+                                                     time.monotonic())
+            self.client_uplinks[c] = StreamMonitor()
+            if self.vad:
+                self.client_vads[c] = VoiceActivityDetector()
+            # 没有握手的客户端留在默认房间
+            self.join_room_locked(c, DEFAULT_ROOM)
+
+    def join_room(self, c, name):
+        """把客户端移到指定房间, 返回新房间"""
+        with self.lock:
+            return self.join_room_locked(c, name)
+
+    def join_room_locked(self, c, name):
+        """join_room 的实现, 调用方持有 self.lock"""
+        old = self.client_rooms.get(c)
+        if old is not None and old.name == name:
+            return old
+        if old is not None:
+            self.leave_room_locked(c)
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, mix=self.mix, active_speakers=self.active_speakers)
+        room.members.add(c)
+        room.update_formats(self.client_codecs)
+        self.client_rooms[c] = room
+        if len(room.members) == 1:
+            self.active_rooms_changed_locked()
+        event = self.client_events.get(c)
+        if event is not None:
+            # 让发送线程改读新房间的广播日志
+            event.set()
+        return room
+
+    def leave_room_locked(self, c):
+        """把客户端移出所在房间, 空房间随之删除, 调用方持有 self.lock"""
+        room = self.client_rooms.pop(c, None)
+        if room is None:
+            return
+        room.members.discard(c)
+        room.update_formats(self.client_codecs)
+        if room.speakers:
+            room.speakers.remove(self.client_ids.get(c, 0))
+        if room.mixer:
+            with self.mix_lock:
+                room.mixer.remove(c)
+        if not room.members:
+            if room.name != DEFAULT_ROOM:
+                del self.rooms[room.name]
+            self.drop_converters(("mix", room.name))
+            self.active_rooms_changed_locked()
+
+    def active_rooms(self):
+        """有成员的房间名列表"""
+        with self.lock:
+            return self.active_rooms_locked()
+
+    def active_rooms_locked(self):
+        return [name for name, room in self.rooms.items() if room.members]
+
+    def active_rooms_changed_locked(self):
+        """有成员的房间有变化时通知其他工作进程和中继节点, 调用方持有 self.lock"""
+        if self.bus:
+            self.bus.announce(self.active_rooms_locked())
+        if self.relay:
+            self.relay.announce_locked()
+
     def handle_client_receive(self, c, addr):
         """处理从客户端接收数据"""
-        buffer = bytearray()  # 用于存储不完整的数据包
+        decoder = FrameDecoder()  # 重组不完整或粘在一起的帧
+        sender_id = self.client_ids.get(c, 0)
         
         while True:
             try:
-                # 增加接收缓冲区大小
-                data = c.recv(4096)
+                data = c.recv(65536)
                 if not data:
                     break
                 
-                # 将数据添加到缓冲区
-                buffer.extend(data)
-                
-                # 处理数据包
-                # 在实际应用中，可能需要实现更复杂的数据包处理逻辑
-                # 这里简单处理，直接使用接收到的数据
-                
-                # 将数据放入其他客户端的队列
-                with self.lock:
-                    self.stats["total_packets"] += 1
-                    dropped = False
-                    
-                    for client in list(self.connections):  # 使用列表副本避免迭代时修改
-                        if client != c and client in self.client_queues:
-                            q = self.client_queues[client]
-                            if q.full():
-                                # 队列满，丢弃最旧的数据包
-                                try:
-                                    q.get_nowait()
-                                    dropped = True
-                                except queue.Empty:
-                                    pass
-                            # 添加新数据包到队列
-                            try:
-                                q.put(data)
-                            except:
-                                pass
-                    
-                    if dropped:
-                        self.stats["dropped_packets"] += 1
-                
-                # 清空缓冲区，准备接收下一个数据包
-                buffer.clear()
+                for frame in decoder.feed(data):
+                    self.route_frame(c, sender_id, frame)
             
             except socket.error as e:
                 print(f"接收数据错误: {e}")
@@ -172,52 +461,675 @@ class Server:
         # 客户端断开连接
         self.remove_client(c, addr)
     
-    def handle_client_send(self, c):
-        """处理向客户端发送数据"""
-        last_send_time = time.time()
-        packet_count = 0
+    def route_frame(self, c, sender_id, frame):
+        """处理客户端发来的一个完整帧"""
+        self.bytes_in.inc(HEADER_SIZE + len(frame.payload))
+        counter = self.frames_in.get(frame.payload_type)
+        if counter is None:
+            self.control_frames_in.inc()
+            self.handle_control(c, sender_id, frame)
+            return
+        counter.inc()
+        arrival = time.time()
+        if c in self.client_clocks:
+            self.uplink_delay_seconds.observe(max(0.0, arrival - frame.timestamp))
+        monitor = self.client_uplinks.get(c)
+        if monitor is not None:
+            monitor.on_frame(frame.seq, frame.timestamp, arrival, HEADER_SIZE + len(frame.payload))
+        
+        room = self.client_rooms.get(c)
+        if room is None:
+            return
+        start = time.perf_counter()
+        source_codec = self.client_sources.get(c, "pcm")
+        try:
+            # 舒适噪声描述帧和音频帧走同一条路径, 只是不检测也不转码
+            if frame.payload_type == PT_AUDIO:
+                source_codec = self.frame_stream(c, source_codec, frame)
+                detector = self.client_vads.get(c)
+                if detector is not None and not detector.process(self.codecs[source_codec].decode(frame.payload)):
+                    self.drops["vad"].inc()
+                    return
+            packet_for = self.route_audio(c, room, sender_id, source_codec, frame)
+        except ValueError:
+            # 无法解码的帧只丢弃这一帧, 不断开发送者
+            self.drops["decode"].inc()
+            return
+        self.fanout_seconds.observe(time.perf_counter() - start)
+        if self.bus or self.relay:
+            # 同一房间在其他工作进程或其他节点上的成员由那边转发
+            if packet_for is not None:
+                packet = packet_for(source_codec)
+            else:
+                packet = encode_frame(frame.payload, sender_id, frame.seq, frame.timestamp,
+                                      frame.payload_type, frame.level)
+            if self.bus:
+                self.bus.publish(room.name, source_codec, packet)
+            if self.relay:
+                self.relay.publish(room.name, source_codec, packet)
+    
+    def frame_stream(self, c, stream, frame):
+        """一个音频帧实际的流
+        
+        客户端换发送流的 CODEC 控制帧走 TCP, 与 UDP 上的音频没有先后保证, 帧长与
+        当前的流不符时按帧长在它可能改用的流里找, 找不到时仍按当前的流处理。
+        """
+        size = len(frame.payload)
+        if size == stream_frame_bytes(stream):
+            return stream
+        return self.client_send_streams.get(c, {}).get(size, stream)
+    
+    def route_audio(self, c, room, sender_id, source_codec, frame):
+        """在本进程内转发或混音一个音频帧
+        
+        c 为 None 表示帧来自其他工作进程或中继节点。转发时返回按编码取转发帧的函数,
+        混音时返回 None。
+        """
+        if self.recorder:
+            # 只放入录音写线程的队列, 不在这里做磁盘操作
+            self.recorder.record(room.name, sender_id, source_codec, frame)
+        if room.mixer:
+            if frame.payload_type == PT_CN:
+                # 静音的人不参与混音, 描述帧不需要处理
+                return None
+            # 混音模式下音频帧解码、转成 48kHz 双声道后交给所在房间的混音器, 由节拍统一发出
+            pcm = self.codecs[source_codec].decode(frame.payload)
+            source_format = stream_format(source_codec)
+            if source_format != DEFAULT_FORMAT:
+                pcm = self.convert(sender_id, source_format, DEFAULT_FORMAT, pcm)
+            key = c if c is not None else ("remote", sender_id)
+            with self.mix_lock:
+                room.mixer.push(key, pcm, frame.timestamp)
+            with self.lock:
+                room.stats["frames"] += 1
+            return None
+        
+        now = time.monotonic()
+        if room.speakers and not room.speakers.admit(sender_id, self.frame_level(frame, source_codec), now):
+            # 不是最活跃的几个说话人之一, 不转发
+            self.drops["inactive_speaker"].inc()
+            self.filtered_at[sender_id] = now
+            return None
+        
+        packet_for = self.packet_variants(frame, sender_id, source_codec, room.formats)
+        self.forward_packet(c, room, packet_for)
+        return packet_for
+    
+    def frame_level(self, frame, source_codec):
+        """一帧的音量 (dB), 优先使用帧头字段, 没有提供时解码后计算"""
+        if frame.level:
+            return frame.level
+        if frame.payload_type == PT_CN:
+            level, _ = decode_cn(frame.payload)
+            return 20 * math.log10(level + 1)
+        return level_db(self.codecs[source_codec].decode(frame.payload), stream_format(source_codec).channels)
+    
+    def deliver_remote(self, name, codec, frame):
+        """处理其他工作进程或中继节点转来的一帧, 只在本进程内转发, 不再发回总线
+
+        codec 为发送者的流名称 (编码和采集格式)。
+        """
+        room = self.rooms.get(name)
+        if room is None or not room.members or not valid_stream(codec):
+            return
+        try:
+            self.route_audio(None, room, frame.sender_id, codec, frame)
+        except ValueError:
+            self.drops["decode"].inc()
+    
+    def convert(self, owner, source, target, pcm):
+        """用 owner 的转换器把一帧 PCM 从 source 格式转成 target 格式"""
+        key = (owner, source, target)
+        converter = self.converters.get(key)
+        if converter is None:
+            converter = self.converters[key] = StreamConverter(source, target)
+        return converter.convert(pcm)
+    
+    def drop_converters(self, owner):
+        for key in [k for k in list(self.converters) if k[0] == owner]:
+            self.converters.pop(key, None)
+    
+    def packet_variants(self, frame, sender_id, source_codec, formats=()):
+        """返回按接收方的流取转发帧的函数, 每种流最多转码一次
+        
+        formats 为房间里各成员的播放格式。重采样器带状态, 必须按帧的顺序处理,
+        所以与来源格式不同的格式在这里 (发送者的线程里) 立即转换; 编码留到
+        第一个需要的接收方取帧时再做。
+        """
+        # 用服务器分配的连接ID重新打包, 接收方据此区分说话人
+        cache = {source_codec: encode_frame(frame.payload, sender_id, frame.seq,
+                                            frame.timestamp, frame.payload_type, frame.level)}
+        source_format = stream_format(source_codec)
+        converted = {}
+        if frame.payload_type == PT_AUDIO:
+            targets = [fmt for fmt in formats if fmt != source_format]
+            if targets:
+                pcm = converted[source_format] = self.codecs[source_codec].decode(frame.payload)
+                for fmt in targets:
+                    converted[fmt] = self.convert(sender_id, source_format, fmt, pcm)
+        
+        def packet_for(stream):
+            """按流取转发帧, 无法转码时返回 None, 调用方跳过"""
+            if stream in cache:
+                return cache[stream]
+            if frame.payload_type == PT_CN:
+                # 描述帧与编码和格式无关, 所有接收方收到同一份
+                return cache[source_codec]
+            target = stream_format(stream)
+            try:
+                pcm = converted.get(target)
+                if pcm is None:
+                    pcm = self.codecs[source_codec].decode(frame.payload)
+                    if target != source_format:
+                        # 这一帧转发之后才换格式或加入房间的接收方, 用一次性的转换器
+                        pcm = StreamConverter(source_format, target).convert(pcm)
+                packet = encode_frame(self.codecs[stream].encode(pcm), sender_id, frame.seq,
+                                      frame.timestamp, frame.payload_type, frame.level)
+            except ValueError:
+                # 在接收方的发送线程里调用, 坏帧不能让它退出
+                self.drops["decode"].inc()
+                packet = None
+            cache[stream] = packet
+            return packet
         
+        return packet_for
+    
+    def forward_packet(self, c, room, packet_for):
+        """把一个完整的帧追加到房间的广播日志, 由同一房间其他成员的发送线程各自取走"""
+        room.frame_log.append(c, packet_for)
+    
+    def handle_control(self, c, sender_id, frame):
+        """处理客户端发来的控制帧"""
+        if frame.payload_type == PT_HELLO:
+            hello = decode_control(frame.payload)
+            codec = negotiate_codec(hello.get("codecs"))
+            # 不支持的格式按 48kHz 双声道处理, 播放格式没有给出时与采集格式相同
+            capture = parse_format(hello.get("format"))
+            playout = parse_format(hello.get("playout"), capture)
+            with self.lock:
+                self.client_codecs[c] = stream_name(codec, playout)
+                self.client_sources[c] = stream_name(codec, capture)
+                if hello.get("vad"):
+                    # 客户端自己只发有声的帧
+                    self.client_vads.pop(c, None)
+                elif c in self.client_vads:
+                    self.client_vads[c] = VoiceActivityDetector(capture.channels)
+                room = self.join_room_locked(c, room_name(hello.get("room")))
+                # 已经在这个房间时加入房间是空操作, 播放格式可能变了
+                room.update_formats(self.client_codecs)
+                if c in self.client_pressure:
+                    ladder = downgrade_ladder(codec, hello.get("codecs"), bool(hello.get("codec_switch")),
+                                              limit_streams=not self.mix, active_speakers=self.active_speakers)
+                    self.client_pressure[c] = ClientPressure(ladder, time.monotonic())
+                if hello.get("reports"):
+                    # 客户端自适应码率时沿同一个阶梯换发送流 (congestion.send_ladder)
+                    streams = [stream_name(*stream) for stream in send_ladder(codec, hello.get("codecs"), capture)]
+                    self.client_send_streams[c] = {stream_frame_bytes(name): name for name in reversed(streams)}
+            welcome = {"client_id": sender_id, "codec": codec, "room": room.name,
+                       "format": format_message(capture), "playout": format_message(playout)}
+            if hello.get("transport") == "udp" and self.udp:
+                token = secrets.token_hex(8)
+                with self.lock:
+                    self.udp_tokens[token] = c
+                welcome["udp_port"] = self.udp_port
+                welcome["token"] = token
+            self.queue_packet(c, encode_control(PT_WELCOME, welcome))
+        elif frame.payload_type == PT_JOIN:
+            request = decode_control(frame.payload)
+            with self.lock:
+                room = self.join_room_locked(c, room_name(request.get("room")))
+                reply = {"room": room.name, "members": len(room.members)}
+            self.queue_packet(c, encode_control(PT_JOIN, reply))
+        elif frame.payload_type == PT_PING:
+            self.handle_ping(c, frame)
+        elif frame.payload_type == PT_CODEC:
+            self.handle_send_stream(c, sender_id, decode_control(frame.payload))
+        elif frame.payload_type == PT_REPORT:
+            self.handle_report(c, sender_id, decode_control(frame.payload))
+        elif frame.payload_type == PT_RELAY and self.relay:
+            self.relay.handle_hello(c, frame.payload)
+        elif frame.payload_type == PT_RELAY_FRAME and self.relay and self.relay.is_relay(c):
+            self.relay.handle_frame(c, frame.payload)
+        # 未知的控制帧直接忽略, 不转发给其他客户端
+    
+    def handle_send_stream(self, c, sender_id, message):
+        """客户端自适应码率, 换了发送的编码和格式"""
+        stream = parse_stream_message(message)
+        if stream is None:
+            return
+        codec, fmt = stream
+        with self.lock:
+            if c not in self.client_sources:
+                return
+            self.client_sources[c] = stream_name(codec, fmt)
+            if c in self.client_vads:
+                self.client_vads[c] = VoiceActivityDetector(fmt.channels)
+        # 重采样器带着旧格式的历史采样, 换格式后重新创建
+        self.drop_converters(sender_id)
+    
+    def handle_report(self, c, sender_id, report):
+        """接收方的报告: 它收到的各发送者的丢包率和抖动, 以及它希望最多收几路"""
+        now = time.monotonic()
+        receive = report.get("receive")
+        pressure = self.client_pressure.get(c)
+        if pressure is not None and (pressure.speakers is not None or (
+                pressure.limited_at is not None and now - pressure.limited_at < POLICY_HOLD)):
+            # 服务器在限制发给它的流数, 它看到的空洞大多是没有转发的帧, 这次报告不用
+            receive = None
+        if isinstance(receive, dict):
+            for sender, stats in receive.items():
+                try:
+                    loss, jitter = float(stats[0]), float(stats[1]) / 1000
+                    self.peer_reports.setdefault(int(sender), {})[sender_id] = (loss, jitter, now)
+                except (TypeError, ValueError, IndexError):
+                    continue
+        streams = report.get("streams")
+        if not self.mix and pressure is not None and isinstance(streams, int) and streams >= 0:
+            if pressure.request_streams(streams):
+                print(f"客户端 {sender_id} 请求最多接收 {streams or '不限'} 路")
+    
+    def send_reports(self, now):
+        """给每个收报告的客户端发一次报告: 它的上行统计、积压和其他收听者报告的接收质量"""
+        for sender, reports in list(self.peer_reports.items()):
+            for receiver, (_, _, at) in list(reports.items()):
+                if now - at > 3 * REPORT_INTERVAL:
+                    reports.pop(receiver, None)
+            if not reports:
+                self.peer_reports.pop(sender, None)
+        for sender, at in list(self.filtered_at.items()):
+            if now - at >= POLICY_HOLD:
+                self.filtered_at.pop(sender, None)
+        for c, monitor in list(self.client_uplinks.items()):
+            stats = monitor.take(now)
+            if c not in self.client_send_streams:
+                continue
+            pressure = self.client_pressure.get(c)
+            report = {"queue": self.queue_depth(c), "congested": bool(pressure and pressure.congested)}
+            if stats is not None:
+                loss, jitter, delay, rate = stats
+                report.update(loss=round(loss, 4), jitter=round(jitter, 4), delay=round(delay, 4),
+                              rate=round(rate) if rate else None)
+            # 个别收听者自己网络差不算发送者的问题, 取中位数
+            client_id = self.client_ids.get(c, 0)
+            peers = list(self.peer_reports.get(client_id, {}).values())
+            if peers and client_id not in self.filtered_at:
+                report["peers"] = [median([p[0] for p in peers]), median([p[1] for p in peers])]
+            self.queue_packet(c, encode_control(PT_REPORT, report))
+    
+    def handle_ping(self, c, frame):
+        """回复时钟同步探测, 记下客户端报告的往返时间和时钟偏差"""
+        received = time.time()
+        try:
+            report = decode_ping(frame.payload)
+        except ProtocolError:
+            report = None
+        if report is not None and c in self.client_queues:
+            if c not in self.client_clocks and c in self.client_uplinks:
+                # 之后的帧头时间戳是服务器时钟, 上行排队延迟的基准重新估计
+                self.client_uplinks[c].reset_base()
+            self.client_clocks[c] = report
+            self.rtt_seconds.observe(report[0])
+        # 序列号和客户端的发送时刻原样带回; 使用UDP的客户端从UDP收到回复
+        pong = encode_frame(encode_pong(received, time.time()), 0, frame.seq, frame.timestamp, PT_PONG)
+        self.send_to_client(c, pong)
+    
+    def handle_udp_receive(self):
+        """UDP接收线程, 所有UDP客户端共用"""
         while True:
             try:
-                if c not in self.connections:
-                    break
-                    
-                if c in self.client_queues:
-                    try:
-                        # 非阻塞方式获取数据，超时时间为0.005秒
-                        data = self.client_queues[c].get(timeout=0.005)
-                        c.sendall(data)
-                        
-                        # 控制发送速率
-                        packet_count += 1
-                        current_time = time.time()
-                        if current_time - last_send_time > 1:  # 每秒重置
-                            packet_count = 0
-                            last_send_time = current_time
-                        
-                        # 动态调整休眠时间，根据发送的数据包数量
-                        if packet_count > 30:  # 如果发送速率过高
-                            time.sleep(0.002)  # 稍微休眠一下
-                        else:
-                            time.sleep(0.0005)  # 最小休眠
-                            
-                    except queue.Empty:
-                        # 队列为空，继续下一次循环
-                        time.sleep(0.001)  # 短暂休眠，减少CPU使用
-                else:
-                    # 如果客户端已被移除，退出循环
+                data, addr = self.udp.recvfrom(65536)
+            except OSError as e:
+                print(f"UDP接收错误: {e}")
+                continue
+            self.handle_datagram(data, addr)
+    
+    def handle_datagram(self, data, addr):
+        """处理一个UDP数据报"""
+        try:
+            frame = decode_datagram(data)
+        except Exception:
+            return
+        
+        if frame.payload_type == PT_UDP_REGISTER:
+            token = frame.payload.decode("ascii", "ignore")
+            with self.lock:
+                c = self.udp_tokens.pop(token, None)
+                if c is not None and c in self.client_queues:
+                    self.udp_addrs[c] = addr
+                    self.udp_clients[addr] = c
+            return
+        
+        c = self.udp_clients.get(addr)
+        if c is None:
+            return
+        if frame.payload_type == PT_PING:
+            # 探测有自己的序号, 不参与音频的迟到判断
+            self.bytes_in.inc(len(data))
+            self.control_frames_in.inc()
+            self.handle_ping(c, frame)
+            return
+        # 迟到或重复的帧直接跳过, 不等待也不重排
+        last = self.udp_last_seq.get(c)
+        if last is not None and seq_diff(frame.seq, last) <= 0:
+            self.drops["late"].inc()
+            return
+        self.udp_last_seq[c] = frame.seq
+        try:
+            self.route_frame(c, self.client_ids.get(c, 0), frame)
+        except Exception:
+            # 所有UDP客户端共用一个接收线程, 一个客户端的坏帧不能让它退出
+            self.drops["decode"].inc()
+    
+    def send_to_client(self, c, packet):
+        """向指定客户端发送一个音频帧, 返回是否丢弃了数据"""
+        addr = self.udp_addrs.get(c)
+        if addr is not None:
+            start = time.perf_counter()
+            try:
+                self.udp.sendto(packet, addr)
+            except OSError:
+                # 发送缓冲区满等情况直接丢弃, UDP不重传
+                self.drops["udp_send"].inc()
+                self.note_pressure(c, dropped=1)
+                return True
+            self.send_seconds.observe(time.perf_counter() - start)
+            self.frames_out.inc()
+            self.bytes_out.inc(len(packet))
+            return False
+        return self.queue_packet(c, packet)
+    
+    def queue_packet(self, c, packet):
+        """把一个帧复制进指定客户端的TCP发送队列, 返回是否丢弃了帧"""
+        ring = self.client_queues.get(c)
+        if ring is None:
+            return False
+        # 队列满时覆盖最旧的数据包
+        with self.queue_lock:
+            dropped = ring.write(packet) > 0
+        if dropped:
+            self.drops["queue_full"].inc()
+            self.note_pressure(c, dropped=1)
+        event = self.client_events.get(c)
+        if event is not None:
+            event.set()
+        return dropped
+    
+    def mix_loop(self):
+        """混音节拍线程, 按绝对时间排期避免误差累积"""
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.frame_interval
+            try:
+                self.mix_tick()
+            except Exception as e:
+                print(f"混音出错: {e}")
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -5 * self.frame_interval:
+                # 落后太多时重新对齐, 不补发
+                next_tick = time.monotonic()
+    
+    def mix_tick(self):
+        """完成一个节拍的混音并给每个客户端发送一帧"""
+        outputs = []
+        with self.mix_lock:
+            for room in list(self.rooms.values()):
+                room_outputs, timestamp = room.mixer.mix(list(room.members))
+                outputs.extend((room, listener, pcm, timestamp) for listener, pcm in room_outputs)
+            if not outputs:
+                return
+            # 序列号全服务器共用, 客户端换房间后混音流的序列号仍然连续
+            seq = self.mix_seq
+            self.mix_seq += 1
+        
+        dropped = {}
+        encoded = {}
+        converted = {}
+        shared = {}
+        for _, _, pcm, _ in outputs:
+            shared[id(pcm)] = shared.get(id(pcm), 0) + 1
+        for room, listener, pcm, timestamp in outputs:
+            # 同一份混音按流只编一次, 没说话的收听者共用同一个PCM对象
+            codec = self.client_codecs.get(listener, "pcm")
+            key = (id(pcm), codec)
+            packet = encoded.get(key)
+            if packet is None:
+                target = stream_format(codec)
+                if target != DEFAULT_FORMAT:
+                    # 共用的混音按房间保留转换器状态, 说话人各自的混音按收听者保留
+                    owner = ("mix", room.name) if shared[id(pcm)] > 1 else ("mix", id(listener))
+                    pcm_key = (id(pcm), target)
+                    if pcm_key not in converted:
+                        converted[pcm_key] = self.convert(owner, DEFAULT_FORMAT, target, pcm)
+                    pcm = converted[pcm_key]
+                # 发送者ID为0表示服务器混音
+                packet = encode_frame(self.codecs[codec].encode(pcm), 0, seq, timestamp)
+                encoded[key] = packet
+            if self.send_to_client(listener, packet):
+                dropped[room] = dropped.get(room, 0) + 1
+        with self.lock:
+            for room, _, _, _ in outputs:
+                room.stats["mixed_frames"] += 1
+            for room, count in dropped.items():
+                room.stats["dropped"] += count
+    
+    
+    def handle_client_send(self, c):
+        """处理向客户端发送数据
+
+        没有数据时阻塞在事件上, 被唤醒后先取发给这个客户端的私有队列 (控制消息、
+        混音), 再按游标取广播日志里其他人的帧, 用一次聚集写全部发出去。
+        """
+        event = self.client_events.get(c)
+        if event is None:
+            return
+        room = None
+        log = None
+        
+        try:
+            while c in self.client_queues:
+                # 先清除事件再取数据, 取完之后放入的帧一定会再次唤醒
+                event.clear()
+                current = self.client_rooms.get(c)
+                if current is not room:
+                    # 换了房间, 从新房间日志的当前位置开始读
+                    if log is not None:
+                        log.unsubscribe(event)
+                    room = current
+                    log = room.frame_log if room is not None else None
+                    cursor = log.subscribe(event) if log is not None else 0
+                    continue
+                # 发送队列可能被 resize_queue 换掉, 每轮重新取
+                ring = self.client_queues.get(c)
+                if ring is None:
                     break
-            except socket.error as e:
+                pressure = self.client_pressure.get(c)
+                limit = self.backlog_limit(c)
+                # 直接发送槽位的内容, 发完之前这些槽位不会被覆盖
+                buffers = ring.peek_many()
+                if limit is not None and len(buffers) > limit:
+                    buffers = self.trim_backlog(c, buffers, limit)
+                # 不在任何房间时 (换房间的过程中、中继连接) 只发私有队列
+                entries = []
+                if log is not None:
+                    # 限制的是这一轮发出的音频帧总数, 私有队列里的音频帧已经占了一部分;
+                    # 控制消息不受限制 (见 trim_backlog), 也不占名额
+                    backlog = self.queue_size
+                    if limit is not None:
+                        queued = sum(1 for b in buffers if HEADER.unpack_from(b)[4] in (PT_AUDIO, PT_CN))
+                        backlog = max(limit - queued, 1)
+                    entries, cursor, skipped = log.read(cursor, backlog, c)
+                    if skipped:
+                        self.drops["queue_full" if limit is None else "slow_consumer"].inc(skipped)
+                        self.note_pressure(c, dropped=skipped)
+                if entries:
+                    codec = self.client_codecs.get(c, "pcm")
+                    packets = [e.packet_for(codec) for e in entries]
+                    packets = [p for p in packets if p is not None]
+                    if pressure is not None and pressure.speakers is not None:
+                        packets = self.limit_streams(pressure, packets)
+                    addr = self.udp_addrs.get(c)
+                    if addr is not None:
+                        for packet in packets:
+                            self.send_to_client(c, packet)
+                    else:
+                        buffers.extend(packets)
+                self.client_backlog[c] = len(buffers)
+                self.note_pressure(c, backlog=len(buffers))
+                if buffers:
+                    self.queue_depth_frames.observe(len(buffers))
+                    self.frames_out.inc(len(buffers))
+                    self.bytes_out.inc(sum(len(b) for b in buffers))
+                    self.send_buffers(c, buffers)
+                    ring.release()
+                elif not entries:
+                    event.wait()
+        except socket.error as e:
+            if c in self.client_queues:
+                # 已经被移除 (例如因持续拥塞被断开) 的连接不再报错
                 print(f"发送数据错误: {e}")
-                break
-            except Exception as e:
-                print(f"发送处理错误: {e}")
-                break
+        except Exception as e:
+            print(f"发送处理错误: {e}")
+        finally:
+            if log is not None:
+                log.unsubscribe(event)
+            self.client_backlog.pop(c, None)
                 
         # 如果循环退出，确保客户端被移除
         if c in self.connections:
             self.remove_client(c, ('未知', 0))
     
+    def send_buffers(self, c, buffers):
+        """把多个缓冲区按顺序完整发出, 阻塞的时间计入客户端的发送压力"""
+        pressure = self.client_pressure.get(c)
+        if pressure is None:
+            self.send_all(c, buffers)
+            return
+        pressure.send_started(time.monotonic())
+        try:
+            self.send_all(c, buffers)
+        finally:
+            pressure.send_finished(time.monotonic())
+    
+    def send_all(self, c, buffers):
+        """把多个缓冲区按顺序完整发出, 支持 sendmsg 的平台上一次系统调用发完"""
+        if not hasattr(c, "sendmsg"):
+            # Windows 没有 sendmsg, 拼接后一次发送
+            start = time.perf_counter()
+            c.sendall(b"".join(buffers))
+            self.send_seconds.observe(time.perf_counter() - start)
+            return
+        while buffers:
+            start = time.perf_counter()
+            sent = c.sendmsg(buffers)
+            self.send_seconds.observe(time.perf_counter() - start)
+            # 部分发送时跳过已经发出的部分继续
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent:
+                buffers[0] = buffers[0][sent:]
+    
+    def note_pressure(self, c, backlog=0, dropped=0):
+        """记下发给客户端时的积压和丢帧, 供背压评估使用"""
+        pressure = self.client_pressure.get(c)
+        if pressure is not None:
+            pressure.note(backlog, dropped)
+    
+    def backlog_limit(self, c):
+        """drop-oldest 生效时客户端最多积压的帧数, 没有限制时返回 None
+        
+        限制按每路流 SLOW_QUEUE 帧计算, 同时收好几个人的音频时不至于每轮都丢。
+        """
+        pressure = self.client_pressure.get(c)
+        if pressure is None or pressure.queue_limit is None:
+            return None
+        room = self.client_rooms.get(c)
+        streams = 1
+        if not self.mix and room is not None:
+            streams = max(1, len(room.members) - 1)
+            for limit in (self.active_speakers, pressure.stream_limit):
+                if limit:
+                    streams = min(streams, limit)
+        return min(self.queue_size, pressure.queue_limit * streams)
+    
+    def trim_backlog(self, c, buffers, limit):
+        """只保留最新的 limit 个音频帧, 控制消息 (WELCOME、CODEC 等) 全部保留"""
+        audio = [i for i, b in enumerate(buffers) if HEADER.unpack_from(b)[4] in (PT_AUDIO, PT_CN)]
+        if len(audio) <= limit:
+            return buffers
+        dropped = set(audio[:len(audio) - limit])
+        self.drops["slow_consumer"].inc(len(dropped))
+        self.note_pressure(c, dropped=len(dropped))
+        return [b for i, b in enumerate(buffers) if i not in dropped]
+    
+    def limit_streams(self, pressure, packets):
+        """降级到限制流数时, 只保留这个接收方的几个最活跃发送者的帧"""
+        now = time.monotonic()
+        kept = [p for p in packets if pressure.admit(p, now)]
+        if len(kept) < len(packets):
+            self.drops["stream_limit"].inc(len(packets) - len(kept))
+            pressure.limited_at = now
+        return kept
+    
+    def backpressure_loop(self):
+        """线程引擎的背压评估线程"""
+        while True:
+            time.sleep(EVAL_INTERVAL)
+            try:
+                self.check_backpressure()
+            except Exception as e:
+                print(f"背压评估出错: {e}")
+    
+    def client_socket(self, c):
+        return c
+    
+    def check_backpressure(self):
+        """评估每个客户端上一个周期的发送压力, 按策略处理"""
+        now = time.monotonic()
+        for c, pressure in list(self.client_pressure.items()):
+            if self.relay and self.relay.is_relay(c):
+                # 服务器之间的中继连接不降级也不断开
+                continue
+            sock = self.client_socket(c)
+            actions = self.backpressure.evaluate(pressure, now, unsent_bytes(sock), send_buffer_size(sock))
+            for action in actions:
+                self.backpressure_actions[action].inc()
+                if action == "disconnect":
+                    self.disconnect_slow_client(c, pressure)
+                elif action in ("downgrade", "upgrade"):
+                    self.apply_downgrade(c, pressure, pressure.level + (1 if action == "downgrade" else -1))
+                # drop_oldest 和 recover 只改变 backlog_limit() 的结果, 发送时按它取帧
+        if now - self.reported_at >= REPORT_INTERVAL:
+            self.reported_at = now
+            self.send_reports(now)
+            if self.relay:
+                self.relay.prune(now)
+    
+    def apply_downgrade(self, c, pressure, level):
+        """切换到降级阶梯的某一级, 编码变了时通知客户端"""
+        if not pressure.set_level(level):
+            return
+        codec = pressure.codec
+        with self.lock:
+            stream = self.client_codecs.get(c)
+            if stream is None:
+                return
+            self.client_codecs[c] = stream_name(codec, stream_format(stream))
+        print(f"客户端 {self.client_ids.get(c, 0)} 接收编码改为 {codec} (降级级别 {level})")
+        self.queue_packet(c, encode_control(PT_CODEC, {"codec": codec}))
+    
+    def disconnect_slow_client(self, c, pressure):
+        """连续拥塞超过预算, 断开客户端"""
+        print(f"客户端 {self.client_ids.get(c, 0)} 持续拥塞 {self.backpressure.budget:.0f} 秒, 断开连接")
+        try:
+            # 先 shutdown 唤醒阻塞在 sendmsg 上的发送线程
+            self.client_socket(c).shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.remove_client(c, ("慢速客户端", self.client_ids.get(c, 0)))
+    
     def remove_client(self, c, addr):
         """移除客户端连接"""
         with self.lock:
@@ -225,6 +1137,32 @@ class Server:
                 self.connections.remove(c)
                 if c in self.client_queues:
                     del self.client_queues[c]
+                event = self.client_events.pop(c, None)
+                if event is not None:
+                    # 唤醒发送线程让它退出
+                    event.set()
+                self.leave_room_locked(c)
+                client_id = self.client_ids.pop(c, None)
+                self.drop_converters(client_id)
+                self.peer_reports.pop(client_id, None)
+                self.filtered_at.pop(client_id, None)
+                self.drop_converters(("mix", id(c)))
+                self.client_codecs.pop(c, None)
+                self.client_sources.pop(c, None)
+                self.client_vads.pop(c, None)
+                self.client_backlog.pop(c, None)
+                self.client_clocks.pop(c, None)
+                self.client_pressure.pop(c, None)
+                self.client_uplinks.pop(c, None)
+                self.client_send_streams.pop(c, None)
+                if self.relay:
+                    self.relay.detach(c)
+                addr_udp = self.udp_addrs.pop(c, None)
+                if addr_udp is not None:
+                    self.udp_clients.pop(addr_udp, None)
+                self.udp_last_seq.pop(c, None)
+                for token in [t for t, client in self.udp_tokens.items() if client is c]:
+                    del self.udp_tokens[token]
                 try:
                     c.close()
                 except:
@@ -232,9 +1170,120 @@ class Server:
                 print(f"客户端断开连接: {addr[0]}:{addr[1]}")
                 print(f"当前连接数: {len(self.connections)}")
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="语音聊天服务器")
+    parser.add_argument("--host", default="0.0.0.0", help="监听地址")
+    parser.add_argument("--port", type=int, default=2000, help="监听端口")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded: 每个客户端两个线程; asyncio: 单线程事件循环")
+    parser.add_argument("--mix", action="store_true",
+                        help="服务器端N-1混音, 每个客户端只接收一路混音流")
+    parser.add_argument("--udp", action="store_true",
+                        help="允许客户端通过同端口号的UDP传输音频")
+    parser.add_argument("--vad", action="store_true",
+                        help="对不做语音活动检测的客户端, 服务器跳过其静音帧")
+    parser.add_argument("--active-speakers", type=int, default=0, metavar="K",
+                        help="转发模式下每个房间只转发最活跃的 K 路音频, 0 表示全部转发")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="在该端口以 Prometheus 文本格式导出运行指标 (/metrics), 0 表示不导出; "
+                             "多进程时工作进程 i 使用该端口加 i")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="指标端口的监听地址")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="工作进程数, 大于1时多个进程用 SO_REUSEPORT 监听同一端口 (仅 Linux)")
+    parser.add_argument("--node-id", type=int, default=0,
+                        help=f"中继模式的节点号 (1-{MAX_NODE_ID}), 每个节点不同; 0 表示不启用中继")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT",
+                        help="要连接的中继节点, 可以重复; 需要同时指定 --node-id")
+    parser.add_argument("--slow-policy", default="drop-oldest", metavar="POLICY,...",
+                        help="接收方跟不上时的处理, 逗号分隔, 可选 " + ", ".join(SLOW_POLICIES) +
+                             "; drop-oldest: 只保留最新的几帧; downgrade: 逐级换低码率编码、限制流数; "
+                             "disconnect: 持续拥塞超过 --slow-budget 秒后断开; none 表示不处理")
+    parser.add_argument("--slow-budget", type=float, default=10.0, metavar="SECONDS",
+                        help="disconnect 策略下允许连续拥塞的秒数")
+    parser.add_argument("--record", metavar="DIR",
+                        help="把房间的音频录制到该目录; 一个 WAV 文件最多约 4GB (48kHz 双声道约 6.2 小时), "
+                             "更长时接着写 -part2.wav 等")
+    parser.add_argument("--record-rooms", metavar="ROOM,...",
+                        help="只录制这些房间, 逗号分隔; 默认录制所有房间")
+    parser.add_argument("--record-mode", choices=RECORD_MODES, default="room",
+                        help="room: 每个房间混成一个文件; speaker: 每个说话人一个文件")
+    parser.add_argument("--record-format", choices=RECORD_FORMATS, default="wav",
+                        help="wav: 解码后写入 WAV; raw: 原样保存收到的帧和索引")
+    parser.add_argument("--record-preallocate", type=float, default=0.0, metavar="SECONDS",
+                        help="录音文件每次预分配的秒数, 0 表示不预分配")
+    parser.add_argument("--record-mmap", action="store_true",
+                        help="通过内存映射写入预分配的录音文件")
+    args = parser.parse_args(argv)
+    if not 0 <= args.node_id <= MAX_NODE_ID:
+        parser.error(f"--node-id 必须在 0-{MAX_NODE_ID} 之间")
+    if args.peer and not args.node_id:
+        parser.error("--peer 需要同时指定 --node-id")
+    if args.active_speakers < 0:
+        parser.error("--active-speakers 不能为负数")
+    if args.node_id and args.workers > 1:
+        parser.error("中继模式暂不支持与 --workers 同时使用")
+    if args.record and args.workers > 1:
+        # 每个工作进程都会收到同一房间的帧, 会重复录制
+        parser.error("录音暂不支持与 --workers 同时使用")
+    if args.record_preallocate < 0:
+        parser.error("--record-preallocate 不能为负数")
+    args.slow_policy = [p for p in args.slow_policy.split(",") if p and p != "none"]
+    for policy in args.slow_policy:
+        if policy not in SLOW_POLICIES:
+            parser.error(f"未知的 --slow-policy: {policy}, 可选: {', '.join(SLOW_POLICIES)}")
+    if args.slow_budget <= 0:
+        parser.error("--slow-budget 必须大于0")
+    return args
+
+
+def start_metrics(server, args, offset=0):
+    """按命令行参数启动指标导出端口"""
+    if not args.metrics_port:
+        return
+    port = args.metrics_port + offset
+    try:
+        serve_metrics(server.metrics, args.metrics_host, port)
+        print(f"运行指标: http://{args.metrics_host}:{port}/metrics")
+    except OSError as e:
+        print(f"无法启动指标端口 {port}: {e}")
+
+
+def create_server(args, reuse_port=False):
+    """根据命令行参数创建服务器"""
+    if args.engine == "asyncio":
+        from async_server import AsyncServer
+        server = AsyncServer(args.host, args.port, mix=args.mix, udp=args.udp,
+                             reuse_port=reuse_port, vad=args.vad, active_speakers=args.active_speakers)
+    else:
+        server = Server(args.host, args.port, mix=args.mix, udp=args.udp,
+                        reuse_port=reuse_port, vad=args.vad, active_speakers=args.active_speakers)
+    server.backpressure = BackpressurePolicy(args.slow_policy, args.slow_budget, server.queue_size)
+    if args.node_id:
+        from relay import RelayManager, parse_peer
+        # 连接ID的高位是节点号, 跨节点转发后不会重复
+        server.next_client_id = itertools.count((args.node_id << NODE_ID_SHIFT) + 1)
+        server.relay = RelayManager(server, args.node_id, [parse_peer(p) for p in args.peer])
+    if args.record:
+        rooms = [room_name(r) for r in args.record_rooms.split(",")] if args.record_rooms else None
+        server.recorder = SessionRecorder(args.record, server.metrics, rooms=rooms, mode=args.record_mode,
+                                          file_format=args.record_format, preallocate=args.record_preallocate,
+                                          use_mmap=args.record_mmap)
+        print(f"录音目录: {args.record}")
+    return server
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    # 被 kill 或服务管理器停止时也按正常退出处理, 录音文件得以收尾
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        server = Server()
+        if args.workers > 1:
+            from workers import run_workers
+            run_workers(args)
+        else:
+            server = create_server(args)
+            start_metrics(server, args)
+            server.serve_forever()
     except KeyboardInterrupt:
         print("服务器被用户中断")
     except Exception as e:
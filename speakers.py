@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""活跃说话人选择 ("last-N")
+
+大房间里转发的大部分是没在说话的人的背景噪声, 而每一路都要给 N-1 个成员各
+发一份。--active-speakers K 时服务器按每个发送者最近的音量只转发最活跃的 K 路,
+每个收听者收到的流数不超过 K, 与房间大小无关。
+
+音量取自帧头的音量字段 (客户端按 VAD 计算的电平填写), 没有提供时服务器解码后
+计算。每个发送者的活跃度是音量的平滑值: 变响时跟得快, 变轻时跟得慢, 没有帧
+(静音未发) 时按时间下降。
+
+为了避免选中的集合来回切换:
+
+- 已选中的发送者一直保持, 直到被替换;
+- 没选中的发送者只有活跃度比已选中的最不活跃者高出 hysteresis_db, 并且对方已经
+  保持了至少 hold 秒, 才替换它;
+- 已选中但超过 idle 秒没有任何帧的发送者 (松开了按键或断线) 随时可以被替换。
+"""
+
+import threading
+
+
+class ActiveSpeakers:
+    """一个房间的活跃说话人集合, 可以在多个接收线程中同时调用"""
+
+    def __init__(self, limit, hysteresis_db=6.0, hold=0.5, attack=0.5, release=0.05,
+                 decay_db=20.0, idle=2.0):
+        self.limit = limit
+        self.hysteresis_db = hysteresis_db
+        self.hold = hold
+        # 每帧向当前音量靠近的比例, 变响时用 attack, 变轻时用 release
+        self.attack = attack
+        self.release = release
+        # 没有帧时活跃度每秒下降的分贝数
+        self.decay_db = decay_db
+        self.idle = idle
+        # 发送者 -> (活跃度, 最后一帧的时间)
+        self.scores = {}
+        # 已选中的发送者 -> 选中的时间
+        self.selected = {}
+        self.lock = threading.Lock()
+        self.stats = {"switches": 0}
+
+    def score(self, sender, now):
+        """发送者在 now 时刻的活跃度, 调用方持有 self.lock"""
+        entry = self.scores.get(sender)
+        if entry is None:
+            return 0.0
+        score, last = entry
+        return max(0.0, score - self.decay_db * max(0.0, now - last))
+
+    def admit(self, sender, level_db, now):
+        """按一帧的音量更新发送者的活跃度, 返回这一帧是否转发"""
+        with self.lock:
+            score = self.score(sender, now)
+            rate = self.attack if level_db > score else self.release
+            score += (level_db - score) * rate
+            self.scores[sender] = (score, now)
+            if sender in self.selected:
+                return True
+            if len(self.selected) < self.limit:
+                self.selected[sender] = now
+                return True
+
+            # 优先替换最久没有帧的, 其次是最不活跃的
+            stalest = min(self.selected, key=lambda s: self.scores[s][1])
+            if now - self.scores[stalest][1] > self.idle:
+                weakest = stalest
+            else:
+                weakest = min(self.selected, key=lambda s: self.score(s, now))
+                if (score <= self.score(weakest, now) + self.hysteresis_db
+                        or now - self.selected[weakest] < self.hold):
+                    return False
+            del self.selected[weakest]
+            self.selected[sender] = now
+            self.stats["switches"] += 1
+            return True
+
+    def remove(self, sender):
+        """发送者离开房间"""
+        with self.lock:
+            self.scores.pop(sender, None)
+            self.selected.pop(sender, None)
+
+    def take_stats(self):
+        """返回并清零统计"""
+        with self.lock:
+            stats = dict(self.stats)
+            self.stats["switches"] = 0
+            # 顺便清理早已不发帧的远端发送者, 它们不会调用 remove()
+            if self.scores:
+                now = max(last for _, last in self.scores.values())
+                for sender in [s for s, (_, last) in self.scores.items()
+                               if s not in self.selected and now - last > 60]:
+                    del self.scores[sender]
+        stats["selected"] = len(self.selected)
+        return stats
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+"""语音活动检测 (VAD)
+
+固定的音量阈值在安静的房间里会把轻声的字头切掉, 在嘈杂的环境里又一直判为有声。
+这里每帧计算两个特征 (整帧一次完成, 不逐个采样循环):
+
+- 能量: 单声道均方根的分贝值, 与在线跟踪的背景噪声电平比较。噪声电平遇到更安静
+  的帧时很快降下去, 否则缓慢上升, 有声期间上升得更慢, 因此环境变吵后几秒内跟上,
+  但一段长句不会把噪声电平抬上去;
+- 过零率: 擦音、送气音 (s, f, h) 能量低但过零多, 能量超过噪声一半阈值且过零率
+  较高时也算有声, 减少字头被切掉。
+
+单帧判断之后再做平滑: 连续 attack 帧有声才进入说话状态, 之后连续 hangover 帧
+无声才退出, 句中的短停顿和字尾的弱音不会被切掉。
+"""
+
+import numpy as np
+
+
+def level_db(pcm, channels=2):
+    """一帧 int16 PCM 的电平 (dB), 刻度与 VoiceActivityDetector.level_db 相同"""
+    samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+    mono = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    if len(mono) < 2:
+        return 0.0
+    mono -= mono.mean()
+    return float(10 * np.log10(float(np.dot(mono, mono)) / len(mono) + 1.0))
+
+
+class VoiceActivityDetector:
+    """单路音频的语音活动检测, 每帧调用一次 process()"""
+
+    def __init__(self, channels=2, threshold_db=6.0, zcr_threshold=0.25, attack=1,
+                 hangover=15, min_level_db=30.0, rise_db=0.05):
+        self.channels = channels
+        # 高于噪声电平多少分贝判为有声
+        self.threshold_db = threshold_db
+        # 过零率 (每个采样间隔过零的比例) 超过该值时按擦音处理
+        self.zcr_threshold = zcr_threshold
+        # 进入说话状态需要的连续有声帧数, 退出前保持的帧数 (每帧约21ms)
+        self.attack = attack
+        self.hangover = hangover
+        # 低于这个电平一定是静音 (int16 满幅约 90 dB)
+        self.min_level_db = min_level_db
+        # 噪声电平每帧最多上升的分贝数, 有声帧上升速度为十分之一
+        self.rise_db = rise_db
+
+        self.noise_db = None
+        self.active = False
+        self.run = 0
+        self.hold = 0
+        # 最近一帧的特征, 供统计和调试
+        self.level_db = 0.0
+        self.zcr = 0.0
+
+    def reset(self):
+        """结束当前的说话状态, 保留噪声电平"""
+        self.active = False
+        self.run = 0
+        self.hold = 0
+
+    def features(self, pcm):
+        """返回 (电平 dB, 过零率)"""
+        samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+        frame = samples[:len(samples) // self.channels * self.channels].reshape(-1, self.channels)
+        mono = frame.mean(axis=1, dtype=np.float32)
+        if len(mono) < 2:
+            return 0.0, 0.0
+        mono -= mono.mean()
+        energy = float(np.dot(mono, mono)) / len(mono)
+        level_db = 10 * np.log10(energy + 1.0)
+        signs = np.signbit(mono)
+        zcr = np.count_nonzero(signs[1:] != signs[:-1]) / (len(mono) - 1)
+        return level_db, zcr
+
+    def is_speech(self, level_db, zcr):
+        """单帧判断, 并更新噪声电平"""
+        if self.noise_db is None:
+            self.noise_db = level_db
+        excess = level_db - self.noise_db
+        speech = level_db >= self.min_level_db and (
+            excess >= self.threshold_db
+            or (excess >= self.threshold_db / 2 and zcr >= self.zcr_threshold))
+
+        if level_db < self.noise_db:
+            self.noise_db += (level_db - self.noise_db) * 0.2
+        else:
+            rise = self.rise_db / 10 if speech else self.rise_db
+            self.noise_db += min(rise, level_db - self.noise_db)
+        return speech
+
+    def process(self, pcm):
+        """输入一帧 int16 PCM, 返回这一帧是否应当作为语音发送"""
+        self.level_db, self.zcr = self.features(pcm)
+        if self.is_speech(self.level_db, self.zcr):
+            self.run += 1
+            if self.run >= self.attack:
+                self.active = True
+                self.hold = self.hangover
+        else:
+            self.run = 0
+            if self.active:
+                if self.hold > 0:
+                    self.hold -= 1
+                else:
+                    self.active = False
+        return self.active
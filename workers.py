@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+"""多进程服务器
+
+单个 Python 进程受 GIL 限制最多用满一个核心。--workers K 时主进程启动 K 个工作
+进程, 每个进程运行一个完整的服务器 (线程或 asyncio 引擎), 监听 socket 都设置
+SO_REUSEPORT 绑定到同一个端口, 由内核把新连接分散到各个进程。
+
+同一个房间的成员可能落在不同的进程上, 进程之间用本机的 Unix socket 组成一条
+总线:
+
+- 每个进程定期 (以及本地房间有人进出时) 向其他进程广播自己有成员的房间列表;
+- 本进程客户端发来的音频帧在本地转发之外, 再发给在同一房间有成员的其他进程,
+  每个进程每帧一条消息, 内容就是重新打包好的转发帧;
+- 从总线收到的帧只在本进程内转发或混音, 不再发回总线, 因此不会形成环路。
+
+连接ID按进程交错分配 (进程 i 使用 i+1, i+1+K, ...), 跨进程转发后接收方仍能
+区分说话人。UDP 音频的注册数据报和之后的数据报必须落在同一个进程上, 所以多进程
+时每个进程的 UDP socket 使用系统分配的端口, 通过 WELCOME 告诉客户端。
+
+需要 SO_REUSEPORT 和 Unix socket (Linux)。
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import selectors
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+
+from protocol import decode_room_frame, encode_room_frame
+
+MSG_ROOMS = b"R"
+MSG_FRAME = b"F"
+# 房间列表的广播间隔, 超过三个间隔没有消息的进程视为已退出
+ANNOUNCE_INTERVAL = 1.0
+PEER_TIMEOUT = 3 * ANNOUNCE_INTERVAL
+# 每条连接最多积压的消息数, 超出丢弃最旧的
+MAX_BACKLOG = 256
+
+MESSAGE_LENGTH = struct.Struct("!I")
+WORKER_INDEX = struct.Struct("!H")
+
+
+class PeerLink:
+    """到另一个工作进程的单向连接, 由自己的发送线程把积压的消息合并发出
+
+    send() 可以在任意线程调用, 只把消息放进队列; 连接断开或对方还没启动时
+    丢弃积压的消息, 下次有消息时重连。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.outbox = deque()
+        self.event = threading.Event()
+        self.dropped = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, message):
+        """加入发送队列, 返回是否因积压丢弃了旧消息"""
+        dropped = False
+        if len(self.outbox) >= MAX_BACKLOG:
+            try:
+                self.outbox.popleft()
+                self.dropped += 1
+                dropped = True
+            except IndexError:
+                pass
+        self.outbox.append(message)
+        self.event.set()
+        return dropped
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            buffers = []
+            while self.outbox:
+                message = self.outbox.popleft()
+                buffers.append(MESSAGE_LENGTH.pack(len(message)))
+                buffers.append(message)
+            if not buffers:
+                continue
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)
+                    self.sock.connect(self.path)
+                self.sock.sendall(b"".join(buffers))
+            except OSError:
+                # 对方还没启动或已退出, 这批消息丢弃, 下次重连
+                self.dropped += len(buffers) // 2
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+
+
+class WorkerBus:
+    """工作进程之间的本机总线
+
+    每个进程监听一个 Unix 流 socket, 向每个其他进程各建一条连接发消息。消息为
+    4字节长度加内容。接收端的 socket 由 add_reader 登记: 线程引擎在总线线程自己的
+    selectors 循环里处理, asyncio 引擎直接登记到事件循环。
+    """
+
+    def __init__(self, server, index, workers, directory):
+        self.server = server
+        self.index = index
+        self.workers = workers
+        self.directory = directory
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path(index))
+        self.listener.listen(workers)
+        self.listener.setblocking(False)
+        self.links = {i: PeerLink(self.path(i)) for i in range(workers) if i != index}
+        # 接收连接 -> 未处理完的数据
+        self.pending = {}
+        self.add_reader = None
+        self.remove_reader = None
+        # 进程号 -> (有成员的房间集合, 最后收到消息的时间); 只在处理总线消息的线程里整体替换
+        self.remote = {}
+        # 房间名 -> 需要转发的连接, 由 remote 推出, 数据路径只读这个字典
+        self.routes = {}
+        self.last_announce = 0.0
+        self.stats = {"sent": 0, "received": 0}
+
+    def path(self, index):
+        return os.path.join(self.directory, f"worker-{index}.sock")
+
+    def attach(self, add_reader, remove_reader):
+        """登记监听socket, 之后接受的连接也通过 add_reader 登记"""
+        self.add_reader = add_reader
+        self.remove_reader = remove_reader
+        add_reader(self.listener, self.accept_ready)
+
+    def announce(self, rooms):
+        """把本进程有成员的房间列表发给所有其他进程"""
+        self.last_announce = time.monotonic()
+        message = MSG_ROOMS + WORKER_INDEX.pack(self.index) + json.dumps(sorted(rooms)).encode()
+        for link in self.links.values():
+            link.send(message)
+
+    def publish(self, room, codec, packet):
+        """把本地客户端的一帧发给同一房间有成员的其他进程"""
+        links = self.routes.get(room)
+        if not links:
+            return
+        message = MSG_FRAME + encode_room_frame(room, codec, packet)
+        for link in links:
+            link.send(message)
+            self.stats["sent"] += 1
+
+    def accept_ready(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"总线接受连接出错: {e}")
+                return
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+            conn.setblocking(False)
+            self.pending[conn] = b""
+            self.add_reader(conn, lambda conn=conn: self.receive_ready(conn))
+
+    def receive_ready(self, conn):
+        """连接可读时读出所有完整的消息并处理"""
+        try:
+            data = conn.recv(262144)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.remove_reader(conn)
+            self.pending.pop(conn, None)
+            conn.close()
+            return
+        buffer = self.pending[conn] + data
+        offset = 0
+        while len(buffer) - offset >= MESSAGE_LENGTH.size:
+            (length,) = MESSAGE_LENGTH.unpack_from(buffer, offset)
+            end = offset + MESSAGE_LENGTH.size + length
+            if end > len(buffer):
+                break
+            self.dispatch(buffer[offset + MESSAGE_LENGTH.size:end])
+            offset = end
+        self.pending[conn] = buffer[offset:]
+
+    def dispatch(self, message):
+        try:
+            self.handle_message(message)
+        except Exception as e:
+            print(f"处理总线消息出错: {e}")
+
+    def handle_message(self, message):
+        """处理总线上收到的一条消息"""
+        kind = message[:1]
+        if kind == MSG_FRAME:
+            room, codec, frame = decode_room_frame(memoryview(message)[1:])
+            self.stats["received"] += 1
+            self.server.deliver_remote(room, codec, frame)
+        elif kind == MSG_ROOMS:
+            (index,) = WORKER_INDEX.unpack_from(message, 1)
+            rooms = set(json.loads(message[1 + WORKER_INDEX.size:]))
+            remote = dict(self.remote)
+            remote[index] = (rooms, time.monotonic())
+            self.update_routes(remote)
+
+    def update_routes(self, remote):
+        routes = {}
+        for index, (rooms, _) in remote.items():
+            link = self.links.get(index)
+            if link is None:
+                continue
+            for room in rooms:
+                routes.setdefault(room, []).append(link)
+        self.remote = remote
+        self.routes = routes
+
+    def expire_peers(self):
+        """去掉很久没有消息的进程"""
+        now = time.monotonic()
+        remote = {i: entry for i, entry in self.remote.items() if now - entry[1] < PEER_TIMEOUT}
+        if len(remote) != len(self.remote):
+            self.update_routes(remote)
+
+    def tick(self):
+        """定期广播房间列表并清理失联的进程"""
+        if time.monotonic() - self.last_announce >= ANNOUNCE_INTERVAL:
+            self.announce(self.server.active_rooms())
+            self.expire_peers()
+
+    def take_stats(self):
+        """返回并清零统计"""
+        stats = dict(self.stats)
+        stats["dropped"] = 0
+        for link in self.links.values():
+            stats["dropped"] += link.dropped
+            link.dropped = 0
+        for key in self.stats:
+            self.stats[key] = 0
+        return stats
+
+    def run(self):
+        """线程引擎的总线线程"""
+        selector = selectors.DefaultSelector()
+        self.attach(lambda sock, callback: selector.register(sock, selectors.EVENT_READ, callback),
+                    selector.unregister)
+        while True:
+            for key, _ in selector.select(ANNOUNCE_INTERVAL):
+                key.data()
+            self.tick()
+
+
+def worker_main(args, index, directory):
+    """工作进程入口"""
+    from server import create_server, start_metrics
+    try:
+        server = create_server(args, reuse_port=True)
+        start_metrics(server, args, index)
+        # 连接ID在所有进程间不重复
+        server.next_client_id = itertools.count(index + 1, args.workers)
+        server.bus = WorkerBus(server, index, args.workers, directory)
+        print(f"工作进程 {index} (pid {os.getpid()}) 已启动")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(args):
+    """启动 args.workers 个工作进程并等待它们退出"""
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        print("当前平台不支持 SO_REUSEPORT, 无法使用多进程模式")
+        return
+    directory = tempfile.mkdtemp(prefix="voicechat-bus-")
+    processes = [multiprocessing.Process(target=worker_main, args=(args, i, directory), daemon=True)
+                 for i in range(args.workers)]
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+        shutil.rmtree(directory, ignore_errors=True)